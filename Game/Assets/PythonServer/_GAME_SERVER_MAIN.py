@@ -42,7 +42,8 @@
 #/unity-game GET - возвращает Unity WebGL игру (если есть).
 
 
-from flask import Flask, request, jsonify, send_from_directory, redirect
+from flask import Flask, Blueprint, request, jsonify, send_from_directory, redirect
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
 import sys
@@ -52,24 +53,78 @@ import logging
 # Добавляем папку endpoints в путь для импорта
 sys.path.append(os.path.join(os.path.dirname(__file__), 'end_points'))
 
-# Импортируем endpoint модули
+# Импортируем endpoint модули (импорт не открывает базу и не запускает потоки)
 from lobby_endpoints import lobby_bp
-from queue_endpoints import queue_bp
-from match_endpoints import match_bp
+from queue_endpoints import queue_bp, start_queue_processor
+from match_endpoints import match_bp, start_timeout_checker
 from user_endpoints import user_bp
+from database import DB_BACKEND, db, init_storage
+from records import Record
 
-app = Flask(__name__)
-CORS(app)
-
-# Регистрируем blueprint'ы с единым префиксом api-game-
-app.register_blueprint(lobby_bp, url_prefix='/api-game-lobby')
-app.register_blueprint(queue_bp, url_prefix='/api-game-queue')
-app.register_blueprint(match_bp, url_prefix='/api-game-match')
-app.register_blueprint(user_bp, url_prefix='/api-game-user')
+# Страницы игры (не API)
+site_bp = Blueprint('site', __name__)
 
 STATIC_ONLINE_GAME_DIR = r"c:\\NDLWebServerBuild\\wwwroot\\online-game"
 
-@app.route('/')
+class RecordJSONProvider(DefaultJSONProvider):
+    """JSON ответов: записи хранилища (records.py) превращаются в словари только здесь"""
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+def create_app(backend: str = DB_BACKEND, start_workers: bool = True) -> Flask:
+    """Создание приложения: инициализация хранилища, регистрация blueprint'ов и запуск фоновых потоков.
+    
+    start_workers=False - без открытия базы и фоновых потоков: хранилище создается
+    при первом обращении (тесты, инструменты, процесс-наблюдатель перезагрузчика).
+    """
+    if start_workers:
+        init_storage(backend)
+    else:
+        db.configure(backend)
+    
+    app = Flask(__name__)
+    app.json = RecordJSONProvider(app)
+    CORS(app)
+    
+    # Регистрируем blueprint'ы с единым префиксом api-game-
+    app.register_blueprint(site_bp)
+    app.register_blueprint(lobby_bp, url_prefix='/api-game-lobby')
+    app.register_blueprint(queue_bp, url_prefix='/api-game-queue')
+    app.register_blueprint(match_bp, url_prefix='/api-game-match')
+    app.register_blueprint(user_bp, url_prefix='/api-game-user')
+    
+    if start_workers:
+        # Очистка очереди игроков при старте сервера
+        try:
+            print("Clearing queue_users table on startup...")
+            db.clear_queue()
+            print("Queue cleared.")
+        except Exception as e:
+            print(f"Error clearing queue on startup: {e}")
+        start_queue_processor()
+        start_timeout_checker()
+        # Фоновая очистка старых игр и игровых сессий
+        db.start_retention_worker()
+        # Фоновые копии базы (backups/ в database.data_dir(), вне папки Assets)
+        db.start_backup_worker()
+    return app
+
+_app = None
+
+def __getattr__(name):
+    """Совместимость с `from _GAME_SERVER_MAIN import app`: приложение создается при первом обращении"""
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@site_bp.route('/')
 def home():
     return jsonify({
         "status": "success",
@@ -77,27 +132,27 @@ def home():
         "port": 3329
     })
 
-@app.route('/online-game/')
+@site_bp.route('/online-game/')
 def online_game():
     """Возвращает HTML страницу с игрой"""
     logging.warning(f"Serving game.html from: {STATIC_ONLINE_GAME_DIR}")
     return send_from_directory(STATIC_ONLINE_GAME_DIR, 'game.html')
 
-@app.route('/online-game/<path:filename>')
+@site_bp.route('/online-game/<path:filename>')
 def static_files(filename):
     """Возвращает статические файлы для игры (css, js и др.)"""
     logging.warning(f"Serving static file: {filename} from: {STATIC_ONLINE_GAME_DIR}")
     return send_from_directory(STATIC_ONLINE_GAME_DIR, filename)
 
-@app.route('/online-game/game.css')
+@site_bp.route('/online-game/game.css')
 def serve_game_css():
     return send_from_directory(STATIC_ONLINE_GAME_DIR, 'game.css')
 
-@app.route('/online-game/game.js')
+@site_bp.route('/online-game/game.js')
 def serve_game_js():
     return send_from_directory(STATIC_ONLINE_GAME_DIR, 'game.js')
 
-@app.route('/unity-game/')
+@site_bp.route('/unity-game/')
 def unity_game():
     """Возвращает Unity WebGL игру (index.html)"""
     unity_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
@@ -112,7 +167,7 @@ def unity_game():
             "unity_path": unity_build_dir
         }), 404
 
-@app.route('/unity-game/<path:filename>')
+@site_bp.route('/unity-game/<path:filename>')
 def unity_static_files(filename):
     """Возвращает статические файлы Unity игры (js, wasm, data и др.)"""
     unity_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
@@ -152,18 +207,11 @@ if __name__ == '__main__':
     print("- /unity-game/ - Unity WebGL game (if available)")
     print("- /api-game-* - API endpoints")
     
-    # Очистка очереди игроков при старте сервера
-    from database import db as _db
-    try:
-        print("Clearing queue_users table on startup...")
-        conn = _db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM queue_users')
-        conn.commit()
-        conn.close()
-        print("Queue cleared.")
-    except Exception as e:
-        print(f"Error clearing queue on startup: {e}")
+    # При debug=True родительский процесс перезагрузчика только следит за файлами:
+    # база и фоновые потоки нужны лишь процессу, который обслуживает запросы
+    serving = os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    app = create_app(start_workers=serving)
+    
     # Проверяем наличие Unity билда
     unity_path = os.path.join(os.path.dirname(__file__), '..', '..')
     if os.path.exists(os.path.join(unity_path, 'index.html')):
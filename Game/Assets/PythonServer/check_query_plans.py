@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Проверка планов запросов горячего пути (EXPLAIN QUERY PLAN)
+
+    python check_query_plans.py                  - на чистой временной базе
+    python check_query_plans.py game_server.db   - на существующей базе (применит миграции)
+
+Код возврата 1, если хотя бы один запрос из HOT_QUERIES выполняется полным сканированием.
+"""
+
+import os
+import sys
+import tempfile
+
+from database import GameDatabase, HOT_QUERIES
+
+def check(path: str) -> bool:
+    """Проверяет планы запросов, возвращает True если все в порядке"""
+    database = GameDatabase(path)
+    with database.connection() as conn:
+        print(f"📋 Schema version: {database.get_schema_version(conn)}")
+
+    problems = database.check_query_plans()
+    database.close()
+
+    for name in HOT_QUERIES:
+        if name in problems:
+            print(f"  ❌ {name}: {' | '.join(problems[name])}")
+        else:
+            print(f"  ✅ {name}")
+
+    return not problems
+
+def main():
+    if len(sys.argv) > 1:
+        ok = check(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            ok = check(os.path.join(tmp, "plans.db"))
+
+    if not ok:
+        print("\n❌ Hot queries fall back to a full table scan")
+        sys.exit(1)
+    print("\n✅ All hot queries use indexes")
+
+if __name__ == "__main__":
+    main()
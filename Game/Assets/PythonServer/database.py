@@ -1,23 +1,1362 @@
 import sqlite3
 import os
-from datetime import datetime
+import json
+import urllib.parse
+import base64
+import functools
+import queue
+import threading
+import re
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
 
-class GameDatabase:
-    def __init__(self, db_path: str = "game_server.db"):
-        """Инициализация базы данных"""
+from storage import GameStorage, DB_RETENTION_DAYS, DB_RETENTION_INTERVAL, DB_BACKUP_INTERVAL, DB_BACKUP_KEEP
+from records import Record, LobbyUserRecord, MatchRecord
+
+# Настройки пула соединений
+DB_POOL_SIZE = 8  # максимальное количество одновременно открытых соединений
+DB_CACHED_STATEMENTS = 128  # размер кэша подготовленных запросов на одно соединение
+DB_POOL_TIMEOUT = 30.0  # время ожидания свободного соединения в секундах
+
+# Журнал WAL и пул соединений только для чтения (mode=ro) для методов get_*
+DB_WAL = True  # journal_mode=WAL: чтения не блокируют запись и наоборот
+DB_READER_POOL_SIZE = 8  # размер пула читателей (0 - чтения идут через общий пул)
+
+# Настройки группового коммита (режим включается параметром group_commit)
+DB_GROUP_COMMIT = False  # все записи через один поток-писатель
+DB_GROUP_COMMIT_WINDOW = 0.002  # сколько секунд писатель собирает операции в одну транзакцию
+DB_GROUP_COMMIT_MAX_BATCH = 256  # максимум операций в одной транзакции
+
+# Настройки кэша пользователей
+DB_USER_CACHE_SIZE = 10000  # максимум пользователей в кэше (0 - кэш выключен)
+DB_USER_CACHE_TTL = 60.0  # время жизни записи в кэше в секундах
+
+# INSERT/UPDATE/DELETE ... RETURNING появился в SQLite 3.35.0, на старых версиях строка перечитывается SELECT
+SQLITE_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Максимум параметров в одном запросе IN (...) (SQLITE_MAX_VARIABLE_NUMBER в старых сборках - 999)
+DB_MAX_IN_PARAMS = 500
+
+# Сколько номеров последовательности (player_id) резервируется в базе за один запрос
+DB_SEQUENCE_BLOCK_SIZE = 100
+
+# Настройки очистки старых данных (retention); DB_RETENTION_DAYS и DB_RETENTION_INTERVAL - в storage.py
+DB_RETENTION_CHUNK_SIZE = 500  # максимум строк, удаляемых одной транзакцией
+DB_RETENTION_PAUSE = 0.05  # пауза между транзакциями, чтобы записи игры не ждали блокировку
+DB_VACUUM_PAGES_PER_STEP = 256  # страниц, освобождаемых одним PRAGMA incremental_vacuum
+
+# Резервное копирование на ходу (sqlite3.Connection.backup): копия снимается шагами по DB_BACKUP_PAGES
+# страниц с паузой между ними, поэтому записи игры не ждут, пока копируется вся база
+# (DB_BACKUP_INTERVAL и DB_BACKUP_KEEP - в storage.py, общие с GameStorage)
+DB_BACKUP_DIR = 'backups'  # каталог копий в data_dir() базы
+DB_BACKUP_PAGES = 256  # страниц за один шаг
+DB_BACKUP_PAUSE = 0.01  # пауза между шагами в секундах
+DB_BACKUP_MAX_RESTARTS = 3  # после стольких перезапусков копия снимается одним шагом
+
+# Счетчики статистики сервера
+DB_STATS_RECONCILE_INTERVAL = 300.0  # как часто (в секундах) счетчики сверяются с базой через COUNT(*)
+
+# PRAGMA foreign_keys=ON на каждом соединении: удаление пользователя или игры одним DELETE
+# удаляет связанные строки через ON DELETE CASCADE (см. CASCADE_FOREIGN_KEYS)
+DB_FOREIGN_KEYS = True
+
+# Шардирование: users, lobby_users, game_stats и user_mmr распределяются по DB_SHARDS файлам
+# по хэшу user_id, остальные таблицы (matches, очередь, сессии) остаются в основной базе
+DB_SHARDS = 1  # 1 - без шардирования
+
+# Каталог файлов, которые сервер создает сам (шарды, копии): задается явно через GAME_DB_DATA_DIR,
+# иначе - data_dir() по пути базы. Файлы в папке Assets редактор Unity импортирует и создает для них .meta
+DB_DATA_DIR = os.environ.get('GAME_DB_DATA_DIR')
+DB_UNITY_DATA_DIR = 'ServerData'  # каталог рядом с Assets проекта Unity
+
+# Реализация глобального db: 'sqlite' - GameDatabase/ShardedGameDatabase, 'memory' - MemoryGameDatabase
+# (без файлов, данные теряются при остановке - для бенчмарков и нагрузочных тестов)
+DB_BACKEND = os.environ.get('GAME_DB_BACKEND', 'sqlite')
+
+# Профилирование: время и строки по методам хранилища и по SQL, журнал медленных запросов.
+# Можно включить на работающем сервере: db.profiler.enable() или POST /api-game-lobby/db-profile
+DB_PROFILING = False
+DB_SLOW_QUERY_MS = 50.0  # запросы дольше попадают в журнал медленных запросов
+DB_SLOW_QUERY_LOG_SIZE = 100  # размер кольцевого журнала медленных запросов
+
+# Списки параметров IN (?, ?, ...) разной длины считаются одним запросом
+_SQL_PARAM_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def normalize_sql(sql: str) -> str:
+    """Текст запроса для статистики: без лишних пробелов, списки ? свернуты"""
+    return _SQL_PARAM_LIST.sub('?, ...', ' '.join(sql.split()))
+
+class QueryProfiler:
+    """Профилировщик слоя базы данных.
+    
+    Пока enabled, считает вызовы, время и строки по публичным методам хранилища
+    (profiled_methods) и по SQL запросам (ProfiledCursor). У метода учитывается
+    только внешний вызов в потоке: вложенные вызовы входят в его время.
+    Запросы дольше slow_query_ms попадают в кольцевой журнал вместе с
+    EXPLAIN QUERY PLAN (параметры не сохраняются - в них бывают пароли).
+    Открытия соединений считаются всегда.
+    """
+    
+    def __init__(self, enabled: bool = DB_PROFILING, slow_query_ms: float = DB_SLOW_QUERY_MS,
+                 slow_log_size: int = DB_SLOW_QUERY_LOG_SIZE):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections: Dict[str, int] = {}
+        self._query_keys: Dict[str, str] = {}  # текст запроса -> normalize_sql, чтобы не разбирать его заново
+        self._slow_queries = deque(maxlen=slow_log_size)
+        self.reset()
+    
+    def enable(self, slow_query_ms: Optional[float] = None):
+        """Включение профилирования (slow_query_ms - новый порог медленного запроса)"""
+        if slow_query_ms is not None:
+            self.slow_query_ms = slow_query_ms
+        self.enabled = True
+    
+    def disable(self):
+        """Выключение профилирования (собранная статистика сохраняется)"""
+        self.enabled = False
+    
+    def reset(self):
+        """Сброс статистики методов, запросов и журнала медленных запросов"""
+        with self._lock:
+            self._methods: Dict[str, list] = {}  # имя -> [вызовов, время, макс. время, запросов, строк]
+            self._queries: Dict[str, list] = {}  # SQL -> [выполнений, время, макс. время, строк]
+            self._slow_queries.clear()
+            self._started_at = datetime.now()
+    
+    def connection_opened(self, name: str):
+        """Учет открытия соединения с базой"""
+        with self._lock:
+            self._connections[name] = self._connections.get(name, 0) + 1
+    
+    def in_method(self) -> bool:
+        """Выполняется ли в текущем потоке учитываемый метод хранилища"""
+        return getattr(self._local, 'method', None) is not None
+    
+    @contextmanager
+    def method(self, name: str):
+        """Замер вызова метода хранилища name вместе с его запросами"""
+        totals = self._local.method = [0, 0]  # запросов, строк
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._local.method = None
+            with self._lock:
+                stats = self._methods.get(name)
+                if stats is None:
+                    stats = self._methods[name] = [0, 0.0, 0.0, 0, 0]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                stats[3] += totals[0]
+                stats[4] += totals[1]
+    
+    def query_key(self, sql: str) -> str:
+        """Ключ запроса в статистике (normalize_sql с кэшем)"""
+        key = self._query_keys.get(sql)
+        if key is None:
+            if len(self._query_keys) >= 10000:
+                self._query_keys.clear()
+            key = self._query_keys[sql] = normalize_sql(sql)
+        return key
+    
+    def record_query(self, key: str, elapsed: float, rows: int, executed: bool, execution_time: float):
+        """Учет шага запроса key: выполнения (executed) или чтения строк.
+        
+        execution_time - время выполнения запроса вместе с уже прочитанными строками.
+        """
+        totals = getattr(self._local, 'method', None)
+        if totals is not None:
+            totals[0] += executed
+            totals[1] += rows
+        with self._lock:
+            stats = self._queries.get(key)
+            if stats is None:
+                stats = self._queries[key] = [0, 0.0, 0.0, 0]
+            stats[0] += executed
+            stats[1] += elapsed
+            stats[2] = max(stats[2], execution_time)
+            stats[3] += rows
+    
+    def log_slow_query(self, conn: sqlite3.Connection, sql: str, params, elapsed: float, rows: int) -> Dict[str, Any]:
+        """Запись медленного запроса в журнал, возвращает запись (курсор дополняет ее при чтении строк)"""
+        try:
+            # Обычный курсор: EXPLAIN не должен попасть в статистику
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        except sqlite3.Error:
+            plan = []  # PRAGMA, BEGIN, COMMIT и другие запросы без плана
+        entry = {
+            "time": datetime.now().isoformat(timespec='seconds'),
+            "sql": ' '.join(sql.split()),
+            "ms": round(elapsed * 1000, 3),
+            "rows": rows,
+            "plan": plan,
+            "thread": threading.current_thread().name
+        }
+        self._slow_queries.append(entry)
+        return entry
+    
+    def snapshot(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Собранная статистика: методы и запросы по убыванию общего времени (limit - сколько первых)"""
+        with self._lock:
+            methods = [(name, list(stats)) for name, stats in self._methods.items()]
+            queries = [(sql, list(stats)) for sql, stats in self._queries.items()]
+            slow_queries = [dict(entry) for entry in reversed(self._slow_queries)]
+            connections = dict(self._connections)
+        
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 3)
+        
+        methods.sort(key=lambda item: item[1][1], reverse=True)
+        queries.sort(key=lambda item: item[1][1], reverse=True)
+        return {
+            "enabled": self.enabled,
+            "slow_query_ms": self.slow_query_ms,
+            "since": self._started_at.isoformat(timespec='seconds'),
+            "methods": [{
+                "method": name,
+                "calls": calls,
+                "total_ms": ms(total),
+                "avg_ms": ms(total / calls),
+                "max_ms": ms(longest),
+                "queries": query_count,
+                "rows": rows
+            } for name, (calls, total, longest, query_count, rows) in methods[:limit]],
+            "queries": [{
+                "sql": sql,
+                "calls": calls,
+                "total_ms": ms(total),
+                "avg_ms": ms(total / calls) if calls else 0.0,
+                "max_ms": ms(longest),
+                "rows": rows
+            } for sql, (calls, total, longest, rows) in queries[:limit]],
+            "connections_opened": connections,
+            "slow_queries": slow_queries
+        }
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Курсор, который передает в QueryProfiler соединения время выполнения и чтения строк"""
+    
+    _sql: Optional[str] = None
+    
+    def _begin(self, sql: str, params):
+        self._sql = sql
+        self._key = self.connection.profiler.query_key(sql)
+        self._params = params
+        self._elapsed = 0.0
+        self._slow: Optional[Dict[str, Any]] = None
+    
+    def _record(self, elapsed: float, rows: int, executed: bool = False):
+        if self._sql is None:
+            return
+        self._elapsed += elapsed
+        profiler = self.connection.profiler
+        profiler.record_query(self._key, elapsed, rows, executed, self._elapsed)
+        if self._slow is not None:
+            self._slow["ms"] = round(self._elapsed * 1000, 3)
+            self._slow["rows"] += rows
+        elif self._elapsed * 1000 >= profiler.slow_query_ms:
+            self._slow = profiler.log_slow_query(self.connection, self._sql, self._params, self._elapsed, rows)
+    
+    def _modified_rows(self) -> int:
+        # Для INSERT/UPDATE/DELETE без RETURNING строки - rowcount, для SELECT - прочитанные строки
+        return max(self.rowcount, 0) if self.description is None else 0
+    
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(time.perf_counter() - start, self._modified_rows(), executed=True)
+    
+    def executemany(self, sql, seq_of_parameters):
+        # Для EXPLAIN QUERY PLAN нужны параметры одного выполнения
+        first = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else ()
+        self._begin(sql, first)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(time.perf_counter() - start, self._modified_rows(), executed=True)
+    
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - start, row is not None)
+        return row
+    
+    def fetchmany(self, size: Optional[int] = None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(time.perf_counter() - start, len(rows))
+        return rows
+    
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - start, len(rows))
+        return rows
+    
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record(time.perf_counter() - start, 0)
+            raise
+        self._record(time.perf_counter() - start, 1)
+        return row
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение пула: пока профилирование включено, запросы выполняются через ProfiledCursor"""
+    
+    profiler: Optional[QueryProfiler] = None
+    
+    def _profiling(self) -> bool:
+        return self.profiler is not None and self.profiler.enabled
+    
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = ProfiledCursor if self._profiling() else sqlite3.Cursor
+        return super().cursor(factory)
+    
+    # Connection.execute создает курсор в C, минуя переопределенный cursor()
+    def execute(self, sql, parameters=()):
+        if not self._profiling():
+            return super().execute(sql, parameters)
+        return self.cursor(ProfiledCursor).execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        if not self._profiling():
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor(ProfiledCursor).executemany(sql, seq_of_parameters)
+
+# Методы хранилища, которые учитывает QueryProfiler: публичные методы интерфейса GameStorage
+PROFILED_METHODS = [name for name in vars(GameStorage) if not name.startswith('_')]
+
+def _profiled_method(name: str, method):
+    """Обертка метода хранилища: замер в self.profiler, если он включен и это внешний вызов"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        if not profiler.enabled or profiler.in_method():
+            return method(self, *args, **kwargs)
+        with profiler.method(name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def profiled_methods(cls):
+    """Декоратор класса хранилища: методы PROFILED_METHODS, определенные в cls, учитываются в профилировщике"""
+    for name in PROFILED_METHODS:
+        if name in vars(cls):
+            setattr(cls, name, _profiled_method(name, vars(cls)[name]))
+    return cls
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite.
+    
+    Соединения создаются лениво и переиспользуются между запросами, поэтому
+    sqlite3.connect() и подготовка запросов выполняются один раз на соединение.
+    Внутри одного потока пул реентерабелен: вложенные вызовы методов GameDatabase
+    получают то же соединение и не занимают дополнительный слот.
+    """
+    
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE,
+                 cached_statements: int = DB_CACHED_STATEMENTS, timeout: float = DB_POOL_TIMEOUT,
+                 read_only: bool = False, foreign_keys: bool = False,
+                 profiler: Optional[QueryProfiler] = None):
         self.db_path = db_path
-        self.init_database()
+        self.size = size
+        self.read_only = read_only
+        self.foreign_keys = foreign_keys
+        self.profiler = profiler
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._owners: Dict[int, list] = {}  # id потока -> [соединение, глубина вложенности]
+        self._all: List[sqlite3.Connection] = []
     
-    def get_connection(self):
-        """Получение соединения с базой данных"""
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие нового соединения"""
+        if self.read_only:
+            # mode=ro: соединение не может писать и не берет блокировку записи
+            database = f"file:{urllib.parse.quote(os.path.abspath(self.db_path))}?mode=ro"
+        else:
+            database = self.db_path
+        conn = sqlite3.connect(
+            database,
+            timeout=self.timeout,
+            check_same_thread=False,  # соединение переходит между потоками через пул
+            cached_statements=self.cached_statements,
+            uri=self.read_only,
+            factory=ProfiledConnection
+        )
         conn.row_factory = sqlite3.Row  # Позволяет обращаться к колонкам по имени
+        conn.profiler = self.profiler
+        if self.profiler is not None:
+            self.profiler.connection_opened(
+                f"{os.path.basename(self.db_path)} ({'read-only' if self.read_only else 'read-write'})")
+        if self.foreign_keys:
+            # Действует на соединение, вне транзакции - поэтому сразу после открытия
+            conn.execute('PRAGMA foreign_keys = ON')
+        with self._lock:
+            self._all.append(conn)
+        return conn
+    
+    def acquire(self) -> sqlite3.Connection:
+        """Получение соединения из пула"""
+        thread_id = threading.get_ident()
+        with self._lock:
+            owned = self._owners.get(thread_id)
+            if owned is not None:
+                owned[1] += 1
+                return owned[0]
+        
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free database connection in pool (size={self.size})")
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        
+        with self._lock:
+            self._owners[thread_id] = [conn, 1]
         return conn
     
+    def owns_connection(self) -> bool:
+        """Держит ли текущий поток соединение из этого пула"""
+        with self._lock:
+            return threading.get_ident() in self._owners
+    
+    def release(self, conn: sqlite3.Connection):
+        """Возврат соединения в пул"""
+        with self._lock:
+            for thread_id, owned in self._owners.items():
+                if owned[0] is conn:
+                    break
+            else:
+                return
+            owned[1] -= 1
+            if owned[1] > 0:
+                return
+            del self._owners[thread_id]
+        
+        try:
+            # Незавершенная транзакция не должна попасть к следующему владельцу
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+    
+    def _discard(self, conn: sqlite3.Connection):
+        """Закрытие испорченного соединения"""
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    
+    def close_all(self):
+        """Закрытие всех соединений пула"""
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        with self._lock:
+            connections, self._all = self._all, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул вместо закрытия"""
+    
+    def __init__(self, pool: ConnectionPool):
+        self._pool = pool
+        self._conn = pool.acquire()
+    
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+    
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+    
+    def __del__(self):
+        self.close()
+
+class GroupCommitWriter:
+    """Единственный поток записи с групповым коммитом.
+    
+    Операции записи - функции operation(conn), которые выполняют SQL без commit().
+    Поток собирает их в течение window секунд и выполняет одной транзакцией,
+    каждую операцию под своим SAVEPOINT: ошибка одной операции не откатывает остальные.
+    Результат или исключение операции возвращается вызывающему через Future.
+    """
+    
+    def __init__(self, pool: ConnectionPool, window: float = DB_GROUP_COMMIT_WINDOW,
+                 max_batch: int = DB_GROUP_COMMIT_MAX_BATCH):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+        self._thread.start()
+    
+    def submit(self, operation) -> Future:
+        """Постановка операции в очередь записи"""
+        if not self._running:
+            raise RuntimeError("Group commit writer is stopped")
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+    
+    def flush(self, timeout: Optional[float] = None):
+        """Ожидание коммита всех операций, поставленных до вызова"""
+        self.submit(lambda conn: None).result(timeout)
+    
+    def stop(self):
+        """Остановка потока после записи оставшихся операций"""
+        if not self._running:
+            return
+        self._running = False
+        self._queue.put(None)
+        self._thread.join()
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            
+            # Забираем все, что уже накопилось, затем ждем новые операции
+            # не дольше окна группового коммита
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            self._commit(batch)
+            if stop:
+                return
+    
+    def _commit(self, batch: list):
+        """Выполнение пачки операций одной транзакцией"""
+        results = []
+        conn = self.pool.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, future in batch:
+                conn.execute('SAVEPOINT group_commit_op')
+                try:
+                    result = operation(conn)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO group_commit_op')
+                    conn.execute('RELEASE group_commit_op')
+                    results.append((future, None, e))
+                else:
+                    conn.execute('RELEASE group_commit_op')
+                    results.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            # Транзакция целиком не записана - ошибка у всех операций пачки
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            results = [(future, None, e) for operation, future in batch]
+        finally:
+            self.pool.release(conn)
+        
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class UserCache:
+    """Ограниченный LRU кэш строк пользователей с временем жизни записей.
+    
+    Чтобы запись, прочитанная до изменения пользователя, не попала в кэш после него,
+    каждая инвалидация увеличивает эпоху, а put() с устаревшим токеном эпохи
+    не сохраняет значение, а удаляет ключ.
+    """
+    
+    def __init__(self, max_size: int = DB_USER_CACHE_SIZE, ttl: float = DB_USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # user_id -> (время истечения, строка)
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def token(self) -> int:
+        """Токен эпохи, который нужно взять до чтения из базы"""
+        return self._epoch
+    
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение копии строки пользователя из кэша"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+    
+    def put(self, user_id: str, user: Dict[str, Any], token: int):
+        """Сохранение строки, если с момента взятия токена не было инвалидаций"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if token != self._epoch or not user:
+                self._entries.pop(user_id, None)
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, dict(user))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def put_committed(self, users: Dict[str, Dict[str, Any]], token: int):
+        """Сохранение строк после коммита записи, которая взяла token при инвалидации.
+        
+        Эпоха увеличивается, поэтому чтения, начатые до коммита (со старой строкой),
+        не попадут в кэш. Если после token была другая инвалидация, строки удаляются.
+        """
+        with self._lock:
+            if token != self._epoch or self.max_size <= 0:
+                for user_id in users:
+                    self._entries.pop(user_id, None)
+                return
+            self._epoch += 1
+            expires_at = time.monotonic() + self.ttl
+            for user_id, user in users.items():
+                if not user:
+                    self._entries.pop(user_id, None)
+                    continue
+                self._entries[user_id] = (expires_at, dict(user))
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, user_id: str) -> int:
+        """Удаление пользователя из кэша, возвращает новый токен эпохи"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(user_id, None)
+            self.invalidations += 1
+            return self._epoch
+    
+    def invalidate_many(self, user_ids: List[str]) -> int:
+        """Удаление нескольких пользователей из кэша, возвращает новый токен эпохи"""
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+            self.invalidations += len(user_ids)
+            return self._epoch
+    
+    def clear(self):
+        """Очистка кэша"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики кэша для подбора его размера"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / requests, 4) if requests else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+class SequenceAllocator:
+    """Выдача номеров последовательности блоками.
+    
+    Блок из block_size номеров резервируется в таблице sequences одним UPDATE,
+    затем номера раздаются из памяти под блокировкой. Параллельные вызовы
+    никогда не получают одинаковый номер; номера неиспользованного остатка
+    блока при перезапуске пропускаются.
+    """
+    
+    def __init__(self, reserve, block_size: int = DB_SEQUENCE_BLOCK_SIZE):
+        self._reserve = reserve  # reserve(count) -> последний зарезервированный номер
+        self.block_size = block_size
+        self._next = 1
+        self._limit = 0
+        self._lock = threading.Lock()
+    
+    def next_value(self) -> int:
+        """Следующий номер последовательности"""
+        with self._lock:
+            if self._next > self._limit:
+                self._limit = self._reserve(self.block_size)
+                self._next = self._limit - self.block_size + 1
+            value = self._next
+            self._next += 1
+            return value
+
+class RetentionWorker:
+    """Фоновая очистка старых данных: раз в interval секунд вызывает GameDatabase.run_retention"""
+    
+    def __init__(self, database: 'GameDatabase', days: int = DB_RETENTION_DAYS,
+                 interval: float = DB_RETENTION_INTERVAL):
+        self.database = database
+        self.days = days
+        self.interval = interval
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="db-retention", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Остановка потока (текущий шаг очистки дорабатывает до конца)"""
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_report = self.database.run_retention(self.days, stop=self._stop)
+                report = self.last_report
+                print(f"Retention: removed {report['game_sessions']} sessions, {report['matches']} matches, "
+                      f"freed {report['vacuum_pages']} pages in {report['chunks']} chunks, "
+                      f"max lock {report['max_lock_ms']} ms, total lock {report['total_lock_ms']} ms")
+            except Exception as e:
+                print(f"Error in retention worker: {e}")
+
+class BackupWorker:
+    """Фоновое резервное копирование: раз в interval секунд вызывает GameDatabase.backup"""
+    
+    def __init__(self, database: 'GameDatabase', interval: float = DB_BACKUP_INTERVAL,
+                 keep: int = DB_BACKUP_KEEP, backup_dir: Optional[str] = None):
+        self.database = database
+        self.interval = interval
+        self.keep = keep
+        self.backup_dir = backup_dir
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="db-backup", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Остановка потока (начатая копия прерывается после текущего шага)"""
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                report = self.database.backup(self.backup_dir, self.keep, stop=self._stop)
+                if report is None:
+                    continue
+                self.last_report = report
+                print(f"Backup: {report['bytes'] / 1_000_000:.1f} MB in {report['duration_ms']} ms "
+                      f"({report['mb_per_s']} MB/s), {report['steps']} steps, max step {report['max_step_ms']} ms, "
+                      f"{report['restarts']} restarts, removed {len(report['removed'])} old snapshots")
+            except Exception as e:
+                print(f"Error in backup worker: {e}")
+
+class _BackupAborted(Exception):
+    """Прерывание sqlite3 backup из progress (reason - 'stopped' или 'restarts')"""
+    
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+def _backup_snapshots(backup_dir: str, root: str, ext: str) -> List[str]:
+    """Имена копий файла root+ext в backup_dir, старые первыми"""
+    pattern = re.compile(rf'{re.escape(root)}-\d{{8}}-\d{{6}}{re.escape(ext)}')
+    return sorted(name for name in os.listdir(backup_dir) if pattern.fullmatch(name))
+
+class StatsCounters:
+    """Реестр счетчиков статистики сервера.
+    
+    Значения меняются инкрементально в местах записи (после коммита), поэтому
+    чтение статистики не обращается к базе. Периодическая сверка с базой
+    (GameDatabase.reconcile_stats) исправляет возможное расхождение.
+    """
+    
+    def __init__(self):
+        self._values: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, name: str, delta: int = 1):
+        """Изменение счетчика на delta (не ниже нуля)"""
+        if delta:
+            with self._lock:
+                self._values[name] = max(0, self._values.get(name, 0) + delta)
+    
+    def set(self, name: str, value: int):
+        """Установка значения счетчика"""
+        with self._lock:
+            self._values[name] = value
+    
+    def update(self, values: Dict[str, int]):
+        """Установка значений нескольких счетчиков"""
+        with self._lock:
+            self._values.update(values)
+    
+    def get(self, name: str) -> int:
+        """Текущее значение счетчика"""
+        with self._lock:
+            return self._values.get(name, 0)
+    
+    def snapshot(self) -> Dict[str, int]:
+        """Копия всех счетчиков"""
+        with self._lock:
+            return dict(self._values)
+
+# Счетчики, которые сверяются с базой: имя -> запрос COUNT(*).
+# Счетчик queue_users ведет очередь в памяти (queue_endpoints), в базе его нет.
+STATS_COUNTER_QUERIES = {
+    'users': 'SELECT COUNT(*) FROM users',
+    'lobby_users': 'SELECT COUNT(*) FROM lobby_users',
+    'matches': 'SELECT COUNT(*) FROM matches',
+    'active_matches': "SELECT COUNT(*) FROM matches WHERE status = 'active'",
+}
+
+# Поля профиля, перенесенные из JSON users.profile_data в отдельные колонки
+USER_PROFILE_COLUMNS = {
+    'match_current': 'TEXT',
+    'queue_ticket_id': 'TEXT',
+    'money': 'REAL DEFAULT 0',
+    'last_login_time': 'TEXT',
+    'last_logout_time': 'TEXT',
+    'last_login_ip': "TEXT DEFAULT ''",
+    'last_logout_ip': "TEXT DEFAULT ''",
+    'last_login_device': "TEXT DEFAULT ''",
+    'last_logout_device': "TEXT DEFAULT ''",
+}
+
+# Колонки users с типом REAL
+USER_REAL_COLUMNS = [column for column, definition in USER_PROFILE_COLUMNS.items() if definition.startswith('REAL')]
+
+# Поля users, которые можно менять через update_user
+USER_UPDATABLE_FIELDS = ['nick_name', 'email', 'password', 'avatar_url', 'mmr', 'status', 'profile_data'] + list(USER_PROFILE_COLUMNS)
+
+def _migrate_profile_data_columns(conn: sqlite3.Connection):
+    """Перенос полей профиля из JSON profile_data в колонки users"""
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    for column, column_type in USER_PROFILE_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE users ADD COLUMN {column} {column_type}')
+    
+    updates = []
+    for user_id, profile_json in conn.execute('SELECT user_id, profile_data FROM users').fetchall():
+        try:
+            profile_data = json.loads(profile_json or '{}')
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(profile_data, dict):
+            continue
+        
+        values = {column: profile_data.pop(column) for column in USER_PROFILE_COLUMNS if column in profile_data}
+        if not values:
+            continue
+        try:
+            values['money'] = float(values.get('money') or 0)
+        except (TypeError, ValueError):
+            values['money'] = 0.0
+        # В JSON остаются только свободные данные профиля
+        values['profile_data'] = json.dumps(profile_data)
+        updates.append((values, user_id))
+    
+    for values, user_id in updates:
+        assignments = ', '.join(f"{column} = ?" for column in values)
+        conn.execute(f'UPDATE users SET {assignments} WHERE user_id = ?', (*values.values(), user_id))
+
+# Рейтинг по умолчанию для типа матча, если у игрока нет записи в user_mmr
+DEFAULT_MMR = 1000
+
+def _parse_mmr_list(mmr_json: Any) -> List[int]:
+    """Разбор легаси-массива users.mmr (JSON строка) в список рейтингов по типам матча"""
+    try:
+        mmr_list = json.loads(mmr_json) if isinstance(mmr_json, str) else mmr_json
+        return [int(value) for value in mmr_list]
+    except (TypeError, ValueError):
+        return []
+
+def _replace_user_mmr(conn: sqlite3.Connection, user_id: str, mmr_json: Any):
+    """Перезапись строк user_mmr игрока по легаси-массиву users.mmr"""
+    conn.execute('DELETE FROM user_mmr WHERE user_id = ?', (user_id,))
+    conn.executemany(
+        'INSERT INTO user_mmr (user_id, match_type, mmr) VALUES (?, ?, ?)',
+        [(user_id, match_type, mmr) for match_type, mmr in enumerate(_parse_mmr_list(mmr_json))]
+    )
+
+def _migrate_user_mmr_table(conn: sqlite3.Connection):
+    """Создание нормализованной таблицы user_mmr и перенос в нее users.mmr"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_mmr (
+            user_id TEXT NOT NULL,
+            match_type INTEGER NOT NULL,
+            mmr INTEGER NOT NULL,
+            PRIMARY KEY (user_id, match_type),
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    # Поиск игроков в диапазоне рейтинга для типа матча
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_mmr_match_type_mmr ON user_mmr (match_type, mmr)')
+    
+    for user_id, mmr_json in conn.execute('SELECT user_id, mmr FROM users').fetchall():
+        _replace_user_mmr(conn, user_id, mmr_json)
+
+# Поля matches, которые можно менять через update_game
+GAME_UPDATABLE_FIELDS = ['name', 'status', 'max_players', 'current_players', 'players', 'ended_at']
+
+def sqlite_timestamp(moment: Optional[datetime] = None) -> str:
+    """Время (по умолчанию текущее) в формате CURRENT_TIMESTAMP SQLite (UTC): так его сравнивает run_retention"""
+    return (moment or datetime.now()).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def encode_cursor(created_at: Any, row_id: int) -> str:
+    """Непрозрачный курсор keyset-пагинации по (created_at, id)"""
+    raw = json.dumps([created_at, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple:
+    """Разбор курсора пагинации (ValueError при неверном курсоре)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return created_at, int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+def encode_shard_cursor(created_at: Any, row_id: int, shard: int) -> str:
+    """Курсор пагинации по нескольким шардам: (created_at, id, номер шарда)"""
+    raw = json.dumps([created_at, row_id, shard]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_shard_cursor(cursor: str) -> tuple:
+    """Разбор курсора пагинации по шардам (ValueError при неверном курсоре)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id, shard = json.loads(raw)
+        return created_at, int(row_id), int(shard)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+# Миграции схемы: (версия, описание, шаги). Шаг - SQL строка или функция(conn).
+# Применяются по возрастанию версии, примененная версия хранится в таблице schema_version.
+# Уже выпущенные миграции не редактируются - только добавляются новые.
+def _migrate_sequences_table(conn: sqlite3.Connection):
+    """Таблица последовательностей; player_id продолжает максимальный существующий номер user_N"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    last_number = conn.execute(r'''
+        SELECT COALESCE(MAX(CAST(SUBSTR(user_id, 6) AS INTEGER)), 0) FROM users
+        WHERE user_id LIKE 'user\_%' ESCAPE '\'
+    ''').fetchone()[0]
+    conn.execute('INSERT OR IGNORE INTO sequences (name, value) VALUES (?, ?)', ('user_id', last_number))
+
+# Внешние ключи с ON DELETE CASCADE: таблица -> [(колонка, родительская таблица, колонка родителя)]
+CASCADE_FOREIGN_KEYS = {
+    'lobby_users': [('user_id', 'users', 'user_id')],
+    'queue_users': [('user_id', 'users', 'user_id')],
+    'game_sessions': [('match_id', 'matches', 'match_id'), ('user_id', 'users', 'user_id')],
+    'game_stats': [('user_id', 'users', 'user_id')],
+    'user_mmr': [('user_id', 'users', 'user_id')],
+}
+
+def _migrate_cascade_foreign_keys(conn: sqlite3.Connection):
+    """Пересоздание дочерних таблиц с ON DELETE CASCADE (SQLite не умеет менять внешние ключи через ALTER).
+    
+    Новое определение берется из sqlite_master: старые FOREIGN KEY заменяются
+    на CASCADE_FOREIGN_KEYS, индексы таблицы создаются заново. Если на
+    соединении включены внешние ключи, строки без родителя не переносятся -
+    их количество печатается по каждой таблице.
+    """
+    enforced = conn.execute('PRAGMA foreign_keys').fetchone()[0]
+    for table, references in CASCADE_FOREIGN_KEYS.items():
+        existing = {(row['from'], row['table'], row['to'], row['on_delete'])
+                    for row in conn.execute(f'PRAGMA foreign_key_list({table})')}
+        if existing == {(column, parent, parent_column, 'CASCADE') for column, parent, parent_column in references}:
+            continue
+        
+        table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (table,)).fetchone()[0]
+        index_sql = [row[0] for row in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+        columns = ', '.join(row[1] for row in conn.execute(f'PRAGMA table_info({table})'))
+        
+        definition = re.sub(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)'
+                            r'(\s+ON\s+(DELETE|UPDATE)\s+(CASCADE|SET NULL|SET DEFAULT|RESTRICT|NO ACTION))*',
+                            '', table_sql, flags=re.IGNORECASE)
+        foreign_keys = ''.join(f',\n    FOREIGN KEY ({column}) REFERENCES {parent} ({parent_column}) ON DELETE CASCADE'
+                               for column, parent, parent_column in references)
+        definition = re.sub(r'\)(\s*WITHOUT ROWID)?\s*$', lambda match: f"{foreign_keys}\n){match.group(1) or ''}",
+                            definition, count=1)
+        definition = re.sub(rf'^CREATE TABLE\s+"?{table}"?', f'CREATE TABLE {table}_cascade', definition, count=1)
+        
+        where = ' AND '.join(f'{column} IN (SELECT {parent_column} FROM {parent})'
+                             for column, parent, parent_column in references) if enforced else '1'
+        conn.execute(definition)
+        total = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        copied = conn.execute(f'INSERT INTO {table}_cascade ({columns}) SELECT {columns} FROM {table} '
+                              f'WHERE {where}').rowcount
+        if copied < total:
+            print(f"Database migration dropped {total - copied} orphaned row(s) from {table}")
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_cascade RENAME TO {table}')
+        for sql in index_sql:
+            conn.execute(sql)
+
+# Таблицы, очищаемые run_retention: таблица -> колонка времени завершения
+RETENTION_TABLES = {
+    'game_sessions': 'left_at',
+    'matches': 'ended_at',
+}
+
+# Таблицы, которые ShardedGameDatabase хранит в шардах по хэшу user_id
+SHARDED_TABLES = ['users', 'lobby_users', 'game_stats', 'user_mmr']
+
+MIGRATIONS = [
+    (1, "Indexes for hot queries", [
+        # Вход по email (get_user_by_email, find_by_email)
+        'CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)',
+        # Активные матчи в get_server_stats
+        'CREATE INDEX IF NOT EXISTS idx_matches_status ON matches (status)',
+        # ORDER BY created_at в get_matches / get_lobby_users
+        'CREATE INDEX IF NOT EXISTS idx_matches_created_at ON matches (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_lobby_users_created_at ON lobby_users (created_at)',
+        # Удаления в delete_user / delete_game
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_user_id ON game_sessions (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_match_id ON game_sessions (match_id)',
+        'CREATE INDEX IF NOT EXISTS idx_game_stats_user_id ON game_stats (user_id)',
+    ]),
+    (2, "Profile fields as users columns", [
+        _migrate_profile_data_columns,
+    ]),
+    (3, "Per-match-type MMR table", [
+        _migrate_user_mmr_table,
+    ]),
+    (4, "Sequences for player IDs", [
+        _migrate_sequences_table,
+    ]),
+    (5, "Indexes for retention", [
+        # Поиск устаревших строк порциями в run_retention
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_left_at ON game_sessions (left_at)',
+        'CREATE INDEX IF NOT EXISTS idx_matches_ended_at ON matches (ended_at)',
+    ]),
+    (6, "Foreign keys with ON DELETE CASCADE", [
+        _migrate_cascade_foreign_keys,
+    ]),
+]
+
+# Запросы горячего пути, которые не должны выполняться полным сканированием таблицы.
+# Проверяются через EXPLAIN QUERY PLAN (см. GameDatabase.check_query_plans).
+HOT_QUERIES = {
+    'get_user': ('SELECT * FROM users WHERE user_id = ?', ('user_1',)),
+    'get_user_by_email': ('SELECT * FROM users WHERE email = ?', ('user@example.com',)),
+    'active_matches_count': ("SELECT COUNT(*) FROM matches WHERE status = 'active'", ()),
+    'get_matches': ('SELECT * FROM matches ORDER BY created_at DESC, id DESC LIMIT ?', (100,)),
+    'get_lobby_users': ('SELECT * FROM lobby_users ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?', (1000, 0)),
+    'delete_user_game_sessions': ('DELETE FROM game_sessions WHERE user_id = ?', ('user_1',)),
+    'delete_user_game_stats': ('DELETE FROM game_stats WHERE user_id = ?', ('user_1',)),
+    'delete_game_sessions': ('DELETE FROM game_sessions WHERE match_id = ?', ('match_1',)),
+    'get_user_mmr': ('SELECT mmr FROM user_mmr WHERE user_id = ? AND match_type = ?', ('user_1', 0)),
+    'get_lobby_users_after_cursor': (
+        'SELECT * FROM lobby_users WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?',
+        ('2025-01-01 00:00:00', 100, 1000)
+    ),
+    'get_matches_after_cursor': (
+        'SELECT * FROM matches WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?',
+        ('2025-01-01 00:00:00', 100, 100)
+    ),
+    'retention_game_sessions': (
+        "SELECT id FROM game_sessions WHERE left_at IS NOT NULL AND left_at < datetime('now', ?) LIMIT ?",
+        ('-30 days', 500)
+    ),
+    'retention_matches': (
+        "SELECT id FROM matches WHERE ended_at IS NOT NULL AND ended_at < datetime('now', ?) LIMIT ?",
+        ('-30 days', 500)
+    ),
+    'find_users_by_mmr': (
+        'SELECT user_id, mmr FROM user_mmr WHERE match_type = ? AND mmr BETWEEN ? AND ? ORDER BY mmr DESC LIMIT ?',
+        (1, 950, 1000, 100)
+    ),
+}
+
+@profiled_methods
+class GameDatabase(GameStorage):
+    def __init__(self, db_path: str = "game_server.db", pool_size: int = DB_POOL_SIZE,
+                 cached_statements: int = DB_CACHED_STATEMENTS, group_commit: bool = DB_GROUP_COMMIT,
+                 group_commit_window: float = DB_GROUP_COMMIT_WINDOW, user_cache_size: int = DB_USER_CACHE_SIZE,
+                 user_cache_ttl: float = DB_USER_CACHE_TTL,
+                 stats_reconcile_interval: float = DB_STATS_RECONCILE_INTERVAL,
+                 wal: bool = DB_WAL, reader_pool_size: int = DB_READER_POOL_SIZE,
+                 foreign_keys: bool = DB_FOREIGN_KEYS, profiler: Optional[QueryProfiler] = None):
+        """Инициализация базы данных (profiler - общий профилировщик, по умолчанию свой)"""
+        self.profiler = profiler if profiler is not None else QueryProfiler()
+        self.db_path = db_path
+        self.foreign_keys = foreign_keys
+        self.pool = ConnectionPool(db_path, size=pool_size, cached_statements=cached_statements,
+                                   foreign_keys=foreign_keys, profiler=self.profiler)
+        self.user_cache = UserCache(user_cache_size, user_cache_ttl)
+        self.counters = StatsCounters()
+        self.use_returning = SQLITE_SUPPORTS_RETURNING
+        # True - списки возвращают записи records.py вместо dict(row): меньше памяти, но ответ не быстрее
+        self.use_records = False
+        self._sequences: Dict[str, SequenceAllocator] = {}
+        self._sequences_lock = threading.Lock()
+        self.stats_reconcile_interval = stats_reconcile_interval
+        self._stats_reconciled_at = 0.0
+        self._stats_reconcile_lock = threading.Lock()
+        self.wal = wal
+        self.readers: Optional[ConnectionPool] = None
+        self.init_database()
+        
+        # Отдельный пул читателей имеет смысл только в WAL: там чтение идет по снимку и не ждет записи
+        if wal and reader_pool_size > 0:
+            self.readers = ConnectionPool(db_path, size=reader_pool_size, cached_statements=cached_statements,
+                                          read_only=True, profiler=self.profiler)
+        
+        # В режиме группового коммита все записи идут через один поток-писатель
+        self.writer = GroupCommitWriter(self.pool, window=group_commit_window) if group_commit else None
+        self.retention: Optional[RetentionWorker] = None
+        self.backups: Optional[BackupWorker] = None
+    
+    def get_connection(self) -> PooledConnection:
+        """Получение соединения с базой данных из пула (close() возвращает его в пул)"""
+        return PooledConnection(self.pool)
+    
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер для работы с соединением из пула"""
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+    
+    @contextmanager
+    def read_connection(self):
+        """Соединение для чтения: из пула читателей, если он есть.
+        
+        Если поток уже держит соединение записи (внутри операции записи),
+        используется оно, чтобы чтение видело незакоммиченные изменения.
+        """
+        if self.readers is None or self.pool.owns_connection():
+            with self.connection() as conn:
+                yield conn
+            return
+        conn = self.readers.acquire()
+        try:
+            yield conn
+        finally:
+            self.readers.release(conn)
+    
+    def close(self):
+        """Закрытие всех соединений"""
+        if self.retention is not None:
+            self.retention.stop()
+            self.retention = None
+        if self.backups is not None:
+            self.backups.stop()
+            self.backups = None
+        if self.writer is not None:
+            self.writer.stop()
+        if self.readers is not None:
+            self.readers.close_all()
+        self.pool.close_all()
+    
+    def _write(self, operation, wait: bool = True, on_commit=None):
+        """Выполнение операции записи operation(conn).
+        
+        Без группового коммита операция выполняется сразу в своей транзакции.
+        С групповым коммитом она ставится в очередь писателя: при wait=True вызов
+        ждет коммита и возвращает результат, при wait=False сразу возвращает Future.
+        on_commit(result) вызывается после успешного коммита.
+        """
+        if self.writer is not None:
+            future = self.writer.submit(operation)
+            if on_commit is not None:
+                future.add_done_callback(lambda f: f.exception() is None and on_commit(f.result()))
+            return future.result() if wait else future
+        
+        with self.connection() as conn:
+            try:
+                result = operation(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        if on_commit is not None:
+            on_commit(result)
+        if wait:
+            return result
+        future = Future()
+        future.set_result(result)
+        return future
+    
+    def flush(self, timeout: Optional[float] = None):
+        """Ожидание записи всех операций в очереди (read-your-writes в режиме группового коммита)"""
+        if self.writer is not None:
+            self.writer.flush(timeout)
+    
+    def _write_user(self, user_id: str, operation, wait: bool = True, keep_cached: bool = True, on_commit=None):
+        """Запись строки пользователя с обновлением кэша.
+        
+        Инвалидация выполняется внутри транзакции записи, поэтому токены эпохи
+        упорядочены так же, как коммиты. После коммита новая строка кладется
+        в кэш через put_committed (keep_cached=False - только удаляется из него).
+        """
+        tokens = []
+        
+        def cached_operation(conn):
+            tokens.append(self.user_cache.invalidate(user_id))
+            return operation(conn)
+        
+        def cached_on_commit(user):
+            if keep_cached:
+                self.user_cache.put_committed({user_id: user}, tokens[-1])
+            else:
+                self.user_cache.invalidate(user_id)
+            if on_commit is not None:
+                on_commit(user)
+        
+        return self._write(cached_operation, wait, cached_on_commit)
+    
+    def _fetch_one(self, conn: sqlite3.Connection, query: str, params: tuple) -> Dict[str, Any]:
+        """Чтение одной строки в рамках текущего соединения"""
+        return self.dict_from_row(conn.execute(query, params).fetchone())
+    
+    def _returned_row(self, row) -> Dict[str, Any]:
+        """Строка из RETURNING в словарь"""
+        row = self.dict_from_row(row)
+        # RETURNING отдает значения до применения affinity колонки: 5 вместо 5.0 для REAL
+        for column in USER_REAL_COLUMNS:
+            if row.get(column) is not None:
+                row[column] = float(row[column])
+        return row
+    
+    def _execute_returning(self, conn: sqlite3.Connection, statement: str, params,
+                           select: str, select_params: tuple) -> Dict[str, Any]:
+        """Выполнение INSERT/UPDATE/DELETE с возвратом затронутой строки ({} если строки нет).
+        
+        При поддержке RETURNING это один запрос. Иначе строка читается запросом
+        select: для DELETE - до удаления, для остальных - после записи.
+        """
+        if self.use_returning:
+            rows = conn.execute(f'{statement} RETURNING *', params).fetchall()
+            return self._returned_row(rows[0] if rows else None)
+        
+        if statement.lstrip().upper().startswith('DELETE'):
+            row = self._fetch_one(conn, select, select_params)
+            conn.execute(statement, params)
+            return row
+        conn.execute(statement, params)
+        return self._fetch_one(conn, select, select_params)
+    
     def init_database(self):
         """Инициализация таблиц базы данных"""
-        conn = self.get_connection()
+        with self.connection() as conn:
+            # Действует только для новой (пустой) базы; существующую переводит enable_incremental_vacuum()
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            # Режим журнала сохраняется в файле базы
+            conn.execute(f"PRAGMA journal_mode = {'WAL' if self.wal else 'DELETE'}")
+            self._create_tables(conn)
+            self.migrate(conn)
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # VACUUM всей базы при старте заблокировал бы запись надолго - переводится вручную
+                print(f"Database {self.db_path} is not in auto_vacuum=INCREMENTAL mode: run_retention will not "
+                      f"return freed pages to the OS until db.enable_incremental_vacuum() is run once")
+        self.reconcile_stats()
+    
+    def reconcile_stats(self):
+        """Сверка счетчиков статистики с базой (COUNT(*) по STATS_COUNTER_QUERIES)"""
+        with self.read_connection() as conn:
+            counts = {name: conn.execute(query).fetchone()[0] for name, query in STATS_COUNTER_QUERIES.items()}
+        self.counters.update(counts)
+        self._stats_reconciled_at = time.monotonic()
+    
+    def _maybe_reconcile_stats(self):
+        """Периодическая сверка счетчиков: выполняет один поток, остальные не ждут"""
+        if time.monotonic() - self._stats_reconciled_at < self.stats_reconcile_interval:
+            return
+        if self._stats_reconcile_lock.acquire(blocking=False):
+            try:
+                if time.monotonic() - self._stats_reconciled_at >= self.stats_reconcile_interval:
+                    self.reconcile_stats()
+            finally:
+                self._stats_reconcile_lock.release()
+    
+    def get_row_count(self, table: str) -> int:
+        """Количество строк таблицы (users, lobby_users, matches) из счетчиков, без запроса к базе"""
+        return self.counters.get(table)
+    
+    def _create_tables(self, conn: sqlite3.Connection):
+        """Создание таблиц"""
         cursor = conn.cursor()
         
         # Таблица пользователей
@@ -46,7 +1385,7 @@ class GameDatabase:
                 status TEXT DEFAULT 'active',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_seen TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
             )
         ''')
         
@@ -59,7 +1398,7 @@ class GameDatabase:
                 joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 priority INTEGER DEFAULT 0,
                 status TEXT DEFAULT 'waiting',
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
             )
         ''')
         
@@ -88,8 +1427,8 @@ class GameDatabase:
                 joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 left_at TIMESTAMP,
                 status TEXT DEFAULT 'active',
-                FOREIGN KEY (match_id) REFERENCES matches (match_id),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                FOREIGN KEY (match_id) REFERENCES matches (match_id) ON DELETE CASCADE,
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
             )
         ''')
         
@@ -102,12 +1441,69 @@ class GameDatabase:
                 matches_won INTEGER DEFAULT 0,
                 total_score INTEGER DEFAULT 0,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Таблица версий схемы
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
         conn.commit()
-        conn.close()
+    
+    def get_schema_version(self, conn: sqlite3.Connection) -> int:
+        """Текущая версия схемы"""
+        return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    
+    def migrate(self, conn: sqlite3.Connection) -> List[int]:
+        """Применение недостающих миграций, каждая в своей транзакции"""
+        applied = []
+        for version, description, steps in MIGRATIONS:
+            if version <= self.get_schema_version(conn):
+                continue
+            
+            # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому два процесса
+            # не применят одну миграцию дважды - второй перепроверит версию
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if version <= self.get_schema_version(conn):
+                    conn.rollback()
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                             (version, description))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            
+            applied.append(version)
+            print(f"Database migrated to version {version}: {description}")
+        
+        return applied
+    
+    def check_query_plans(self) -> Dict[str, List[str]]:
+        """Проверка планов HOT_QUERIES, возвращает запросы с полным сканированием таблицы"""
+        problems = {}
+        with self.connection() as conn:
+            for name, (query, params) in HOT_QUERIES.items():
+                plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+                bad = [
+                    detail for detail in plan
+                    if (detail.startswith('SCAN ') and 'INDEX' not in detail) or 'TEMP B-TREE' in detail
+                ]
+                if bad:
+                    problems[name] = plan
+        return problems
     
     def dict_from_row(self, row) -> Dict[str, Any]:
         """Преобразование строки БД в словарь"""
@@ -115,171 +1511,330 @@ class GameDatabase:
             return {}
         return dict(row)
     
+    def records_from_rows(self, record_class: type, rows: list) -> List[Record]:
+        """Строки БД в записи record_class (при use_records=False - в словари)"""
+        if not self.use_records:
+            return [self.dict_from_row(row) for row in rows]
+        return record_class.from_rows(rows)
+    
+    # Последовательности
+    def _reserve_sequence(self, name: str, count: int) -> int:
+        """Резервирование count номеров последовательности, возвращает последний из них"""
+        def operation(conn):
+            conn.execute('INSERT OR IGNORE INTO sequences (name, value) VALUES (?, 0)', (name,))
+            conn.execute('UPDATE sequences SET value = value + ? WHERE name = ?', (count, name))
+            return conn.execute('SELECT value FROM sequences WHERE name = ?', (name,)).fetchone()[0]
+        
+        return self._write(operation)
+    
+    def next_sequence_value(self, name: str) -> int:
+        """Следующий номер последовательности name (без гонок между потоками и процессами)"""
+        allocator = self._sequences.get(name)
+        if allocator is None:
+            with self._sequences_lock:
+                allocator = self._sequences.setdefault(
+                    name, SequenceAllocator(lambda count: self._reserve_sequence(name, count)))
+        return allocator.next_value()
+    
     # Методы для работы с пользователями
     def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Создание нового пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO users (user_id, nick_name, email, password, avatar_url, mmr, status, profile_data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_data['user_id'],
-                user_data['nick_name'],
-                user_data['email'],
-                user_data['password'],
-                user_data.get('avatar_url', ''),
-                user_data.get('mmr', '[]'),
-                user_data.get('status', 'active'),
-                user_data.get('profile_data', '{}')
-            ))
-            
-            conn.commit()
-            return self.get_user(user_data['user_id'])
-        except sqlite3.IntegrityError:
-            raise ValueError("User already exists")
-        finally:
-            conn.close()
+        def operation(conn):
+            try:
+                user = self._execute_returning(conn, '''
+                    INSERT INTO users (user_id, nick_name, email, password, avatar_url, mmr, status, profile_data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    user_data['user_id'],
+                    user_data['nick_name'],
+                    user_data['email'],
+                    user_data['password'],
+                    user_data.get('avatar_url', ''),
+                    user_data.get('mmr', '[]'),
+                    user_data.get('status', 'active'),
+                    user_data.get('profile_data', '{}')
+                ), 'SELECT * FROM users WHERE user_id = ?', (user_data['user_id'],))
+            except sqlite3.IntegrityError:
+                raise ValueError("User already exists")
+            _replace_user_mmr(conn, user_data['user_id'], user_data.get('mmr', '[]'))
+            return user
+        
+        return self._write_user(user_data['user_id'], operation, on_commit=lambda user: self.counters.add('users'))
     
     def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """Получение пользователя по ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        """Получение пользователя по ID (через кэш пользователей)"""
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        token = self.user_cache.token()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
         
-        return self.dict_from_row(row)
+        user = self.dict_from_row(row)
+        self.user_cache.put(user_id, user, token)
+        return user
+    
+    def _select_users(self, conn: sqlite3.Connection, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Чтение строк пользователей запросами IN (...) по DB_MAX_IN_PARAMS идентификаторов"""
+        users = {}
+        for start in range(0, len(user_ids), DB_MAX_IN_PARAMS):
+            chunk = user_ids[start:start + DB_MAX_IN_PARAMS]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT * FROM users WHERE user_id IN ({placeholders})', chunk).fetchall()
+            for row in rows:
+                users[row['user_id']] = self.dict_from_row(row)
+        return users
+    
+    def get_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получение нескольких пользователей одним запросом: user_id -> строка (отсутствующих нет в результате)"""
+        users = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                users[user_id] = user
+            else:
+                missing.append(user_id)
+        
+        if missing:
+            token = self.user_cache.token()
+            with self.read_connection() as conn:
+                loaded = self._select_users(conn, missing)
+            for user_id in missing:
+                self.user_cache.put(user_id, loaded.get(user_id, {}), token)
+            users.update(loaded)
+        return users
     
     def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Получение пользователя по email"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
+            row = cursor.fetchone()
         
         return self.dict_from_row(row)
     
-    def update_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Обновление данных пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+    def update_user(self, user_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление данных пользователя (wait=False - вернуть Future, не дожидаясь коммита)"""
         # Строим динамический UPDATE запрос
         fields = []
         values = []
         
         for key, value in user_data.items():
-            if key != 'user_id' and key in ['nick_name', 'email', 'password', 'avatar_url', 'mmr', 'status', 'profile_data']:
+            if key != 'user_id' and key in USER_UPDATABLE_FIELDS:
                 fields.append(f"{key} = ?")
                 values.append(value)
         
         if not fields:
-            conn.close()
-            return None
+            return None if wait else self._write(lambda conn: None, wait)
         
-        values.append(user_data['user_id'])
+        user_id = user_data['user_id']
+        values.append(user_id)
         query = f"UPDATE users SET {', '.join(fields)} WHERE user_id = ?"
         
-        cursor.execute(query, values)
-        conn.commit()
-        conn.close()
+        def operation(conn):
+            user = self._execute_returning(conn, query, values, 'SELECT * FROM users WHERE user_id = ?', (user_id,))
+            # users.mmr - легаси-массив для API, рейтинги по типам матча - в user_mmr
+            if 'mmr' in user_data and user:
+                _replace_user_mmr(conn, user_id, user_data['mmr'])
+            return user
         
-        return self.get_user(user_data['user_id'])
+        return self._write_user(user_id, operation, wait)
+    
+    def update_users(self, patches: List[Dict[str, Any]], wait: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Обновление нескольких пользователей в одной транзакции.
+        
+        patches - словари как для update_user. Патчи с одинаковым набором полей
+        выполняются одним executemany. Возвращает user_id -> обновленная строка
+        (wait=False - Future с этим словарем).
+        """
+        groups: Dict[tuple, List[tuple]] = {}
+        mmr_patches = []
+        for patch in patches:
+            fields = tuple(key for key in patch if key != 'user_id' and key in USER_UPDATABLE_FIELDS)
+            if not fields:
+                continue
+            groups.setdefault(fields, []).append(tuple(patch[key] for key in fields) + (patch['user_id'],))
+            if 'mmr' in fields:
+                mmr_patches.append(patch)
+        
+        user_ids = list(dict.fromkeys(params[-1] for rows in groups.values() for params in rows))
+        if not user_ids:
+            return {} if wait else self._write(lambda conn: {}, wait)
+        
+        tokens = []
+        
+        def operation(conn):
+            tokens.append(self.user_cache.invalidate_many(user_ids))
+            for fields, rows in groups.items():
+                assignments = ', '.join(f"{key} = ?" for key in fields)
+                conn.executemany(f"UPDATE users SET {assignments} WHERE user_id = ?", rows)
+            users = self._select_users(conn, user_ids)
+            # users.mmr - легаси-массив для API, рейтинги по типам матча - в user_mmr
+            for patch in mmr_patches:
+                if patch['user_id'] in users:
+                    _replace_user_mmr(conn, patch['user_id'], patch['mmr'])
+            return users
+        
+        def on_commit(users):
+            self.user_cache.put_committed({user_id: users.get(user_id, {}) for user_id in user_ids}, tokens[-1])
+        
+        return self._write(operation, wait, on_commit)
     
     def delete_user(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """Удаление пользователя"""
-        user = self.get_user(user_id)
-        if not user:
-            return None
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Удаляем из всех связанных таблиц
-        cursor.execute('DELETE FROM lobby_users WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM queue_users WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM game_sessions WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM game_stats WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
-        
-        return user
+        """Удаление пользователя (None, если его нет)"""
+        return self.delete_users([user_id]).get(user_id)
+    
+    def delete_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Удаление нескольких пользователей в одной транзакции: user_id -> удаленная строка.
+        
+        Строки в lobby_users, queue_users, game_sessions, game_stats и user_mmr
+        удаляет ON DELETE CASCADE, поэтому на порцию из DB_MAX_IN_PARAMS
+        пользователей выполняется один DELETE. С foreign_keys=False связанные
+        строки удаляются явными запросами.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        removed_from_lobby = []
+        
+        def operation(conn):
+            self.user_cache.invalidate_many(user_ids)
+            deleted = {}
+            in_lobby = 0
+            for start in range(0, len(user_ids), DB_MAX_IN_PARAMS):
+                chunk = user_ids[start:start + DB_MAX_IN_PARAMS]
+                placeholders = ', '.join('?' * len(chunk))
+                # Счетчик лобби: каскадные удаления не попадают в rowcount
+                in_lobby += conn.execute(f'SELECT COUNT(*) FROM lobby_users WHERE user_id IN ({placeholders})',
+                                         chunk).fetchone()[0]
+                if self.use_returning:
+                    rows = conn.execute(f'DELETE FROM users WHERE user_id IN ({placeholders}) RETURNING *',
+                                        chunk).fetchall()
+                    deleted.update((row['user_id'], self._returned_row(row)) for row in rows)
+                else:
+                    deleted.update(self._select_users(conn, chunk))
+                    conn.execute(f'DELETE FROM users WHERE user_id IN ({placeholders})', chunk)
+                if not self.foreign_keys:
+                    for table in ('lobby_users', 'queue_users', 'game_sessions', 'game_stats', 'user_mmr'):
+                        conn.execute(f'DELETE FROM {table} WHERE user_id IN ({placeholders})', chunk)
+            removed_from_lobby.append(in_lobby)
+            return deleted
+        
+        def on_commit(deleted):
+            self.user_cache.invalidate_many(user_ids)
+            self.counters.add('users', -len(deleted))
+            self.counters.add('lobby_users', -removed_from_lobby[-1])
+        
+        return self._write(operation, on_commit=on_commit)
+    
+    # Методы для работы с рейтингом
+    def get_user_mmr(self, user_id: str, match_type: int) -> Optional[int]:
+        """Рейтинг игрока для типа матча (None, если записи нет)"""
+        with self.read_connection() as conn:
+            row = conn.execute('SELECT mmr FROM user_mmr WHERE user_id = ? AND match_type = ?',
+                               (user_id, match_type)).fetchone()
+        
+        return row[0] if row else None
+    
+    def find_users_by_mmr(self, match_type: int, mmr: int, delta: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Игроки с рейтингом в диапазоне mmr ± delta для типа матча, ближайшие к mmr первыми"""
+        # Два прохода по индексу (match_type, mmr) от mmr вниз и вверх: ближайшие
+        # игроки находятся без чтения всего диапазона
+        with self.read_connection() as conn:
+            below = conn.execute('''
+                SELECT user_id, mmr FROM user_mmr
+                WHERE match_type = ? AND mmr BETWEEN ? AND ?
+                ORDER BY mmr DESC
+                LIMIT ?
+            ''', (match_type, mmr - delta, mmr, limit)).fetchall()
+            above = conn.execute('''
+                SELECT user_id, mmr FROM user_mmr
+                WHERE match_type = ? AND mmr > ? AND mmr <= ?
+                ORDER BY mmr
+                LIMIT ?
+            ''', (match_type, mmr, mmr + delta, limit)).fetchall()
+        
+        users = [{"user_id": row[0], "mmr": row[1]} for row in below + above]
+        users.sort(key=lambda user: abs(user["mmr"] - mmr))
+        return users[:limit]
     
     # Методы для работы с лобби
     def create_lobby_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Создание пользователя в лобби"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO lobby_users (user_id, username, status)
-                VALUES (?, ?, ?)
-            ''', (
-                user_data['user_id'],
-                user_data['username'],
-                user_data.get('status', 'active')
-            ))
-            
-            conn.commit()
-            return self.get_lobby_user(user_data['user_id'])
-        except sqlite3.IntegrityError:
-            raise ValueError("User already in lobby")
-        finally:
-            conn.close()
+        def operation(conn):
+            try:
+                return self._execute_returning(conn, '''
+                    INSERT INTO lobby_users (user_id, username, status)
+                    VALUES (?, ?, ?)
+                ''', (
+                    user_data['user_id'],
+                    user_data['username'],
+                    user_data.get('status', 'active')
+                ), 'SELECT * FROM lobby_users WHERE user_id = ?', (user_data['user_id'],))
+            except sqlite3.IntegrityError:
+                raise ValueError("User already in lobby")
+        
+        return self._write(operation, on_commit=lambda user: self.counters.add('lobby_users'))
     
     def get_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Получение пользователя из лобби"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM lobby_users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM lobby_users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
         
         return self.dict_from_row(row)
     
-    def get_lobby_users(self, page: int = 1, per_page: int = 1000) -> Dict[str, Any]:
-        """Получение списка пользователей в лобби с пагинацией"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Общее количество пользователей
-        cursor.execute('SELECT COUNT(*) FROM lobby_users')
-        total_users = cursor.fetchone()[0]
-        
-        # Пользователи для текущей страницы
-        offset = (page - 1) * per_page
-        cursor.execute('''
-            SELECT * FROM lobby_users 
-            ORDER BY created_at DESC 
-            LIMIT ? OFFSET ?
-        ''', (per_page, offset))
-        
-        users = [self.dict_from_row(row) for row in cursor.fetchall()]
-        conn.close()
+    def get_lobby_users(self, page: int = 1, per_page: int = 1000, cursor: Optional[str] = None,
+                        include_total: bool = True) -> Dict[str, Any]:
+        """Получение списка пользователей в лобби с пагинацией.
+        
+        С курсором (next_cursor предыдущей страницы) используется keyset-пагинация
+        по (created_at, id), стоимость которой не зависит от глубины страницы.
+        Без курсора page > 1 обрабатывается через OFFSET для совместимости.
+        """
+        with self.read_connection() as conn:
+            if cursor:
+                created_at, row_id = decode_cursor(cursor)
+                rows = conn.execute('''
+                    SELECT * FROM lobby_users
+                    WHERE (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (created_at, row_id, per_page)).fetchall()
+            else:
+                # Пользователи для текущей страницы
+                offset = (page - 1) * per_page
+                rows = conn.execute('''
+                    SELECT * FROM lobby_users 
+                    ORDER BY created_at DESC, id DESC 
+                    LIMIT ? OFFSET ?
+                ''', (per_page, offset)).fetchall()
+            
+            users = self.records_from_rows(LobbyUserRecord, rows)
         
-        return {
+        result = {
             "users": users,
-            "total_users": total_users,
             "page": page,
             "per_page": per_page,
-            "total_pages": (total_users + per_page - 1) // per_page
+            "next_cursor": encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if rows and len(rows) == per_page else None
         }
+        if include_total:
+            # Общее количество пользователей - из счетчика, без COUNT(*)
+            total_users = self.get_row_count('lobby_users')
+            result["total_users"] = total_users
+            result["total_pages"] = (total_users + per_page - 1) // per_page
+        return result
     
     def update_lobby_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Обновление пользователя в лобби"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         fields = []
         values = []
         
@@ -289,77 +1844,62 @@ class GameDatabase:
                 values.append(value)
         
         if not fields:
-            conn.close()
             return None
         
-        values.append(user_data['user_id'])
+        user_id = user_data['user_id']
+        values.append(user_id)
         query = f"UPDATE lobby_users SET {', '.join(fields)} WHERE user_id = ?"
         
-        cursor.execute(query, values)
-        conn.commit()
-        conn.close()
+        def operation(conn):
+            return self._execute_returning(conn, query, values, 'SELECT * FROM lobby_users WHERE user_id = ?', (user_id,))
         
-        return self.get_lobby_user(user_data['user_id'])
+        return self._write(operation)
     
     def delete_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Удаление пользователя из лобби"""
-        user = self.get_lobby_user(user_id)
-        if not user:
-            return None
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        def operation(conn):
+            user = self._execute_returning(conn, 'DELETE FROM lobby_users WHERE user_id = ?', (user_id,),
+                                           'SELECT * FROM lobby_users WHERE user_id = ?', (user_id,))
+            return user or None
         
-        cursor.execute('DELETE FROM lobby_users WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
-        
-        return user
+        return self._write(operation, on_commit=lambda user: user and self.counters.add('lobby_users', -1))
     
     # Методы для работы с очередью
     def add_user_to_queue(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Добавление пользователя в очередь"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO queue_users (user_id, username, priority, status)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                user_data['user_id'],
-                user_data['username'],
-                user_data.get('priority', 0),
-                user_data.get('status', 'waiting')
-            ))
-            
-            conn.commit()
-            return self.get_queue_user(user_data['user_id'])
-        except sqlite3.IntegrityError:
-            raise ValueError("User already in queue")
-        finally:
-            conn.close()
+        def operation(conn):
+            try:
+                return self._execute_returning(conn, '''
+                    INSERT INTO queue_users (user_id, username, priority, status)
+                    VALUES (?, ?, ?, ?)
+                ''', (
+                    user_data['user_id'],
+                    user_data['username'],
+                    user_data.get('priority', 0),
+                    user_data.get('status', 'waiting')
+                ), 'SELECT * FROM queue_users WHERE user_id = ?', (user_data['user_id'],))
+            except sqlite3.IntegrityError:
+                raise ValueError("User already in queue")
+        
+        return self._write(operation)
     
     def get_queue_user(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Получение пользователя из очереди"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM queue_users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM queue_users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
         
         return self.dict_from_row(row)
     
     def get_queue_users(self) -> Dict[str, Any]:
         """Получение списка пользователей в очереди"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM queue_users ORDER BY priority DESC, joined_at ASC')
-        users = [self.dict_from_row(row) for row in cursor.fetchall()]
-        
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM queue_users ORDER BY priority DESC, joined_at ASC')
+            users = [self.dict_from_row(row) for row in cursor.fetchall()]
         
         return {
             "users": users,
@@ -368,167 +1908,696 @@ class GameDatabase:
     
     def remove_user_from_queue(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Удаление пользователя из очереди"""
-        user = self.get_queue_user(user_id)
-        if not user:
-            return None
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM queue_users WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        def operation(conn):
+            user = self._execute_returning(conn, 'DELETE FROM queue_users WHERE user_id = ?', (user_id,),
+                                           'SELECT * FROM queue_users WHERE user_id = ?', (user_id,))
+            return user or None
         
-        return user
+        return self._write(operation)
+    
+    def clear_queue(self) -> int:
+        """Удаление всех пользователей из очереди"""
+        return self._write(lambda conn: conn.execute('DELETE FROM queue_users').rowcount)
     
     # Методы для работы с играми
-    def create_game(self, game_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Создание новой игры"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO matches (match_id, name, status, max_players, current_players, players)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                game_data['match_id'],
-                game_data['name'],
-                game_data.get('status', 'waiting'),
-                game_data.get('max_players', 4),
-                game_data.get('current_players', 0),
-                game_data.get('players', '[]')
-            ))
-            
-            conn.commit()
-            return self.get_game(game_data['match_id'])
-        except sqlite3.IntegrityError:
-            raise ValueError("Match already exists")
-        finally:
-            conn.close()
+    def create_game(self, game_data: Dict[str, Any], wait: bool = True) -> Dict[str, Any]:
+        """Создание новой игры (wait=False - вернуть Future, не дожидаясь коммита)"""
+        def operation(conn):
+            try:
+                return self._execute_returning(conn, '''
+                    INSERT INTO matches (match_id, name, status, max_players, current_players, players)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (
+                    game_data['match_id'],
+                    game_data['name'],
+                    game_data.get('status', 'waiting'),
+                    game_data.get('max_players', 4),
+                    game_data.get('current_players', 0),
+                    game_data.get('players', '[]')
+                ), 'SELECT * FROM matches WHERE match_id = ?', (game_data['match_id'],))
+            except sqlite3.IntegrityError:
+                raise ValueError("Match already exists")
+        
+        def on_commit(game):
+            self.counters.add('matches')
+            self.counters.add('active_matches', game.get('status') == 'active')
+        
+        return self._write(operation, wait, on_commit)
     
     def get_game(self, match_id: str) -> Optional[Dict[str, Any]]:
         """Получение матча по ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM matches WHERE match_id = ?', (match_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT * FROM matches WHERE match_id = ?', (match_id,))
+            row = cursor.fetchone()
         
         return self.dict_from_row(row)
     
-    def get_matches(self) -> Dict[str, Any]:
-        """Получение списка всех игр"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM matches ORDER BY created_at DESC')
-        matches = [self.dict_from_row(row) for row in cursor.fetchall()]
-        
-        conn.close()
+    def get_matches(self, limit: int = 100, cursor: Optional[str] = None,
+                    include_total: bool = True) -> Dict[str, Any]:
+        """Получение списка игр (новые первыми) с keyset-пагинацией по (created_at, id)"""
+        with self.read_connection() as conn:
+            if cursor:
+                created_at, row_id = decode_cursor(cursor)
+                rows = conn.execute('''
+                    SELECT * FROM matches
+                    WHERE (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (created_at, row_id, limit)).fetchall()
+            else:
+                rows = conn.execute('''
+                    SELECT * FROM matches
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (limit,)).fetchall()
+            
+            matches = self.records_from_rows(MatchRecord, rows)
         
-        return {
+        result = {
             "matches": matches,
-            "total_matches": len(matches)
+            "limit": limit,
+            "next_cursor": encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if rows and len(rows) == limit else None
         }
+        if include_total:
+            result["total_matches"] = self.get_row_count('matches')
+        return result
     
-    def update_game(self, game_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Обновление данных игры"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def update_game(self, game_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление данных игры (wait=False - вернуть Future, не дожидаясь коммита).
         
+        ended_at (sqlite_timestamp) завершает игру: открытые сессии ее игроков получают left_at,
+        по этим колонкам run_retention удаляет старые игры и сессии.
+        """
         fields = []
         values = []
         
         for key, value in game_data.items():
-            if key != 'match_id' and key in ['name', 'status', 'max_players', 'current_players', 'players']:
+            if key != 'match_id' and key in GAME_UPDATABLE_FIELDS:
                 fields.append(f"{key} = ?")
                 values.append(value)
         
         if not fields:
-            conn.close()
-            return None
+            return None if wait else self._write(lambda conn: None, wait)
         
-        values.append(game_data['match_id'])
+        match_id = game_data['match_id']
+        values.append(match_id)
         query = f"UPDATE matches SET {', '.join(fields)} WHERE match_id = ?"
         
-        cursor.execute(query, values)
-        conn.commit()
-        conn.close()
-        
-        return self.get_game(game_data['match_id'])
+        active_delta = []
+        
+        def operation(conn):
+            # Прежний статус нужен только для счетчика активных игр
+            before = self._fetch_one(conn, 'SELECT status FROM matches WHERE match_id = ?', (match_id,)) \
+                if 'status' in game_data else {}
+            game = self._execute_returning(conn, query, values, 'SELECT * FROM matches WHERE match_id = ?', (match_id,))
+            if game and game_data.get('ended_at'):
+                conn.execute('UPDATE game_sessions SET left_at = ? WHERE match_id = ? AND left_at IS NULL',
+                             (game_data['ended_at'], match_id))
+            if before and game:
+                active_delta.append((game['status'] == 'active') - (before['status'] == 'active'))
+            return game
+        
+        def on_commit(game):
+            if active_delta:
+                self.counters.add('active_matches', active_delta[-1])
+        
+        return self._write(operation, wait, on_commit)
     
     def delete_game(self, match_id: str) -> Optional[Dict[str, Any]]:
         """Удаление игры"""
-        game = self.get_game(match_id)
-        if not game:
-            return None
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Удаляем связанные записи
-        cursor.execute('DELETE FROM game_sessions WHERE match_id = ?', (match_id,))
-        cursor.execute('DELETE FROM matches WHERE match_id = ?', (match_id,))
-        
-        conn.commit()
-        conn.close()
-        
-        return game
+        def operation(conn):
+            # Сессии игры удаляет ON DELETE CASCADE
+            game = self._execute_returning(conn, 'DELETE FROM matches WHERE match_id = ?', (match_id,),
+                                           'SELECT * FROM matches WHERE match_id = ?', (match_id,))
+            if not game:
+                return None
+            if not self.foreign_keys:
+                conn.execute('DELETE FROM game_sessions WHERE match_id = ?', (match_id,))
+            return game
+        
+        def on_commit(game):
+            if game:
+                self.counters.add('matches', -1)
+                self.counters.add('active_matches', -(game['status'] == 'active'))
+        
+        return self._write(operation, on_commit=on_commit)
     
     # Методы для статистики
     def get_server_stats(self) -> Dict[str, Any]:
-        """Получение статистики сервера"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Количество пользователей в лобби
-        cursor.execute('SELECT COUNT(*) FROM lobby_users')
-        lobby_users_count = cursor.fetchone()[0]
-        
-        # Количество пользователей в очереди
-        cursor.execute('SELECT COUNT(*) FROM queue_users')
-        queue_users_count = cursor.fetchone()[0]
-        
-        # Количество активных игр
-        cursor.execute('SELECT COUNT(*) FROM matches WHERE status = "active"')
-        active_matches_count = cursor.fetchone()[0]
-        
-        # Общее количество пользователей
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users_count = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        """Получение статистики сервера (из счетчиков, без запросов к базе)"""
+        self._maybe_reconcile_stats()
         return {
-            "lobby_users_count": lobby_users_count,
-            "queue_users_count": queue_users_count,
-            "active_matches_count": active_matches_count,
-            "total_users_count": total_users_count
+            "lobby_users_count": self.counters.get('lobby_users'),
+            "queue_users_count": self.counters.get('queue_users'),
+            "active_matches_count": self.counters.get('active_matches'),
+            "total_users_count": self.counters.get('users')
         }
     
-    def cleanup_old_data(self, days: int = 30):
-        """Очистка старых данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Удаляем старые игровые сессии
-        cursor.execute('''
-            DELETE FROM game_sessions 
-            WHERE left_at IS NOT NULL 
-            AND left_at < datetime('now', '-{} days')
-        '''.format(days))
-        
-        # Удаляем завершенные игры старше указанного периода
-        cursor.execute('''
-            DELETE FROM matches 
-            WHERE ended_at IS NOT NULL 
-            AND ended_at < datetime('now', '-{} days')
-        '''.format(days))
-        
-        conn.commit()
-        conn.close()
+    def cleanup_old_data(self, days: int = DB_RETENTION_DAYS) -> Dict[str, Any]:
+        """Очистка старых данных (синхронно, порциями - см. run_retention)"""
+        return self.run_retention(days)
+    
+    def run_retention(self, days: int = DB_RETENTION_DAYS, chunk_size: int = DB_RETENTION_CHUNK_SIZE,
+                      pause: float = DB_RETENTION_PAUSE, stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Удаление завершенных игр и сессий старше days дней.
+        
+        Строки удаляются транзакциями не более чем по chunk_size с паузой pause
+        между ними, поэтому блокировка записи удерживается недолго. Затем
+        освобожденные страницы возвращаются ОС через PRAGMA incremental_vacuum.
+        Возвращает количество удаленных строк, освобожденных страниц и время блокировок.
+        """
+        cutoff_modifier = f'-{int(days)} days'
+        report = {"game_sessions": 0, "matches": 0, "chunks": 0, "vacuum_pages": 0,
+                  "max_lock_ms": 0.0, "total_lock_ms": 0.0}
+        run_started = time.perf_counter()
+        
+        def record(start: float):
+            # Время от начала транзакции порции до коммита (включая ожидание блокировки записи)
+            lock_ms = (time.perf_counter() - start) * 1000
+            report["chunks"] += 1
+            report["max_lock_ms"] = round(max(report["max_lock_ms"], lock_ms), 2)
+            report["total_lock_ms"] = round(report["total_lock_ms"] + lock_ms, 2)
+        
+        def delete_chunk(query: str) -> int:
+            started = []
+            
+            def operation(conn):
+                started.append(time.perf_counter())
+                return conn.execute(query, (cutoff_modifier, chunk_size)).rowcount
+            
+            return self._write(operation, on_commit=lambda removed: record(started[-1]))
+        
+        for table, column in RETENTION_TABLES.items():
+            query = f'''
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table}
+                    WHERE {column} IS NOT NULL AND {column} < datetime('now', ?)
+                    LIMIT ?
+                )
+            '''
+            while not (stop is not None and stop.is_set()):
+                removed = delete_chunk(query)
+                report[table] += removed
+                if removed < chunk_size:
+                    break
+                time.sleep(pause)
+        
+        if report["matches"]:
+            self.reconcile_stats()
+        
+        def vacuum_step():
+            # executescript выполняет PRAGMA до конца (execute освобождает только одну страницу);
+            # вне транзакции и мимо группового коммита - executescript коммитит открытую транзакцию
+            with self.connection() as conn:
+                start = time.perf_counter()
+                free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                conn.executescript(f'PRAGMA incremental_vacuum({DB_VACUUM_PAGES_PER_STEP});')
+                freed = free_before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+            record(start)
+            return freed
+        
+        with self.connection() as conn:
+            incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        while incremental and not (stop is not None and stop.is_set()):
+            freed = vacuum_step()
+            report["vacuum_pages"] += freed
+            if freed < DB_VACUUM_PAGES_PER_STEP:
+                break
+            time.sleep(pause)
+        
+        report["duration_ms"] = round((time.perf_counter() - run_started) * 1000, 2)
+        return report
+    
+    def start_retention_worker(self, days: int = DB_RETENTION_DAYS,
+                               interval: float = DB_RETENTION_INTERVAL) -> RetentionWorker:
+        """Запуск фоновой очистки старых данных (повторный вызов возвращает уже запущенную)"""
+        if self.retention is None:
+            self.retention = RetentionWorker(self, days, interval)
+        return self.retention
+    
+    def backup(self, backup_dir: Optional[str] = None, keep: int = DB_BACKUP_KEEP, pages: int = DB_BACKUP_PAGES,
+               pause: float = DB_BACKUP_PAUSE, stop: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """Копия базы на ходу в backup_dir (по умолчанию DB_BACKUP_DIR в data_dir() базы).
+        
+        sqlite3.Connection.backup копирует по pages страниц с паузой pause между
+        шагами: блокировка чтения держится только на время шага. Если базу
+        меняют другие соединения, SQLite начинает копию заново; после
+        DB_BACKUP_MAX_RESTARTS перезапусков копия снимается одним шагом (в WAL
+        он читает снимок и не блокирует запись). Копия пишется во временный файл
+        и переименовывается, старые копии сверх keep удаляются.
+        Возвращает отчет (путь, размер, время, скорость) или None, если stop прервал копию.
+        """
+        backup_dir = backup_dir or os.path.join(data_dir(self.db_path), DB_BACKUP_DIR)
+        os.makedirs(backup_dir, exist_ok=True)
+        root, ext = os.path.splitext(os.path.basename(self.db_path))
+        path = os.path.join(backup_dir, f"{root}-{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}")
+        temp_path = f"{path}.tmp"
+        report = {"files": [path], "bytes": 0, "pages": 0, "steps": 0, "restarts": 0, "max_step_ms": 0.0,
+                  "single_step": False}
+        started = time.perf_counter()
+        step = {"started": started, "remaining": None}
+        
+        def progress(status, remaining, total):
+            now = time.perf_counter()
+            report["steps"] += 1
+            report["pages"] = total
+            report["max_step_ms"] = round(max(report["max_step_ms"], (now - step["started"]) * 1000), 2)
+            # После перезапуска копия идет с первой страницы: оставшихся страниц не меньше, чем было
+            if step["remaining"] is not None and remaining >= step["remaining"]:
+                report["restarts"] += 1
+                if report["restarts"] > DB_BACKUP_MAX_RESTARTS:
+                    raise _BackupAborted('restarts')
+            step["remaining"] = remaining
+            if stop is not None and stop.is_set():
+                raise _BackupAborted('stopped')
+            if remaining:
+                time.sleep(pause)
+            step["started"] = time.perf_counter()
+        
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        source = sqlite3.connect(self.db_path, timeout=DB_POOL_TIMEOUT)
+        target = sqlite3.connect(temp_path)
+        try:
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _BackupAborted as e:
+                if e.reason == 'stopped':
+                    target.close()
+                    os.remove(temp_path)
+                    return None
+                report["single_step"] = True
+                step["started"], step["remaining"] = time.perf_counter(), None
+                source.backup(target, pages=-1, progress=progress)
+            # Копия - один самостоятельный файл, без -wal
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            source.close()
+            target.close()
+        os.replace(temp_path, path)
+        
+        report["removed"] = []
+        for name in _backup_snapshots(backup_dir, root, ext)[:-max(keep, 1)]:
+            os.remove(os.path.join(backup_dir, name))
+            report["removed"].append(name)
+        
+        duration = time.perf_counter() - started
+        report["bytes"] = os.path.getsize(path)
+        report["duration_ms"] = round(duration * 1000, 2)
+        report["mb_per_s"] = round(report["bytes"] / 1_000_000 / duration, 2)
+        return report
+    
+    def start_backup_worker(self, interval: float = DB_BACKUP_INTERVAL, keep: int = DB_BACKUP_KEEP,
+                            backup_dir: Optional[str] = None) -> BackupWorker:
+        """Запуск фонового резервного копирования (повторный вызов возвращает уже запущенное)"""
+        if self.backups is None:
+            self.backups = BackupWorker(self, interval, keep, backup_dir)
+        return self.backups
+    
+    def enable_incremental_vacuum(self):
+        """Перевод существующей базы в auto_vacuum=INCREMENTAL (VACUUM всей базы, разовая операция)"""
+        with self.connection() as conn:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+
+def data_dir(db_path: str) -> str:
+    """Каталог шардов и копий базы db_path: DB_DATA_DIR, если задан; для базы в папке Assets
+    проекта Unity - DB_UNITY_DATA_DIR рядом с Assets; иначе - каталог самой базы"""
+    if DB_DATA_DIR:
+        return DB_DATA_DIR
+    directory = os.path.dirname(os.path.abspath(db_path))
+    parts = directory.split(os.sep)
+    if 'Assets' in parts:
+        project = os.sep.join(parts[:len(parts) - 1 - parts[::-1].index('Assets')])
+        return os.path.join(project or os.sep, DB_UNITY_DATA_DIR)
+    return directory
+
+def shard_path(db_path: str, index: int) -> str:
+    """Путь к файлу шарда в data_dir(): game_server.db -> game_server.shard0.db"""
+    root, ext = os.path.splitext(os.path.basename(db_path))
+    return os.path.join(data_dir(db_path), f"{root}.shard{index}{ext}")
+
+def _gather_futures(futures: List[Future], combine) -> Future:
+    """Future, который завершается после всех futures с результатом combine(результаты)"""
+    gathered = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+    
+    def on_done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            gathered.set_exception(errors[0])
+        else:
+            gathered.set_result(combine([future.result() for future in futures]))
+    
+    if not futures:
+        gathered.set_result(combine([]))
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
+
+@profiled_methods
+class ShardedGameDatabase(GameDatabase):
+    """База данных с шардированием данных игроков.
+    
+    Таблицы SHARDED_TABLES распределяются по shards файлам (shard_path) по
+    crc32(user_id) % shards: операции с одним игроком идут в его шард и не
+    конкурируют за блокировку записи с остальными. matches, очередь, игровые
+    сессии и последовательности остаются в основной базе (db_path).
+    Списки и статистика собираются со всех шардов.
+    """
+    
+    def __init__(self, db_path: str = "game_server.db", shards: int = DB_SHARDS, **options):
+        """Инициализация основной базы и шардов (options - параметры GameDatabase)"""
+        if shards < 1:
+            raise ValueError("shards must be >= 1")
+        # До super().__init__: init_database вызывает reconcile_stats, который обходит шарды
+        self.shards: List[GameDatabase] = []
+        # Родительские строки users лежат в шардах, поэтому внешние ключи основной базы
+        # не проверяются, и связанные строки в ней удаляются явными запросами
+        super().__init__(db_path, **dict(options, foreign_keys=False))
+        os.makedirs(data_dir(db_path), exist_ok=True)
+        # Общий профилировщик: вызовы методов шардов входят в вызов метода ShardedGameDatabase
+        self.shards = [GameDatabase(shard_path(db_path, index), **dict(options, profiler=self.profiler))
+                       for index in range(shards)]
+        # Общий кэш: эпохи инвалидации едины для всех шардов
+        for shard in self.shards:
+            shard.user_cache = self.user_cache
+        self._move_users_to_shards()
+        self.reconcile_stats()
+    
+    def shard_index(self, user_id: str) -> int:
+        """Номер шарда игрока"""
+        return zlib.crc32(user_id.encode()) % len(self.shards)
+    
+    def shard_for(self, user_id: str) -> GameDatabase:
+        """Шард, в котором хранятся данные игрока"""
+        return self.shards[self.shard_index(user_id)]
+    
+    def _group_by_shard(self, items: list, key) -> Dict[int, list]:
+        """Группировка элементов по номеру шарда key(элемент)"""
+        groups: Dict[int, list] = {}
+        for item in items:
+            groups.setdefault(self.shard_index(key(item)), []).append(item)
+        return groups
+    
+    def _move_users_to_shards(self):
+        """Перенос данных игроков из основной базы в шарды (при включении шардирования на существующей базе).
+        
+        Строки вставляются через INSERT OR IGNORE и удаляются из основной базы
+        после коммита во все шарды, поэтому прерванный перенос можно повторить.
+        """
+        moved = 0
+        with self.connection() as conn:
+            for table in SHARDED_TABLES:
+                rows = conn.execute(f'SELECT * FROM {table}').fetchall()
+                if not rows:
+                    continue
+                columns = rows[0].keys()
+                statement = (f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                             f"VALUES ({', '.join('?' * len(columns))})")
+                for index, shard_rows in self._group_by_shard(rows, lambda row: row['user_id']).items():
+                    self.shards[index]._write(lambda shard_conn, shard_rows=shard_rows: shard_conn.executemany(
+                        statement, [tuple(row) for row in shard_rows]))
+                conn.execute(f'DELETE FROM {table}')
+                conn.commit()
+                if table == 'users':
+                    moved = len(rows)
+        if moved:
+            self.user_cache.clear()
+            print(f"🔀 Moved {moved} users to {len(self.shards)} shards")
+    
+    def close(self):
+        """Закрытие соединений основной базы и шардов"""
+        for shard in self.shards:
+            shard.close()
+        super().close()
+    
+    def flush(self, timeout: Optional[float] = None):
+        """Ожидание записи операций в очередях основной базы и шардов"""
+        for shard in self.shards:
+            shard.flush(timeout)
+        super().flush(timeout)
+    
+    def reconcile_stats(self):
+        """Сверка счетчиков основной базы и шардов"""
+        for shard in self.shards:
+            shard.reconcile_stats()
+        super().reconcile_stats()
+    
+    def get_row_count(self, table: str) -> int:
+        """Количество строк таблицы: для шардированных таблиц - сумма по шардам"""
+        if table in SHARDED_TABLES:
+            return sum(shard.counters.get(table) for shard in self.shards)
+        return super().get_row_count(table)
+    
+    def check_query_plans(self) -> Dict[str, List[str]]:
+        """Проверка планов запросов в основной базе и шардах"""
+        problems = super().check_query_plans()
+        for index, shard in enumerate(self.shards):
+            for name, plan in shard.check_query_plans().items():
+                problems.setdefault(name, []).extend(f"shard {index}: {step}" for step in plan)
+        return problems
+    
+    # Пользователи: операции с одним игроком - в его шарде
+    def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание нового пользователя в его шарде"""
+        return self.shard_for(user_data['user_id']).create_user(user_data)
+    
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя по ID из его шарда"""
+        return self.shard_for(user_id).get_user(user_id)
+    
+    def get_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получение нескольких пользователей: по одному запросу на шард"""
+        users = {}
+        for index, shard_ids in self._group_by_shard(list(dict.fromkeys(user_ids)), lambda user_id: user_id).items():
+            users.update(self.shards[index].get_users(shard_ids))
+        return users
+    
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя по email (поиск по всем шардам)"""
+        for shard in self.shards:
+            user = shard.get_user_by_email(email)
+            if user:
+                return user
+        return {}
+    
+    def update_user(self, user_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление данных пользователя в его шарде"""
+        return self.shard_for(user_data['user_id']).update_user(user_data, wait)
+    
+    def update_users(self, patches: List[Dict[str, Any]], wait: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Обновление нескольких пользователей: по одной транзакции на шард"""
+        results = [self.shards[index].update_users(shard_patches, wait)
+                   for index, shard_patches in self._group_by_shard(patches, lambda patch: patch['user_id']).items()]
+        
+        def combine(parts):
+            users = {}
+            for part in parts:
+                users.update(part)
+            return users
+        
+        return combine(results) if wait else _gather_futures(results, combine)
+    
+    def delete_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Удаление пользователей из их шардов, а также из очереди и сессий основной базы"""
+        deleted = {}
+        for index, shard_ids in self._group_by_shard(list(dict.fromkeys(user_ids)), lambda user_id: user_id).items():
+            deleted.update(self.shards[index].delete_users(shard_ids))
+        if not deleted:
+            return deleted
+        
+        removed = list(deleted)
+        
+        def operation(conn):
+            for start in range(0, len(removed), DB_MAX_IN_PARAMS):
+                chunk = removed[start:start + DB_MAX_IN_PARAMS]
+                placeholders = ', '.join('?' * len(chunk))
+                conn.execute(f'DELETE FROM queue_users WHERE user_id IN ({placeholders})', chunk)
+                conn.execute(f'DELETE FROM game_sessions WHERE user_id IN ({placeholders})', chunk)
+        
+        self._write(operation)
+        return deleted
+    
+    def get_user_mmr(self, user_id: str, match_type: int) -> Optional[int]:
+        """Рейтинг игрока для типа матча из его шарда"""
+        return self.shard_for(user_id).get_user_mmr(user_id, match_type)
+    
+    def find_users_by_mmr(self, match_type: int, mmr: int, delta: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Игроки с рейтингом в диапазоне mmr ± delta: ближайшие limit из всех шардов"""
+        users = []
+        for shard in self.shards:
+            users.extend(shard.find_users_by_mmr(match_type, mmr, delta, limit))
+        users.sort(key=lambda user: abs(user["mmr"] - mmr))
+        return users[:limit]
+    
+    # Лобби
+    def create_lobby_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание пользователя в лобби (в шарде игрока)"""
+        return self.shard_for(user_data['user_id']).create_lobby_user(user_data)
+    
+    def get_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя из лобби (из шарда игрока)"""
+        return self.shard_for(user_id).get_lobby_user(user_id)
+    
+    def update_lobby_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Обновление пользователя в лобби (в шарде игрока)"""
+        return self.shard_for(user_data['user_id']).update_lobby_user(user_data)
+    
+    def delete_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя из лобби (из шарда игрока)"""
+        return self.shard_for(user_id).delete_lobby_user(user_id)
+    
+    def get_lobby_users(self, page: int = 1, per_page: int = 1000, cursor: Optional[str] = None,
+                        include_total: bool = True) -> Dict[str, Any]:
+        """Получение списка пользователей в лобби со всех шардов.
+        
+        Строки упорядочены по (created_at, id, номер шарда) по убыванию: id в
+        разных шардах могут совпадать, номер шарда делает порядок однозначным.
+        С курсором каждый шард отдает не больше per_page строк после курсора,
+        результаты сливаются. Без курсора page > 1 читает page * per_page строк
+        с каждого шарда (как OFFSET - только для совместимости).
+        """
+        if cursor:
+            created_at, row_id, cursor_shard = decode_shard_cursor(cursor)
+            limit, offset = per_page, 0
+        else:
+            limit, offset = page * per_page, (page - 1) * per_page
+        
+        rows = []
+        for index, shard in enumerate(self.shards):
+            with shard.read_connection() as conn:
+                if cursor:
+                    # Строки с тем же (created_at, id) в шардах с меньшим номером идут после курсора
+                    operator = '<=' if index < cursor_shard else '<'
+                    shard_rows = conn.execute(f'''
+                        SELECT * FROM lobby_users
+                        WHERE (created_at, id) {operator} (?, ?)
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (created_at, row_id, limit)).fetchall()
+                else:
+                    shard_rows = conn.execute('''
+                        SELECT * FROM lobby_users
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (limit,)).fetchall()
+            rows.extend((row['created_at'], row['id'], index, record)
+                        for row, record in zip(shard_rows, self.records_from_rows(LobbyUserRecord, shard_rows)))
+        
+        rows.sort(key=lambda item: item[:3], reverse=True)
+        rows = rows[offset:offset + per_page]
+        
+        result = {
+            "users": [item[3] for item in rows],
+            "page": page,
+            "per_page": per_page,
+            "next_cursor": encode_shard_cursor(*rows[-1][:3]) if rows and len(rows) == per_page else None
+        }
+        if include_total:
+            total_users = self.get_row_count('lobby_users')
+            result["total_users"] = total_users
+            result["total_pages"] = (total_users + per_page - 1) // per_page
+        return result
+    
+    def backup(self, backup_dir: Optional[str] = None, keep: int = DB_BACKUP_KEEP, pages: int = DB_BACKUP_PAGES,
+               pause: float = DB_BACKUP_PAUSE, stop: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """Копии основной базы и шардов: каждый файл копируется отдельно, общий момент времени не гарантируется"""
+        started = time.perf_counter()
+        reports = []
+        for database in [super()] + self.shards:
+            report = database.backup(backup_dir, keep, pages, pause, stop)
+            if report is None:
+                return None
+            reports.append(report)
+        
+        duration = time.perf_counter() - started
+        combined = {key: sum(report[key] for report in reports) for key in ("bytes", "pages", "steps", "restarts")}
+        combined.update({
+            "files": [path for report in reports for path in report["files"]],
+            "removed": [name for report in reports for name in report["removed"]],
+            "max_step_ms": max(report["max_step_ms"] for report in reports),
+            "single_step": any(report["single_step"] for report in reports),
+            "duration_ms": round(duration * 1000, 2),
+            "mb_per_s": round(combined["bytes"] / 1_000_000 / duration, 2)
+        })
+        return combined
+    
+    # Статистика
+    def get_server_stats(self) -> Dict[str, Any]:
+        """Статистика сервера: игроки и лобби - сумма по шардам, очередь и матчи - из основной базы"""
+        stats = super().get_server_stats()
+        for shard in self.shards:
+            shard._maybe_reconcile_stats()
+        stats["lobby_users_count"] = self.get_row_count('lobby_users')
+        stats["total_users_count"] = self.get_row_count('users')
+        return stats
+
+def create_storage(backend: str = DB_BACKEND) -> GameStorage:
+    """Создание хранилища по имени реализации (DB_BACKEND)"""
+    if backend == 'memory':
+        from memory_database import MemoryGameDatabase
+        return MemoryGameDatabase()
+    if backend == 'sqlite':
+        return ShardedGameDatabase(shards=DB_SHARDS) if DB_SHARDS > 1 else GameDatabase()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+class StorageProxy:
+    """Глобальный db: хранилище создается при init_storage() или при первом обращении.
+    
+    Импорт database и endpoint'ов не открывает базу; атрибуты и методы
+    делегируются созданному хранилищу.
+    """
+    
+    def __init__(self):
+        self._storage: Optional[GameStorage] = None
+        self._backend = DB_BACKEND
+        self._lock = threading.Lock()
+    
+    def configure(self, backend: str):
+        """Реализация, которой хранилище будет создано при первом обращении (базу не открывает)"""
+        self._backend = backend
+    
+    def get(self, backend: Optional[str] = None) -> GameStorage:
+        """Хранилище, при необходимости создается реализацией backend (по умолчанию - из configure())"""
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    self._storage = create_storage(backend or self._backend)
+        return self._storage
+    
+    @property
+    def initialized(self) -> bool:
+        """Создано ли хранилище"""
+        return self._storage is not None
+    
+    def close(self):
+        """Закрытие хранилища (следующее обращение создаст новое)"""
+        with self._lock:
+            storage, self._storage = self._storage, None
+        if storage is not None:
+            storage.close()
+    
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+    
+    def __setattr__(self, name, value):
+        # Настройки хранилища (db.use_records = True) - в само хранилище, а не в прокси
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.get(), name, value)
+
+def init_storage(backend: str = DB_BACKEND) -> GameStorage:
+    """Явная инициализация глобального db (повторный вызов возвращает уже созданное хранилище)"""
+    return db.get(backend)
 
-# Глобальный экземпляр базы данных
-db = GameDatabase() 
\ No newline at end of file
+# Глобальный экземпляр хранилища (создается лениво)
+db = StorageProxy() 
\ No newline at end of file
@@ -0,0 +1,971 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк слоя базы данных игрового сервера (запускается локально, сервер не нужен)
+
+    python db_benchmark.py                 - все сценарии
+    python db_benchmark.py pool            - только указанный сценарий
+"""
+
+import os
+import io
+import sys
+import json
+import contextlib
+import time
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+
+from database import GameDatabase, ShardedGameDatabase
+
+ITERATIONS = 2000
+
+def measure(func, iterations: int = ITERATIONS) -> float:
+    """Возвращает среднее время одного вызова в микросекундах"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+def print_result(name: str, before: float, after: float):
+    """Печатает строку сравнения до/после"""
+    print(f"  {name:<40} before: {before:9.1f} us   after: {after:9.1f} us   x{before / after:5.1f}")
+
+def make_database(path: str, users: int = 100, **options) -> GameDatabase:
+    """Создает тестовую базу с пользователями"""
+    database = GameDatabase(path, **options)
+    for i in range(users):
+        database.create_user({
+            'user_id': f"user_{i}",
+            'nick_name': f"Player {i}",
+            'email': f"user_{i}@bench.local",
+            'password': "password",
+            'mmr': json.dumps([1000] * 6),
+            'profile_data': json.dumps({'match_current': None, 'queue_ticket_id': None})
+        })
+    return database
+
+def bench_pool(path: str):
+    """Стоимость соединения на запрос: sqlite3.connect() на каждый вызов против пула"""
+    print("\n📊 Connection cost per request (add_to_queue: get_user x2 + update_user)")
+    database = make_database(path, user_cache_size=0)
+
+    # Старое поведение: новое соединение на каждый метод
+    def legacy_get_user(user_id):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else {}
+
+    def legacy_update_user(user_id, profile_data):
+        conn = sqlite3.connect(path)
+        conn.execute('UPDATE users SET profile_data = ? WHERE user_id = ?', (profile_data, user_id))
+        conn.commit()
+        conn.close()
+        return legacy_get_user(user_id)
+
+    def legacy_request(i):
+        user_id = f"user_{i % 100}"
+        legacy_get_user(user_id)
+        legacy_get_user(user_id)
+        legacy_update_user(user_id, '{}')
+
+    def pooled_request(i):
+        user_id = f"user_{i % 100}"
+        database.get_user(user_id)
+        database.get_user(user_id)
+        database.update_user({'user_id': user_id, 'profile_data': '{}'})
+
+    print_result("get_user (single read)",
+                 measure(lambda i: legacy_get_user(f"user_{i % 100}")),
+                 measure(lambda i: database.get_user(f"user_{i % 100}")))
+    print_result("add_to_queue request", measure(legacy_request), measure(pooled_request))
+    database.close()
+
+def bench_group_commit(path: str):
+    """Параллельные update_user: транзакция на вызов против группового коммита"""
+    print("\n📊 Concurrent update_user throughput (8 threads)")
+    threads_count = 8
+    per_thread = 250
+
+    def run(database: GameDatabase, wait: bool) -> float:
+        def worker(n):
+            futures = []
+            for i in range(per_thread):
+                user_id = f"user_{(n * per_thread + i) % 100}"
+                futures.append(database.update_user({'user_id': user_id, 'profile_data': '{}'}, wait=wait))
+            if not wait:
+                for future in futures:
+                    future.result()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(threads_count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return threads_count * per_thread / (time.perf_counter() - start)
+
+    database = make_database(path, user_cache_size=0)
+    direct = run(database, wait=True)
+    database.close()
+
+    database = GameDatabase(path, group_commit=True, user_cache_size=0)
+    grouped = run(database, wait=True)
+    grouped_async = run(database, wait=False)
+    database.close()
+
+    database = GameDatabase(path, group_commit=True, group_commit_window=0, user_cache_size=0)
+    grouped_no_window = run(database, wait=True)
+    database.close()
+
+    print(f"  {'commit per call':<40} {direct:9.0f} writes/s")
+    print(f"  {'group commit (wait=True)':<40} {grouped:9.0f} writes/s")
+    print(f"  {'group commit, window=0 (wait=True)':<40} {grouped_no_window:9.0f} writes/s")
+    print(f"  {'group commit (wait=False, futures)':<40} {grouped_async:9.0f} writes/s")
+
+def bench_user_cache(path: str):
+    """Повторные get_user для одних и тех же игроков: без кэша против кэша пользователей"""
+    print("\n📊 Repeated get_user (add_to_queue + match create/finish pattern)")
+    make_database(path).close()
+    uncached = GameDatabase(path, user_cache_size=0)
+    cached = GameDatabase(path)
+
+    def queue_join(database):
+        def request(i):
+            user_id = f"user_{i % 100}"
+            database.get_user(user_id)
+            database.get_user(user_id)
+            if i % 10 == 0:
+                database.update_user({'user_id': user_id, 'profile_data': '{}'})
+            database.get_user(user_id)
+        return request
+
+    print_result("get_user x3 + 10% update_user", measure(queue_join(uncached)), measure(queue_join(cached)))
+    stats = cached.user_cache.stats()
+    print(f"  hit ratio: {stats['hit_ratio']:.1%}  hits: {stats['hits']}  misses: {stats['misses']}  "
+          f"invalidations: {stats['invalidations']}")
+    uncached.close()
+    cached.close()
+
+def bench_server_stats(path: str):
+    """Статус сервера: четыре COUNT(*) на запрос против счетчиков в памяти"""
+    print("\n📊 Server stats (/api-game-lobby/ polling, 10000 users)")
+    database = make_database(path, users=10000, user_cache_size=0)
+    with database.connection() as conn:
+        conn.executemany('INSERT INTO lobby_users (user_id, username) VALUES (?, ?)',
+                         [(f"user_{i}", f"Player {i}") for i in range(0, 10000, 2)])
+        conn.commit()
+    database.reconcile_stats()
+
+    def legacy_stats(i):
+        with database.connection() as conn:
+            for query in ('SELECT COUNT(*) FROM lobby_users', 'SELECT COUNT(*) FROM queue_users',
+                          "SELECT COUNT(*) FROM matches WHERE status = 'active'", 'SELECT COUNT(*) FROM users'):
+                conn.execute(query).fetchone()
+
+    print_result("get_server_stats", measure(legacy_stats, 500), measure(lambda i: database.get_server_stats()))
+    database.close()
+
+def bench_bulk_users(path: str):
+    """Создание/завершение матча 6v6: get_user + update_user на игрока против get_users + update_users"""
+    print("\n📊 6v6 match players update (12 players)")
+    database = make_database(path, user_cache_size=0)
+
+    def players(i):
+        return [f"user_{(i * 12 + n) % 100}" for n in range(12)]
+
+    def per_player(i):
+        for user_id in players(i):
+            database.get_user(user_id)
+            database.update_user({'user_id': user_id, 'match_current': f"match_{i}", 'queue_ticket_id': None})
+
+    def bulk(i):
+        user_ids = players(i)
+        database.get_users(user_ids)
+        database.update_users([{'user_id': user_id, 'match_current': f"match_{i}", 'queue_ticket_id': None}
+                               for user_id in user_ids])
+
+    print_result("get + update x12", measure(per_player, 200), measure(bulk, 200))
+    database.close()
+
+def bench_returning(path: str):
+    """Запись с повторным чтением строки SELECT против INSERT/UPDATE/DELETE ... RETURNING"""
+    print("\n📊 Write + read back of the row (SELECT after write vs RETURNING, best of 3, synchronous=OFF)")
+    database = make_database(path, users=1000, user_cache_size=0)
+    if not database.use_returning:
+        print("  ⚠ SQLite < 3.35: RETURNING is not supported, only the fallback is available")
+        database.close()
+        return
+    # Без fsync на коммит разница в один запрос не теряется в шуме диска
+    with database.connection() as conn:
+        conn.execute('PRAGMA synchronous = OFF')
+
+    def run(prefix):
+        return {
+            "create_user": measure(lambda i: database.create_user({
+                'user_id': f"{prefix}_{i}", 'nick_name': "Player", 'email': f"{prefix}_{i}@bench.local",
+                'password': "password", 'mmr': json.dumps([1000] * 6)}), 500),
+            "update_user": measure(lambda i: database.update_user({'user_id': f"user_{i % 1000}", 'money': i})),
+            "create_lobby_user": measure(lambda i: database.create_lobby_user({
+                'user_id': f"user_{i}", 'username': "Player"}), 500),
+            "update_lobby_user": measure(lambda i: database.update_lobby_user({
+                'user_id': f"user_{i % 500}", 'status': 'away'})),
+            "delete_lobby_user": measure(lambda i: database.delete_lobby_user(f"user_{i}"), 500),
+            "add_user_to_queue": measure(lambda i: database.add_user_to_queue({
+                'user_id': f"user_{i}", 'username': "Player"}), 500),
+            "remove_user_from_queue": measure(lambda i: database.remove_user_from_queue(f"user_{i}"), 500),
+            "create_game": measure(lambda i: database.create_game({
+                'match_id': f"{prefix}_match_{i}", 'name': "1v1 Match", 'status': 'active'}), 500),
+            "update_game": measure(lambda i: database.update_game({
+                'match_id': f"{prefix}_match_{i % 500}", 'status': 'finished'})),
+            "delete_game": measure(lambda i: database.delete_game(f"{prefix}_match_{i}"), 500),
+        }
+
+    before, after = {}, {}
+    for attempt in range(3):
+        for use_returning, results in ((False, before), (True, after)):
+            database.use_returning = use_returning
+            for name, value in run(f"{use_returning}_{attempt}").items():
+                results[name] = min(value, results.get(name, value))
+    for name in before:
+        print_result(name, before[name], after[name])
+    database.close()
+
+def bench_wal_readers(path: str):
+    """Параллельные GET (get_matches, get_lobby_users) и записи матчей: rollback journal против WAL + читатели"""
+    print("\n📊 Concurrent reads vs writes (4 reader threads at ~200 req/s each + 1 writer thread, 3 s)")
+    duration = 3.0
+
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[int(len(values) * fraction)] * 1000 if values else 0.0
+
+    def run(db_path: str, **options):
+        database = make_database(db_path, users=1000, user_cache_size=0, **options)
+        for i in range(2000):
+            database.create_game({'match_id': f"seed_{i}", 'name': "1v1 Match", 'status': 'finished'})
+        stop = threading.Event()
+        read_latency = []
+        write_latency = []
+
+        def reader():
+            while not stop.is_set():
+                start = time.perf_counter()
+                database.get_matches(limit=100)
+                database.get_lobby_users(per_page=100)
+                read_latency.append(time.perf_counter() - start)
+                time.sleep(0.005)
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                database.create_game({'match_id': f"live_{i}", 'name': "1v1 Match", 'status': 'active'})
+                database.update_game({'match_id': f"live_{i}", 'status': 'finished'})
+                write_latency.append(time.perf_counter() - start)
+                i += 1
+
+        threads = [threading.Thread(target=reader) for _ in range(4)] + [threading.Thread(target=writer)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        database.close()
+        return (len(read_latency) / duration, percentile(read_latency, 0.99),
+                len(write_latency) / duration, percentile(write_latency, 0.99))
+
+    for n, (name, options) in enumerate((("rollback journal, shared pool", {'wal': False}),
+                                         ("WAL, shared pool", {'wal': True, 'reader_pool_size': 0}),
+                                         ("WAL + mode=ro reader pool", {'wal': True}))):
+        reads, read_p99, writes, write_p99 = run(f"{path}.{n}", **options)
+        print(f"  {name:<32} reads: {reads:6.0f}/s p99 {read_p99:6.1f} ms   "
+              f"match writes: {writes:6.0f}/s p99 {write_p99:6.1f} ms")
+
+def bench_shards(path: str):
+    """Параллельные записи игроков (update_user): одна база против 4 шардов"""
+    print("\n📊 Concurrent player writes (8 threads, 2 s)")
+    duration = 2.0
+
+    def run(db_path: str, shards: int):
+        if shards > 1:
+            database = ShardedGameDatabase(db_path, shards=shards, user_cache_size=0)
+        else:
+            database = GameDatabase(db_path, user_cache_size=0)
+        for i in range(800):
+            database.create_user({'user_id': f"user_{i}", 'nick_name': f"Player {i}",
+                                  'email': f"user_{i}@bench.local", 'password': "password"})
+        stop = threading.Event()
+        latency = []
+
+        def worker(thread_index):
+            i = 0
+            while not stop.is_set():
+                user_id = f"user_{thread_index * 100 + i % 100}"
+                start = time.perf_counter()
+                database.update_user({'user_id': user_id, 'mmr': json.dumps([1000 + i, 1000, 1000, 1000])})
+                latency.append(time.perf_counter() - start)
+                i += 1
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        stats = database.get_server_stats()
+        database.close()
+        latency.sort()
+        return len(latency) / duration, latency[int(len(latency) * 0.99)] * 1000, stats['total_users_count']
+
+    for shards in (1, 4):
+        writes, p99, users = run(f"{path}.{shards}", shards)
+        print(f"  {f'{shards} shard(s)':<12} writes: {writes:6.0f}/s   p99 {p99:7.1f} ms   users: {users}")
+
+def run_app_requests(users: int = 300):
+    """Запросы к Flask-приложению через test client в текущем процессе; печатает JSON со временем на запрос (мкс)"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import _GAME_SERVER_MAIN
+    client = _GAME_SERVER_MAIN.create_app().test_client()
+    timings = {}
+
+    def call(name, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        assert response.status_code < 300, (url, response.status_code)
+        return response.get_json()
+
+    for i in range(users):
+        player_id = call('register', 'post', '/api-game-user/register',
+                         json={'email': f"user_{i}@bench.local", 'password': "password"})['player_id']
+        call('login', 'post', '/api-game-user/login', json={'email': f"user_{i}@bench.local", 'password': "password"})
+        call('get_user', 'get', f'/api-game-user/{player_id}')
+        call('update_user', 'put', f'/api-game-user/{player_id}', json={'nick_name': f"Renamed {i}"})
+        call('lobby_join', 'post', '/api-game-lobby/join', json={'player_id': player_id})
+        call('lobby_list', 'get', '/api-game-lobby/users?per_page=50')
+        call('lobby_leave', 'post', '/api-game-lobby/leave', json={'player_id': player_id})
+    print(json.dumps({name: sum(values) / len(values) * 1_000_000 for name, values in timings.items()}))
+    os._exit(0)  # фоновые потоки очереди и матчей не ждем
+
+def bench_backends(path: str):
+    """Полное Flask-приложение на SQLite и на хранилище в памяти: стоимость персистентности по запросам"""
+    print("\n📊 Flask app via test client, 300 players (register, login, get, update, lobby join/list/leave)")
+    results = {}
+    for backend in ('sqlite', 'memory'):
+        # Глобальный db создается при импорте, поэтому каждое хранилище - в своем процессе
+        workdir = f"{path}.{backend}"
+        os.makedirs(workdir)
+        env = dict(os.environ, GAME_DB_BACKEND=backend)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--app-requests'], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+    for name in results['sqlite']:
+        print_result(f"{name} (sqlite -> memory)", results['sqlite'][name], results['memory'][name])
+
+STARTUP_SCRIPT = """
+import sys, time, threading, json
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import _GAME_SERVER_MAIN
+imported = time.perf_counter()
+threads = threading.active_count()
+_GAME_SERVER_MAIN.create_app()
+print(json.dumps([(imported - start) * 1000, (time.perf_counter() - imported) * 1000, threads]))
+"""
+
+def bench_startup(path: str):
+    """Холодный старт: импорт _GAME_SERVER_MAIN и create_app() в новом процессе (база уже создана)"""
+    print("\n📊 Cold start of _GAME_SERVER_MAIN (median of 5 processes)")
+    os.makedirs(path)
+    server_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for i in range(6):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, server_dir], cwd=path,
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    # Первый запуск создает базу и применяет миграции - в медиану не входит
+    runs = sorted(runs[1:])
+    import_ms, app_ms, threads = runs[len(runs) // 2]
+    print(f"  {'import _GAME_SERVER_MAIN':<40} {import_ms:9.1f} ms   threads after import: {threads}")
+    print(f"  {'create_app() (storage + workers)':<40} {app_ms:9.1f} ms")
+
+def bench_delete_bots(path: str):
+    """Очистка ботов после нагрузочного теста: delete_user на каждого против одного delete_users"""
+    print("\n📊 Delete 500 bots with lobby rows (ON DELETE CASCADE)")
+    database = make_database(path, users=0)
+    bots = [f"bot_{i}" for i in range(500)]
+
+    def create_bots():
+        for user_id in bots:
+            database.create_user({'user_id': user_id, 'nick_name': user_id, 'email': f"{user_id}@bench.local",
+                                  'password': "password", 'mmr': json.dumps([1000] * 6)})
+            database.create_lobby_user({'user_id': user_id, 'username': user_id})
+
+    def timed(delete) -> float:
+        create_bots()
+        start = time.perf_counter()
+        delete()
+        elapsed = time.perf_counter() - start
+        assert database.get_row_count('users') == 0 and database.get_row_count('lobby_users') == 0
+        return elapsed * 1_000_000
+
+    def per_user():
+        for user_id in bots:
+            database.delete_user(user_id)
+
+    print_result("delete 500 users", timed(per_user), timed(lambda: database.delete_users(bots)))
+    database.close()
+
+def bench_profiling(path: str):
+    """Цена профилирования: get_user и get_users без кэша с выключенным и включенным QueryProfiler"""
+    print("\n📊 QueryProfiler overhead (before: disabled, after: enabled)")
+    database = make_database(path, user_cache_size=0)
+    user_ids = [f"user_{n}" for n in range(20)]
+
+    def get_user(i):
+        database.get_user(f"user_{i % 100}")
+
+    def get_users(i):
+        database.get_users(user_ids)
+
+    for name, func in (("get_user", get_user), ("get_users x20", get_users)):
+        database.profiler.disable()
+        before = measure(func)
+        database.profiler.enable()
+        after = measure(func)
+        print(f"  {name:<40} disabled: {before:9.1f} us   enabled: {after:9.1f} us   +{after - before:5.1f} us")
+    database.close()
+
+def bench_backup(path: str):
+    """Онлайн-копия базы: длительность, скорость и задержка записей игры во время копии"""
+    print("\n📊 Online backup of 20000 users while a writer updates a player every 2 ms")
+    database = make_database(path, users=20000, user_cache_size=0)
+    backup_dir = os.path.join(os.path.dirname(path), "backups")
+
+    for name, pages in (("one step (pages=-1)", -1), ("steps of 256 pages", 256)):
+        latencies = []
+        stop = threading.Event()
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                database.update_user({'user_id': f"user_{i % 20000}", 'money': i})
+                latencies.append(time.perf_counter() - start)
+                i += 1
+                time.sleep(0.002)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        time.sleep(0.2)
+        report = database.backup(backup_dir, pages=pages)
+        stop.set()
+        thread.join()
+        latencies.sort()
+        print(f"  {name:<24} {report['bytes'] / 1_000_000:6.1f} MB in {report['duration_ms']:8.1f} ms "
+              f"({report['mb_per_s']:6.1f} MB/s)   restarts: {report['restarts']}   "
+              f"single step: {report['single_step']!s:<5}   write p99: {latencies[len(latencies) * 99 // 100] * 1000:5.2f} ms   "
+              f"max: {latencies[-1] * 1000:5.2f} ms")
+
+    report = database.backup(backup_dir, pages=256)
+    print(f"  {'steps of 256, idle':<24} {report['bytes'] / 1_000_000:6.1f} MB in {report['duration_ms']:8.1f} ms "
+          f"({report['mb_per_s']:6.1f} MB/s)   steps: {report['steps']}   max step: {report['max_step_ms']} ms")
+    database.close()
+
+def bench_retention(path: str):
+    """Очистка старых данных: матчи, завершенные finish_match и cancel_match, и их сессии удаляет run_retention"""
+    from datetime import datetime
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    import database
+    import match_endpoints
+    from match_endpoints import create_match_internal, finish_match, cancel_match
+    print("\n📊 Retention of ended matches: finish_match / cancel_match, then run_retention(days=0)")
+    cwd = os.getcwd()
+    os.makedirs(path)
+    os.chdir(path)  # глобальный db создается в текущей папке
+    try:
+        for backend in ('sqlite', 'memory'):
+            database.db.close()
+            storage = database.init_storage(backend)
+            players = [f"retention_{backend}_{i}" for i in range(4)]
+            for player in players:
+                storage.create_user({'user_id': player, 'nick_name': player, 'email': f"{player}@bench.local",
+                                     'password': "password"})
+            finished = create_match_internal({'match_type': '1v1', 'players': players[:2]})
+            cancelled = create_match_internal({'match_type': '1v1', 'players': players[2:]})
+            active = create_match_internal({'match_type': '1v1', 'players': players[:2]})
+            # Сессии игроков сервер не создает - их пишут внешние инструменты прямо в таблицу
+            sessions = [(match_id, player) for match_id, pair in ((finished, players[:2]), (cancelled, players[2:]),
+                                                                  (active, players[:2])) for player in pair]
+            if backend == 'sqlite':
+                with storage.connection() as conn:
+                    conn.executemany('INSERT INTO game_sessions (match_id, user_id) VALUES (?, ?)', sessions)
+                    conn.commit()
+            else:
+                storage._game_sessions.extend({'match_id': match_id, 'user_id': player, 'left_at': None}
+                                              for match_id, player in sessions)
+            with contextlib.redirect_stdout(io.StringIO()):
+                finish_match(finished, {'winners': players[:1], 'losers': players[1:2]})
+                cancel_match(cancelled)
+            for match_id in (finished, cancelled):
+                ended_at = storage.get_game(match_id)['ended_at']
+                assert ended_at and datetime.strptime(ended_at, '%Y-%m-%d %H:%M:%S'), (backend, ended_at)
+            time.sleep(1.1)  # ended_at хранится с точностью до секунды
+            report = storage.run_retention(days=0)
+            assert report['matches'] == 2 and report['game_sessions'] == 4, (backend, report)
+            assert not storage.get_game(finished) and not storage.get_game(cancelled) and storage.get_game(active)
+            print(f"  {backend:<40} purged {report['matches']} matches, {report['game_sessions']} sessions "
+                  f"in {report['duration_ms']:.1f} ms")
+    finally:
+        match_endpoints.matches_active.clear()
+        match_endpoints.matches_history.clear()
+        database.db.close()
+        os.chdir(cwd)
+
+def bench_records(path: str):
+    """Списки лобби и матчей: dict(row) на строку против записей records.py (время, память, блоки)"""
+    print("\n📊 Lobby/match pages of 1000 rows: dict rows (before) vs tuple records, use_records=True (after)")
+    database = make_database(path, users=1000, user_cache_size=0)
+    for i in range(1000):
+        database.create_lobby_user({'user_id': f"user_{i}", 'username': f"Player {i}"})
+        database.create_game({'match_id': f"match_{i}", 'name': f"Match {i}", 'status': 'finished',
+                              'players': json.dumps([f"user_{i}"])})
+
+    def retained(call):
+        """Память и количество блоков, которые держит результат call()"""
+        tracemalloc.start()
+        result = call()
+        size, _ = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+        del result
+        return size, blocks
+
+    def to_json(result):
+        return json.dumps(result, default=lambda record: record.to_dict())
+
+    cases = (("get_lobby_users(per_page=1000)", lambda: database.get_lobby_users(per_page=1000)),
+             ("get_matches(limit=1000)", lambda: database.get_matches(1000)))
+    for name, call in cases:
+        results = {}
+        for use_records in (False, True):
+            database.use_records = use_records
+            results[use_records] = (measure(lambda i: call(), 100), measure(lambda i: to_json(call()), 100),
+                                    *retained(call))
+        print_result(name, results[False][0], results[True][0])
+        print_result(f"{name} + json.dumps", results[False][1], results[True][1])
+        print(f"  {'  retained by result':<40} before: {results[False][2] / 1024:7.0f} KB / {results[False][3]:5} blocks   "
+              f"after: {results[True][2] / 1024:7.0f} KB / {results[True][3]:5} blocks")
+    database.close()
+
+def bench_matchmaking(path: str):
+    """Такт матчмейкера на больших очередях: сортировка списка и линейный поиск против индекса по MMR"""
+    import random
+    from datetime import datetime, timedelta
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    from queue_endpoints import QueueTicket, MATCH_TYPES, calculate_mmr_threshold, can_create_match
+    from matchmaking import TicketQueue
+
+    def legacy_can_create_match(tickets, match_type):
+        """Прежний can_create_match: сортировка всего списка и поиск вокруг одного самого старого билета"""
+        required_players = MATCH_TYPES[match_type]['players_required']
+        tickets.sort(key=lambda x: x.queue_ticket_register_time)
+        base_ticket = tickets[0]
+        base_threshold = calculate_mmr_threshold(base_ticket)
+        suitable_tickets = []
+        for ticket in tickets:
+            if len(suitable_tickets) >= required_players:
+                break
+            if abs(base_ticket.queue_ticket_player_mmr - ticket.queue_ticket_player_mmr) <= max(base_threshold, calculate_mmr_threshold(ticket)):
+                suitable_tickets.append(ticket)
+        return suitable_tickets if len(suitable_tickets) >= required_players else None
+
+    def spread(group):
+        mmrs = [ticket.queue_ticket_player_mmr for ticket in group]
+        return max(mmrs) - min(mmrs)
+
+    rng = random.Random(42)
+    now = datetime.now()
+    for count in (10_000, 50_000, 100_000):
+        print(f"\n📊 Matchmaker tick, {count} tickets: sorted list + linear scan (before) vs MMR index (after)")
+        # Билеты ставились в очередь за последние 2 минуты, MMR ~ N(1500, 300)
+        tickets = [QueueTicket(queue_ticket_id=f"ticket_{i}", queue_match_type=0, queue_player=f"user_{i}",
+                               queue_ticket_register_time=now - timedelta(seconds=120 * (count - i) / count),
+                               queue_ticket_player_mmr=int(rng.gauss(1500, 300)), queue_ticket_player_mmr_threshold=25)
+                   for i in range(count)]
+        shuffled = tickets[:]
+        rng.shuffle(shuffled)
+        legacy = shuffled[:]
+        queue = TicketQueue()
+        start = time.perf_counter()
+        for ticket in tickets:
+            queue.add(ticket)
+        print(f"  {'build index':<40} {(time.perf_counter() - start) * 1000:9.1f} ms")
+        for match_type in (0, 4):
+            name = MATCH_TYPES[match_type]['name']
+            iterations = 20 if count > 10_000 else 50
+            legacy[:] = shuffled
+            # первый такт сортирует перемешанный список, следующие - уже почти упорядоченный
+            first = measure(lambda i: legacy_can_create_match(legacy, match_type), 1)
+            before = measure(lambda i: legacy_can_create_match(legacy, match_type), iterations)
+            after = measure(lambda i: can_create_match(queue, match_type), iterations)
+            print_result(f"can_create_match {name} (first tick)", first, after)
+            print_result(f"can_create_match {name}", before, after)
+            print(f"  {'  MMR spread of the group':<40} before: {spread(legacy_can_create_match(legacy, match_type)):9}      "
+                  f"after: {spread(can_create_match(queue, match_type)):9}")
+        victims = rng.sample(tickets, 200)
+        before = measure(lambda i: legacy.remove(victims[i]), len(victims))
+        after = measure(lambda i: queue.remove(victims[i]), len(victims))
+        print_result("remove ticket", before, after)
+        before = measure(lambda i: legacy.append(victims[i]), len(victims))
+        after = measure(lambda i: queue.add(victims[i]), len(victims))
+        print_result("add ticket", before, after)
+
+def bench_queue_index(path: str):
+    """Вход, выход и статус игрока в очереди: перебор всех очередей против индекса player_id -> билет"""
+    import random
+    from datetime import datetime
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    import queue_endpoints
+    from queue_endpoints import QueueTicket, MATCH_TYPES, enqueue_ticket, dequeue_ticket
+    from database import init_storage
+    init_storage('memory')  # счетчик queue_users в enqueue_ticket/dequeue_ticket - без файла базы
+
+    def find_by_scan(lists, player_id):
+        """Прежний поиск: перебор билетов всех очередей"""
+        for tickets in lists.values():
+            for ticket in tickets:
+                if ticket.queue_player == player_id:
+                    return ticket
+        return None
+
+    rng = random.Random(42)
+    for count in (10_000, 100_000):
+        print(f"\n📊 Queue lookups, {count} tickets in {len(MATCH_TYPES)} queues: scan (before) vs player index (after)")
+        queue_endpoints.init_queues()
+        queue_endpoints.player_tickets.clear()
+        lists = {match_type: [] for match_type in MATCH_TYPES}
+        tickets = [QueueTicket(queue_ticket_id=f"ticket_{i}", queue_match_type=i % len(MATCH_TYPES), queue_player=f"user_{i}",
+                               queue_ticket_register_time=datetime.now(), queue_ticket_player_mmr=rng.randint(500, 2500),
+                               queue_ticket_player_mmr_threshold=25)
+                   for i in range(count)]
+        with queue_endpoints.queue_lock:
+            for ticket in tickets:
+                lists[ticket.queue_match_type].append(ticket)
+                enqueue_ticket(ticket)
+        players = [ticket.queue_player for ticket in rng.sample(tickets, 200)]
+        before = measure(lambda i: find_by_scan(lists, players[i]), len(players))
+        after = measure(lambda i: queue_endpoints.player_tickets.get(players[i]), len(players))
+        print_result("player status / duplicate check", before, after)
+        before = measure(lambda i: find_by_scan(lists, f"missing_{i}"), 20)
+        after = measure(lambda i: f"missing_{i}" in queue_endpoints.player_tickets, 20)
+        print_result("join check for a new player", before, after)
+
+        def leave_by_scan(i):
+            ticket = find_by_scan(lists, players[i])
+            lists[ticket.queue_match_type].remove(ticket)
+
+        before = measure(leave_by_scan, len(players))
+        after = measure(lambda i: dequeue_ticket(queue_endpoints.player_tickets[players[i]]), len(players))
+        print_result("leave queue", before, after)
+    queue_endpoints.init_queues()
+    queue_endpoints.player_tickets.clear()
+
+def bench_matchmaker_drain(path: str):
+    """Разбор всплеска 1000 игроков 1v1: один матч за такт против матчей до исчерпания групп и бюджета"""
+    import random
+    from datetime import datetime
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    import database
+    import queue_endpoints
+    import match_endpoints
+    from queue_endpoints import QueueTicket, enqueue_ticket, process_queue, start_queue_processor, commit_pending_matches
+    from matchmaking import MatchmakerStats
+    print("\n📊 Burst of 1000 queued 1v1 players: one match per tick (before) vs budgeted ticks (after)")
+    cwd = os.getcwd()
+    database.db.close()
+    os.chdir(os.path.dirname(path))  # глобальный db создается в текущей папке
+    database.init_storage('sqlite')
+    rng = random.Random(42)
+    counter = iter(range(10**9))
+
+    def enqueue_burst(players: int, mmr_spread: int = 500):
+        with queue_endpoints.queue_lock:
+            for _ in range(players):
+                i = next(counter)
+                enqueue_ticket(QueueTicket(queue_ticket_id=f"ticket_{i}", queue_match_type=0, queue_player=f"user_{i}",
+                                           queue_ticket_register_time=datetime.now(),
+                                           queue_ticket_player_mmr=1500 + rng.randint(-mmr_spread, mmr_spread),
+                                           queue_ticket_player_mmr_threshold=25))
+            queue_endpoints.dirty_match_types.clear()
+
+    try:
+        queue_endpoints.matchmaker_stats = MatchmakerStats()
+        enqueue_burst(1000)
+        start = time.perf_counter()
+        while process_queue([0]):
+            pass
+        drain_ms = (time.perf_counter() - start) * 1000
+        with contextlib.redirect_stdout(io.StringIO()):  # без строки "Created match" на каждый матч
+            commit_pending_matches()
+        stats = queue_endpoints.matchmaker_stats
+        print(f"  {'matches formed':<40} {stats.matches:9}   left in queue: {len(queue_endpoints.queues[0])}")
+        print(f"  {'drain time':<40} before: ~{stats.matches * queue_endpoints.QUEUE_TICK_INTERVAL:7.0f} s   "
+              f"after: {drain_ms:9.1f} ms in {stats.ticks} ticks (max {stats.max_tick_matches} matches, "
+              f"{stats.max_tick_ms:.1f} ms per tick)")
+
+        # Задержка от постановки второго игрока до матча: такт по таймеру против пробуждения по событию
+        with queue_endpoints.queue_lock:
+            for ticket in list(queue_endpoints.queues[0]):
+                queue_endpoints.dequeue_ticket(ticket)
+        start_queue_processor()
+        time.sleep(0.1)
+        latencies = []
+        for _ in range(20):
+            start = time.perf_counter()
+            with queue_endpoints.queue_lock:
+                i = next(counter)
+                for player in range(2):
+                    enqueue_ticket(QueueTicket(queue_ticket_id=f"ticket_{i}_{player}", queue_match_type=0,
+                                               queue_player=f"user_{i}_{player}", queue_ticket_register_time=datetime.now(),
+                                               queue_ticket_player_mmr=1500, queue_ticket_player_mmr_threshold=25))
+            with contextlib.redirect_stdout(io.StringIO()):
+                while queue_endpoints.player_tickets:
+                    time.sleep(0.0005)
+                latencies.append((time.perf_counter() - start) * 1000)
+                queue_endpoints.match_commit_queue.join()
+        print(f"  {'enqueue -> match latency':<40} before: ~{queue_endpoints.QUEUE_TICK_INTERVAL * 500:6.0f} ms avg   "
+              f"after: {sum(latencies) / len(latencies):7.1f} ms avg, {max(latencies):.1f} ms max")
+    finally:
+        match_endpoints.matches_active.clear()
+        database.db.close()
+        os.chdir(cwd)
+
+def bench_grouping(path: str):
+    """Стратегии группировки на синтетической очереди: разброс MMR в матче, ожидание и время поиска"""
+    import random
+    from datetime import datetime, timedelta
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    from queue_endpoints import QueueTicket, MATCH_TYPES, calculate_mmr_threshold
+    from matchmaking import TicketQueue, GROUPING_STRATEGIES
+
+    def percentile(values, fraction):
+        return sorted(values)[int(fraction * (len(values) - 1))] if values else 0
+
+    def simulate(grouping, match_type: int, arrivals_per_second: float, seconds: int = 300):
+        """Очередь на виртуальных часах: игроки приходят каждую секунду, MMR ~ N(1500, 300),
+        на такте создаются все матчи, которые находит стратегия"""
+        rng = random.Random(42)
+        size = MATCH_TYPES[match_type]['players_required']
+        queue = TicketQueue()
+        start = datetime(2025, 1, 1)
+        spreads, waits = [], []
+        search = 0.0
+        for second in range(1, seconds + 1):
+            now = start + timedelta(seconds=second)
+            arrivals = int(arrivals_per_second) + (rng.random() < arrivals_per_second % 1)
+            for offset in sorted(rng.random() for _ in range(arrivals)):
+                queue.add(QueueTicket(queue_ticket_id=f"ticket_{second}_{offset}", queue_match_type=match_type,
+                                      queue_player=f"user_{second}_{offset}",
+                                      queue_ticket_register_time=now - timedelta(seconds=1 - offset),
+                                      queue_ticket_player_mmr=int(rng.gauss(1500, 300)),
+                                      queue_ticket_player_mmr_threshold=25))
+            failed = set()
+            while True:
+                began = time.perf_counter()
+                group = grouping(queue, size, lambda ticket: calculate_mmr_threshold(ticket, now), None, failed)
+                search += time.perf_counter() - began
+                if not group:
+                    break
+                mmrs = [ticket.queue_ticket_player_mmr for ticket in group]
+                spreads.append(max(mmrs) - min(mmrs))
+                for ticket in group:
+                    waits.append((now - ticket.queue_ticket_register_time).total_seconds())
+                    queue.remove(ticket)
+        return {
+            'matches': len(spreads),
+            'spread': (sum(spreads) / max(len(spreads), 1), percentile(spreads, 0.95), max(spreads, default=0)),
+            'wait': (sum(waits) / max(len(waits), 1), percentile(waits, 0.95)),
+            'left': len(queue),
+            'search_us': search / max(len(spreads), 1) * 1_000_000,
+        }
+
+    def check_requeued():
+        """Билеты несохраненного матча возвращаются в очередь с прежним временем постановки: свежий билет
+        (порог 25), поставленный, пока матч сохранялся, не должен ограничивать поиск для них (порог 100)"""
+        now = datetime(2025, 1, 1, 12)
+
+        def ticket(name: str, mmr: int, waited: int):
+            return QueueTicket(queue_ticket_id=f"ticket_{name}", queue_match_type=0, queue_player=f"user_{name}",
+                               queue_ticket_register_time=now - timedelta(seconds=waited),
+                               queue_ticket_player_mmr=mmr, queue_ticket_player_mmr_threshold=25)
+
+        requeued = [ticket('old_1', 1500, 300), ticket('old_2', 1560, 300)]
+        for grouping in GROUPING_STRATEGIES.values():
+            queue = TicketQueue()
+            for old in requeued:
+                queue.add(old)
+            for old in requeued:  # матч собран - билеты уходят из очереди
+                queue.remove(old)
+            queue.add(ticket('fresh', 3000, 0))
+            for old in requeued:  # сохранить матч не удалось - commit_match возвращает билеты
+                queue.add(old)
+            group = grouping(queue, 2, lambda item: calculate_mmr_threshold(item, now))
+            assert group is not None and {item.queue_ticket_id for item in group} == {old.queue_ticket_id for old in requeued}, \
+                grouping.__name__
+        print("\n✅ Re-queued tickets (waited 300 s, MMR gap 60) behind a fresh ticket are matched by every strategy")
+
+    check_requeued()
+    for match_type, rate in ((0, 2), (0, 50), (4, 20), (4, 200)):
+        name = MATCH_TYPES[match_type]['name']
+        print(f"\n📊 Grouping strategies, {name}, {rate} players/s for 300 s (virtual clock)")
+        print(f"  {'strategy':<10}{'matches':>8}{'spread avg/p95/max':>22}{'wait avg/p95 s':>18}{'left':>7}{'search us/match':>17}")
+        for strategy, grouping in GROUPING_STRATEGIES.items():
+            result = simulate(grouping, match_type, rate)
+            spread = "/".join(f"{value:.0f}" for value in result['spread'])
+            wait = "/".join(f"{value:.1f}" for value in result['wait'])
+            print(f"  {strategy:<10}{result['matches']:>8}{spread:>22}{wait:>18}{result['left']:>7}{result['search_us']:>17.1f}")
+
+def bench_match_commit(path: str):
+    """queue_lock во время разбора 1000 игроков: сохранение матчей под блокировкой против конвейера сохранения"""
+    import random
+    import uuid
+    from datetime import datetime
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'end_points'))
+    import database
+    import queue_endpoints
+    import match_endpoints
+    from queue_endpoints import (QueueTicket, MatchProposal, enqueue_ticket, dequeue_ticket, can_create_match,
+                                 create_match_from_tickets, process_queue, commit_pending_matches, queue_lock)
+    print("\n📊 queue_lock while 1000 queued 1v1 players are matched (SQLite): persist under lock (before) vs commit pipeline (after)")
+    cwd = os.getcwd()
+    database.db.close()
+    os.chdir(os.path.dirname(path))  # глобальный db создается в текущей папке
+    database.init_storage('sqlite')
+    rng = random.Random(42)
+
+    def enqueue_burst(prefix: str, players: int = 1000):
+        with queue_lock:
+            for i in range(players):
+                enqueue_ticket(QueueTicket(queue_ticket_id=f"{prefix}_ticket_{i}", queue_match_type=0,
+                                           queue_player=f"{prefix}_user_{i}", queue_ticket_register_time=datetime.now(),
+                                           queue_ticket_player_mmr=1500 + rng.randint(-500, 500),
+                                           queue_ticket_player_mmr_threshold=25))
+            queue_endpoints.dirty_match_types.clear()
+
+    def legacy_process_queue() -> bool:
+        """Прежний такт: матч сохраняется в базу, пока queue_lock захвачен"""
+        deadline = time.perf_counter() + queue_endpoints.QUEUE_TICK_BUDGET
+        with queue_lock:
+            tickets = queue_endpoints.queues[0]
+            failed = set()
+            while tickets:
+                match_tickets = can_create_match(tickets, 0, deadline, failed)
+                if not match_tickets:
+                    return time.perf_counter() >= deadline
+                create_match_from_tickets(MatchProposal(match_id=str(uuid.uuid4()), match_type=0, tickets=match_tickets))
+                for ticket in match_tickets:
+                    dequeue_ticket(ticket)
+                if time.perf_counter() >= deadline:
+                    return True
+        return False
+
+    def run(tick, prefix: str):
+        """Такты до разбора очереди; параллельно поток, которому queue_lock нужен как запросу статуса/входа"""
+        enqueue_burst(prefix)
+        holds, waits = [], []
+        done = threading.Event()
+
+        def contender():
+            while not done.is_set():
+                start = time.perf_counter()
+                with queue_lock:
+                    waits.append(time.perf_counter() - start)
+                time.sleep(0.001)
+
+        def committer():
+            while not done.is_set() or not queue_endpoints.match_commit_queue.empty():
+                commit_pending_matches()
+                time.sleep(0.001)
+
+        threads = [threading.Thread(target=contender), threading.Thread(target=committer)]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            while True:
+                began = time.perf_counter()
+                more = tick()
+                holds.append(time.perf_counter() - began)
+                if not more:
+                    break
+            done.set()
+            for thread in threads:
+                thread.join()
+        total = time.perf_counter() - start
+        waits.sort()
+        return {
+            'hold_total_ms': sum(holds) * 1000, 'hold_max_ms': max(holds) * 1000, 'ticks': len(holds),
+            'wait_p99_ms': waits[int(0.99 * (len(waits) - 1))] * 1000, 'wait_max_ms': waits[-1] * 1000,
+            'persisted_ms': total * 1000,
+        }
+
+    try:
+        before = run(legacy_process_queue, "legacy")
+        after = run(lambda: process_queue([0]), "pipeline")
+        for key, label in (('hold_total_ms', 'queue_lock held, total'), ('hold_max_ms', 'queue_lock held, longest tick'),
+                           ('wait_p99_ms', 'lock wait of another request, p99'), ('wait_max_ms', 'lock wait of another request, max'),
+                           ('persisted_ms', 'all matches persisted')):
+            print(f"  {label:<40} before: {before[key]:9.1f} ms   after: {after[key]:9.1f} ms")
+        print(f"  {'ticks':<40} before: {before['ticks']:9}      after: {after['ticks']:9}")
+    finally:
+        with queue_lock:
+            for ticket in list(queue_endpoints.queues[0]):
+                dequeue_ticket(ticket)
+        match_endpoints.matches_active.clear()
+        database.db.close()
+        os.chdir(cwd)
+
+BENCHMARKS = {
+    'pool': bench_pool,
+    'group_commit': bench_group_commit,
+    'user_cache': bench_user_cache,
+    'server_stats': bench_server_stats,
+    'bulk_users': bench_bulk_users,
+    'returning': bench_returning,
+    'wal': bench_wal_readers,
+    'shards': bench_shards,
+    'backends': bench_backends,
+    'startup': bench_startup,
+    'delete_bots': bench_delete_bots,
+    'profiling': bench_profiling,
+    'backup': bench_backup,
+    'retention': bench_retention,
+    'records': bench_records,
+    'matchmaking': bench_matchmaking,
+    'queue_index': bench_queue_index,
+    'grouping': bench_grouping,
+    'match_commit': bench_match_commit,
+    'matchmaker_drain': bench_matchmaker_drain,  # запускает потоки обработчика очередей - последним
+}
+
+def main():
+    if sys.argv[1:] == ['--app-requests']:
+        run_app_requests()
+    selected = sys.argv[1:] or list(BENCHMARKS.keys())
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in selected:
+            if name not in BENCHMARKS:
+                print(f"❌ Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+                continue
+            BENCHMARKS[name](os.path.join(tmp, f"bench_{name}.db"))
+
+if __name__ == "__main__":
+    main()
@@ -17,19 +17,29 @@ def get_server_status():
             "environment": "production",
             "url": "https://renderfin.com"
         },
-        "stats": stats
+        "stats": stats,
+        "user_cache": db.user_cache.stats()
     })
 
 @lobby_bp.route('/users', methods=['GET'])
 def get_lobby_users():
-    """Возвращает список пользователей в лобби с пагинацией"""
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 1000))
+    """Возвращает список пользователей в лобби с пагинацией (cursor - next_cursor предыдущей страницы)"""
+    page = request.args.get('page', '1')
+    per_page = request.args.get('per_page', '1000')
+    cursor = request.args.get('cursor')
+    include_total = request.args.get('include_total', 'true').lower() != 'false'
+    
+    # Номер страницы - от 1, размер страницы - от 1 до 1000
+    if not page.isdigit() or int(page) < 1:
+        return jsonify({"status": "error", "message": "page must be a positive integer"}), 400
+    if not per_page.isdigit() or not 1 <= int(per_page) <= 1000:
+        return jsonify({"status": "error", "message": "per_page must be an integer from 1 to 1000"}), 400
+    page, per_page = int(page), int(per_page)
     
-    # Ограничиваем размер страницы
-    per_page = min(per_page, 1000)
-    
-    users_data = db.get_lobby_users(page, per_page)
+    try:
+        users_data = db.get_lobby_users(page, per_page, cursor=cursor, include_total=include_total)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     return jsonify({
         "status": "success",
         "data": users_data
@@ -156,3 +166,46 @@ def leave_lobby():
         "message": "Left lobby successfully",
         "user": deleted_user
     })
+
+@lobby_bp.route('/db-profile', methods=['GET'])
+def get_db_profile():
+    """Профиль слоя базы данных: время методов и запросов, открытия соединений, медленные запросы"""
+    if not verify_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    limit = request.args.get('limit')
+    if limit is not None and not limit.isdigit():
+        return jsonify({"status": "error", "message": "limit must be a non-negative integer"}), 400
+    return jsonify({
+        "status": "success",
+        "profile": db.profiler.snapshot(int(limit) if limit else None)
+    })
+
+@lobby_bp.route('/db-profile', methods=['POST'])
+def configure_db_profile():
+    """Включает/выключает профилирование базы данных: {"enabled": true, "slow_query_ms": 20, "reset": true}"""
+    if not verify_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    data = request.get_json() or {}
+    
+    # Порог сравнивается со временем каждого запроса: строка или отрицательное число сломали бы все запросы
+    slow_query_ms = data.get('slow_query_ms')
+    if slow_query_ms is not None and (isinstance(slow_query_ms, bool) or not isinstance(slow_query_ms, (int, float))
+                                      or slow_query_ms < 0):
+        return jsonify({"status": "error", "message": "slow_query_ms must be a non-negative number"}), 400
+    
+    if data.get('reset'):
+        db.profiler.reset()
+    if data.get('enabled') is True:
+        db.profiler.enable(slow_query_ms)
+    elif data.get('enabled') is False:
+        db.profiler.disable()
+    elif slow_query_ms is not None:
+        db.profiler.slow_query_ms = slow_query_ms
+    
+    return jsonify({
+        "status": "success",
+        "enabled": db.profiler.enabled,
+        "slow_query_ms": db.profiler.slow_query_ms
+    })
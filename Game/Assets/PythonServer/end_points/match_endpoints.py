@@ -41,7 +41,7 @@
 
 from flask import Blueprint, request, jsonify
 from static import verify_admin_token
-from database import db
+from database import db, sqlite_timestamp
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field
 from typing import List, Any, Optional, Dict
@@ -101,9 +101,13 @@ matches_active: Dict[str, Match] = {}
 matches_history: Dict[str, Match] = {}
 matches_lock = threading.Lock()
 
-def create_match_internal(match_data: dict) -> str:
-    """Внутренняя функция для создания матча (используется системой очередей)"""
-    match_id = str(uuid.uuid4())
+def create_match_internal(match_data: dict, match_id: Optional[str] = None) -> str:
+    """Внутренняя функция для создания матча (используется системой очередей).
+    
+    Ошибка сохранения в базу пробрасывается: конвейер сохранения очереди повторяет попытку
+    с тем же match_id.
+    """
+    match_id = match_id or str(uuid.uuid4())
     
     match = Match(
         match_id=match_id,
@@ -129,6 +133,9 @@ def create_match_internal(match_data: dict) -> str:
         })
     except Exception as e:
         print(f"Error saving match to database: {e}")
+        with matches_lock:
+            matches_active.pop(match_id, None)
+        raise
     
     return match_id
 
@@ -153,26 +160,17 @@ def finish_match(match_id: str, result_data: dict):
         del matches_active[match_id]
         
         # Обновляем данные игроков
-        for player_id in match.players:
-            try:
-                user = db.get_user(player_id)
-                if user:
-                    profile_data = json.loads(user.get('profile_data', '{}'))
-                    profile_data['match_current'] = None
-                    
-                    db.update_user({
-                        'user_id': player_id,
-                        'profile_data': json.dumps(profile_data)
-                    })
-            except Exception as e:
-                print(f"Error updating player {player_id}: {e}")
+        try:
+            db.update_users([{'user_id': player_id, 'match_current': None} for player_id in match.players])
+        except Exception as e:
+            print(f"Error updating players {match.players}: {e}")
         
         # Обновляем в базе данных
         try:
             db.update_game({
                 'match_id': match_id,
                 'status': 'finished',
-                'ended_at': match.end_time.isoformat()
+                'ended_at': sqlite_timestamp(match.end_time)
             })
         except Exception as e:
             print(f"Error updating match in database: {e}")
@@ -195,25 +193,17 @@ def cancel_match(match_id: str, reason: str = "timeout"):
         del matches_active[match_id]
         
         # Обновляем данные игроков
-        for player_id in match.players:
-            try:
-                user = db.get_user(player_id)
-                if user:
-                    profile_data = json.loads(user.get('profile_data', '{}'))
-                    profile_data['match_current'] = None
-                    
-                    db.update_user({
-                        'user_id': player_id,
-                        'profile_data': json.dumps(profile_data)
-                    })
-            except Exception as e:
-                print(f"Error updating player {player_id}: {e}")
+        try:
+            db.update_users([{'user_id': player_id, 'match_current': None} for player_id in match.players])
+        except Exception as e:
+            print(f"Error updating players {match.players}: {e}")
         
         # Обновляем в базе данных
         try:
             db.update_game({
                 'match_id': match_id,
-                'status': 'cancelled'
+                'status': 'cancelled',
+                'ended_at': sqlite_timestamp(match.end_time)
             })
         except Exception as e:
             print(f"Error updating match in database: {e}")
@@ -238,20 +228,24 @@ def check_match_timeouts():
         for match_id in matches_to_cancel:
             cancel_match(match_id, "timeout")
 
-# Запускаем проверку таймаутов каждые 30 секунд
-def start_timeout_checker():
-    """Запускает проверку таймаутов матчей"""
+checker_thread: Optional[threading.Thread] = None
+
+# Проверка таймаутов каждые 30 секунд; запускается явно из create_app(), не при импорте модуля
+def start_timeout_checker() -> threading.Thread:
+    """Запускает проверку таймаутов матчей (повторный вызов возвращает уже запущенный поток)"""
+    global checker_thread
+    
     def run_checker():
         import time
         while True:
             check_match_timeouts()
             time.sleep(30)
     
-    checker_thread = threading.Thread(target=run_checker, daemon=True)
-    checker_thread.start()
-
-# Запускаем проверку при загрузке модуля
-start_timeout_checker()
+    with matches_lock:
+        if checker_thread is None:
+            checker_thread = threading.Thread(target=run_checker, name="match-timeouts", daemon=True)
+            checker_thread.start()
+    return checker_thread
 
 @match_bp.route('/', methods=['GET'])
 def get_matches():
@@ -295,6 +289,26 @@ def get_matches():
         "total_history": len(history_matches)
     })
 
+@match_bp.route('/list', methods=['GET'])
+def list_matches():
+    """Возвращает сохраненные в базе матчи с keyset-пагинацией (cursor - next_cursor предыдущей страницы)"""
+    limit = request.args.get('limit', '100')
+    cursor = request.args.get('cursor')
+    include_total = request.args.get('include_total', 'true').lower() != 'false'
+    
+    if not limit.isdigit() or not 1 <= int(limit) <= 1000:
+        return jsonify({"status": "error", "message": "limit must be an integer from 1 to 1000"}), 400
+    limit = int(limit)
+    
+    try:
+        matches_data = db.get_matches(limit, cursor=cursor, include_total=include_total)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({
+        "status": "success",
+        "data": matches_data
+    })
+
 @match_bp.route('/', methods=['POST'])
 def create_match():
     """Создает новый матч"""
@@ -310,9 +324,9 @@ def create_match():
         return jsonify({"status": "error", "message": "Invalid match type"}), 400
     
     # Проверяем, что все игроки существуют
+    users = db.get_users(data['players'])
     for player_id in data['players']:
-        user = db.get_user(player_id)
-        if not user:
+        if player_id not in users:
             return jsonify({"status": "error", "message": f"Player {player_id} not found"}), 404
     
     try:
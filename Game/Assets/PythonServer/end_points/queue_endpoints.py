@@ -55,9 +55,11 @@ import json
 import time
 import threading
 from datetime import datetime, timedelta
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+from queue import Queue
 from database import db
+from matchmaking import GROUPING_STRATEGIES, MatchmakerStats, TicketQueue
 import uuid
 
 queue_bp = Blueprint('queue', __name__)
@@ -70,6 +72,13 @@ all_mmr_min_limit_threshold = 25 # минимальная разница для
 all_mmr_time_in_seconds_to_raise_threshold = 10 # время в секундах для повышения порога
 all_mmr_raise_threshold_step = 0.1 # шаг повышения порога в процентах при превышенииmmr_time_in_seconds_to_raise_threshold в ожидании очереди на матч
 
+# Обработчик очередей
+QUEUE_TICK_INTERVAL = 1.0 # такт по таймеру, секунды: пороги MMR растут со временем ожидания
+QUEUE_TICK_BUDGET = 0.05 # время на один такт под queue_lock, секунды; если такт собрал матчи, следующий - сразу же
+queue_grouping_strategy = 'anchor' # как собирать группу из очереди - ключ matchmaking.GROUPING_STRATEGIES; 'window' - по выбору (уже разброс, но для 5v5 больше ожидание)
+MATCH_COMMIT_RETRIES = 3 # попыток сохранить матч; после последней игроки возвращаются в очередь
+MATCH_COMMIT_RETRY_DELAY = 0.2 # пауза перед повтором сохранения, секунды (вдвое больше с каждой попыткой)
+
 # Типы матчей и их требования
 MATCH_TYPES = {
     0: {'name': '1v1', 'players_required': 2},
@@ -95,32 +104,78 @@ class QueueTicket:
         if isinstance(self.queue_ticket_register_time, str):
             self.queue_ticket_register_time = datetime.fromisoformat(self.queue_ticket_register_time)
 
-# Глобальное хранилище очередей в памяти
-queues: Dict[int, List[QueueTicket]] = {}
+@dataclass
+class MatchProposal:
+    """Матч, собранный обработчиком очередей и ожидающий сохранения"""
+    match_id: str
+    match_type: int
+    tickets: List[QueueTicket]
+    proposed_at: datetime = field(default_factory=datetime.now)
+    game_saved: bool = False  # шаги сохранения, уже выполненные до ошибки, при повторе пропускаются
+    players_updated: bool = False
+    
+    @property
+    def players(self) -> List[str]:
+        return [ticket.queue_player for ticket in self.tickets]
+
+# Глобальное хранилище очередей в памяти: по типу матча - билеты в порядке ожидания и индекс по MMR
+queues: Dict[int, TicketQueue] = {}
+# Индекс player_id -> билет по всем очередям (игрок стоит не больше чем в одной очереди)
+player_tickets: Dict[str, QueueTicket] = {}
 queue_lock = threading.Lock()
+# Постановка билета будит обработчик, не дожидаясь такта по таймеру
+queue_condition = threading.Condition(queue_lock)
+# Типы матчей, в которые ставились билеты с прошлого такта
+dirty_match_types: Set[int] = set()
+# По типу матча - queue_ticket_id билетов без группы в проходе по очереди, который прервал бюджет такта:
+# следующий такт продолжает проход, а не начинает его заново; очищается, когда проход дошел до конца
+scan_failed: Dict[int, Set[str]] = {}
 queue_processor_running = False
+matchmaker_stats = MatchmakerStats()
+
+# Конвейер сохранения: обработчик под queue_lock только собирает матчи (MatchProposal),
+# поток match-committer по одному в порядке создания сохраняет их в базу
+match_commit_queue: "Queue[MatchProposal]" = Queue()
+# player_id -> матч, который собран, но еще не сохранен (под queue_lock; читается без него)
+pending_matches: Dict[str, MatchProposal] = {}
 
 def init_queues():
     """Инициализация очередей"""
     global queues
     for match_type in MATCH_TYPES.keys():
-        queues[match_type] = []
+        queues[match_type] = TicketQueue()
+    scan_failed.clear()
+
+def enqueue_ticket(ticket: QueueTicket) -> bool:
+    """Ставит билет в очередь его типа матча (False, если игрок уже в очереди). Вызывается под queue_lock"""
+    if ticket.queue_player in player_tickets:
+        return False
+    player_tickets[ticket.queue_player] = ticket
+    queues[ticket.queue_match_type].add(ticket)
+    db.counters.add('queue_users')
+    dirty_match_types.add(ticket.queue_match_type)
+    queue_condition.notify()
+    return True
+
+def dequeue_ticket(ticket: QueueTicket) -> bool:
+    """Убирает билет из очереди и индекса игроков (False, если билета там уже нет). Вызывается под queue_lock"""
+    if not queues[ticket.queue_match_type].remove(ticket):
+        return False
+    if player_tickets.get(ticket.queue_player) is ticket:
+        del player_tickets[ticket.queue_player]
+    db.counters.add('queue_users', -1)
+    return True
 
 def get_player_mmr(player_id: str, match_type: int) -> int:
     """Получает MMR игрока для определенного типа матча"""
-    user = db.get_user(player_id)
-    if not user:
+    mmr = db.get_user_mmr(player_id, match_type)
+    if mmr is None:
         return 1000  # Начальный рейтинг по умолчанию
-    
-    try:
-        mmr_list = json.loads(user.get('mmr', '[1000, 1000, 1000, 1000, 1000, 1000]'))
-        return mmr_list[match_type] if match_type < len(mmr_list) else 1000
-    except:
-        return 1000
+    return mmr
 
-def calculate_mmr_threshold(ticket: QueueTicket) -> int:
-    """Рассчитывает текущий порог MMR для билета"""
-    time_in_queue = (datetime.now() - ticket.queue_ticket_register_time).total_seconds()
+def calculate_mmr_threshold(ticket: QueueTicket, now: Optional[datetime] = None) -> int:
+    """Рассчитывает текущий порог MMR для билета (на момент now, по умолчанию - сейчас)"""
+    time_in_queue = ((now or datetime.now()) - ticket.queue_ticket_register_time).total_seconds()
     
     if time_in_queue <= all_mmr_time_in_seconds_to_raise_threshold:
         return all_mmr_min_limit_threshold
@@ -131,120 +186,196 @@ def calculate_mmr_threshold(ticket: QueueTicket) -> int:
     
     return int(threshold)
 
-def can_create_match(tickets: List[QueueTicket], match_type: int) -> Optional[List[QueueTicket]]:
-    """Проверяет, можно ли создать матч из билетов"""
+def can_create_match(tickets: TicketQueue, match_type: int, deadline: Optional[float] = None,
+                     failed: Optional[Set[str]] = None) -> Optional[List[QueueTicket]]:
+    """Проверяет, можно ли создать матч из билетов (deadline и failed - см. matchmaking.GroupingStrategy)"""
     required_players = MATCH_TYPES[match_type]['players_required']
     
     if len(tickets) < required_players:
         return None
     
-    # Сортируем билеты по времени создания (приоритет у тех, кто дольше ждет)
-    tickets.sort(key=lambda x: x.queue_ticket_register_time)
-    
-    # Берем первый билет как основу для поиска
-    base_ticket = tickets[0]
-    base_mmr = base_ticket.queue_ticket_player_mmr
-    base_threshold = calculate_mmr_threshold(base_ticket)
-    
-    # Находим подходящих игроков
-    suitable_tickets = []
-    for ticket in tickets:
-        if len(suitable_tickets) >= required_players:
-            break
-        
-        ticket_mmr = ticket.queue_ticket_player_mmr
-        ticket_threshold = calculate_mmr_threshold(ticket)
-        
-        # Проверяем, подходит ли игрок по MMR
-        mmr_diff = abs(base_mmr - ticket_mmr)
-        if mmr_diff <= max(base_threshold, ticket_threshold):
-            suitable_tickets.append(ticket)
-    
-    if len(suitable_tickets) >= required_players:
-        return suitable_tickets[:required_players]
-    
-    return None
+    # Пороги всех билетов считаем на один момент времени
+    now = datetime.now()
+    grouping = GROUPING_STRATEGIES[queue_grouping_strategy]
+    return grouping(tickets, required_players, lambda ticket: calculate_mmr_threshold(ticket, now), deadline, failed)
 
-def create_match_from_tickets(tickets: List[QueueTicket], match_type: int) -> str:
-    """Создает матч из билетов"""
+def create_match_from_tickets(proposal: MatchProposal) -> str:
+    """Сохраняет матч и данные игроков (ошибки пробрасываются; при повторе выполненные шаги пропускаются)"""
     from match_endpoints import create_match_internal
     
     # Создаем матч
-    match_data = {
-        'match_type': MATCH_TYPES[match_type]['name'],
-        'players': [ticket.queue_player for ticket in tickets],
-        'status': 'starting'
-    }
-    
-    match_id = create_match_internal(match_data)
+    if not proposal.game_saved:
+        match_data = {
+            'match_type': MATCH_TYPES[proposal.match_type]['name'],
+            'players': proposal.players,
+            'status': 'starting'
+        }
+        create_match_internal(match_data, proposal.match_id)
+        proposal.game_saved = True
     
     # Обновляем данные игроков
+    if not proposal.players_updated:
+        db.update_users([{
+            'user_id': player_id,
+            'match_current': proposal.match_id,
+            'queue_ticket_id': None
+        } for player_id in proposal.players])
+        proposal.players_updated = True
+    
+    return proposal.match_id
+
+def propose_match(tickets: List[QueueTicket], match_type: int) -> MatchProposal:
+    """Убирает билеты из очереди и ставит матч в конвейер сохранения. Вызывается под queue_lock"""
+    proposal = MatchProposal(match_id=str(uuid.uuid4()), match_type=match_type, tickets=tickets)
     for ticket in tickets:
+        dequeue_ticket(ticket)
+        pending_matches[ticket.queue_player] = proposal
+    match_commit_queue.put(proposal)
+    return proposal
+
+def commit_match(proposal: MatchProposal) -> bool:
+    """Сохраняет собранный матч с повторами. False - сохранить не удалось, игроки возвращены в очередь"""
+    for attempt in range(1, MATCH_COMMIT_RETRIES + 1):
         try:
-            user = db.get_user(ticket.queue_player)
-            if user:
-                profile_data = json.loads(user.get('profile_data', '{}'))
-                profile_data['match_current'] = match_id
-                profile_data['queue_ticket_id'] = None
-                
-                db.update_user({
-                    'user_id': ticket.queue_player,
-                    'profile_data': json.dumps(profile_data)
-                })
+            create_match_from_tickets(proposal)
+            break
         except Exception as e:
-            print(f"Error updating player {ticket.queue_player}: {e}")
+            print(f"Error saving match {proposal.match_id} (attempt {attempt}/{MATCH_COMMIT_RETRIES}): {e}")
+            matchmaker_stats.commit_retries += 1
+            if attempt < MATCH_COMMIT_RETRIES:
+                time.sleep(MATCH_COMMIT_RETRY_DELAY * 2 ** (attempt - 1))
+    else:
+        matchmaker_stats.commit_failures += 1
+        if proposal.game_saved:
+            try:
+                db.delete_game(proposal.match_id)
+            except Exception as e:
+                print(f"Error deleting unsaved match {proposal.match_id}: {e}")
+            from match_endpoints import matches_active, matches_lock
+            with matches_lock:
+                matches_active.pop(proposal.match_id, None)
+        # Билеты возвращаются с прежним временем постановки (и порогом MMR) на свое место в порядке ожидания
+        with queue_lock:
+            for ticket in proposal.tickets:
+                pending_matches.pop(ticket.queue_player, None)
+                enqueue_ticket(ticket)
+        return False
     
-    return match_id
+    with queue_lock:
+        for player_id in proposal.players:
+            if pending_matches.get(player_id) is proposal:
+                del pending_matches[player_id]
+    matchmaker_stats.committed += 1
+    matchmaker_stats.commit_lag_ms = (datetime.now() - proposal.proposed_at).total_seconds() * 1000
+    print(f"Created match {proposal.match_id} for {len(proposal.tickets)} players")
+    return True
 
-def process_queue():
-    """Обрабатывает очередь на создание матчей"""
+def commit_pending_matches() -> int:
+    """Сохраняет в текущем потоке все матчи из конвейера (когда match-committer не запущен: тесты, инструменты)"""
+    committed = 0
+    while not match_commit_queue.empty():
+        committed += commit_match(match_commit_queue.get())
+        match_commit_queue.task_done()
+    return committed
+
+def process_queue(match_types: Optional[Iterable[int]] = None, budget: float = QUEUE_TICK_BUDGET, event: bool = False) -> bool:
+    """Обрабатывает очередь на создание матчей: создает матчи, пока есть подходящие группы и не исчерпан бюджет такта.
+    
+    match_types - только эти типы матчей (по умолчанию все). Возвращает True, если такт
+    собрал матчи, но бюджет кончился раньше, чем группы, - тогда следующий такт нужен сразу.
+    Такт без матчей возвращает False, даже если проход по очереди не закончен: его продолжит
+    такт по таймеру или постановке билета, а не немедленный повтор под queue_lock.
+    """
     global queue_processor_running
     
     if queue_processor_running:
-        return
+        return False
     
     queue_processor_running = True
+    started = time.perf_counter()
+    deadline = started + budget
+    matches = 0
+    exhausted = False
     
     try:
         with queue_lock:
-            for match_type, tickets in queues.items():
-                if not tickets:
-                    continue
-                
-                # Пытаемся создать матч
-                match_tickets = can_create_match(tickets, match_type)
-                if match_tickets:
-                    # Создаем матч
-                    match_id = create_match_from_tickets(match_tickets, match_type)
+            for match_type in (match_types if match_types is not None else list(queues)):
+                tickets = queues[match_type]
+                failed = scan_failed.setdefault(match_type, set())
+                while tickets:
+                    # Пытаемся создать матч
+                    match_tickets = can_create_match(tickets, match_type, deadline, failed)
+                    if not match_tickets:
+                        # поиск мог прерваться по бюджету - тогда досмотрим с того же места на следующем такте,
+                        # иначе проход закончен и следующий проверит все билеты заново (пороги выросли)
+                        exhausted = time.perf_counter() >= deadline
+                        if not exhausted:
+                            failed.clear()
+                        break
                     
-                    # Удаляем билеты из очереди
-                    for ticket in match_tickets:
-                        if ticket in tickets:
-                            tickets.remove(ticket)
+                    # Убираем билеты из очереди; матч сохранит match-committer уже без queue_lock
+                    propose_match(match_tickets, match_type)
+                    matches += 1
                     
-                    print(f"Created match {match_id} for {len(match_tickets)} players")
+                    if time.perf_counter() >= deadline:
+                        exhausted = True
+                        break
+                if exhausted:
+                    break
     
     except Exception as e:
         print(f"Error in queue processor: {e}")
     finally:
         queue_processor_running = False
+        matchmaker_stats.record_tick(started, time.perf_counter(), matches, exhausted, event)
+    
+    return exhausted and matches > 0
 
 # Инициализируем очереди при загрузке модуля
 init_queues()
 
-# Запускаем обработку очередей каждую секунду
-def start_queue_processor():
-    """Запускает обработчик очередей"""
+processor_thread: Optional[threading.Thread] = None
+committer_thread: Optional[threading.Thread] = None
+
+# Обработка очередей по таймеру (QUEUE_TICK_INTERVAL) и сразу после постановки билета,
+# сохранение собранных матчей - в отдельном потоке; запускается явно из create_app(), не при импорте модуля
+def start_queue_processor() -> threading.Thread:
+    """Запускает обработчик очередей и поток сохранения матчей (повторный вызов возвращает уже запущенный обработчик)"""
+    global processor_thread, committer_thread
+    
     def run_processor():
+        next_timer_tick = time.monotonic()
+        backlog = False
         while True:
-            process_queue()
-            time.sleep(1)
+            with queue_condition:
+                # Ждем постановки билета или такта по таймеру; не ждем, пока такты собирают матчи и упираются в бюджет
+                while not backlog and not dirty_match_types:
+                    timeout = next_timer_tick - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    queue_condition.wait(timeout)
+                timer = time.monotonic() >= next_timer_tick
+                # По событию смотрим только очереди с новыми билетами, по таймеру и при разборе - все
+                match_types = None if timer or backlog else sorted(dirty_match_types)
+                dirty_match_types.clear()
+            if timer:
+                next_timer_tick = time.monotonic() + QUEUE_TICK_INTERVAL
+            backlog = process_queue(match_types, event=match_types is not None)
+    
+    def run_committer():
+        # Один поток и FIFO: матчи и данные игроков сохраняются в порядке сборки,
+        # повтор сохранения задерживает следующие матчи, а не обгоняется ими
+        while True:
+            commit_match(match_commit_queue.get())
+            match_commit_queue.task_done()
     
-    processor_thread = threading.Thread(target=run_processor, daemon=True)
-    processor_thread.start()
-
-# Запускаем обработчик при загрузке модуля
-start_queue_processor()
+    with queue_lock:
+        if processor_thread is None:
+            committer_thread = threading.Thread(target=run_committer, name="match-committer", daemon=True)
+            committer_thread.start()
+            processor_thread = threading.Thread(target=run_processor, name="queue-processor", daemon=True)
+            processor_thread.start()
+    return processor_thread
 
 @queue_bp.route('/', methods=['GET'])
 def get_queues():
@@ -271,6 +402,19 @@ def get_queues():
         "queues": result
     })
 
+@queue_bp.route('/stats', methods=['GET'])
+def get_matchmaker_stats():
+    """Возвращает метрики обработчика очередей"""
+    return jsonify({
+        "status": "success",
+        "matchmaker": dict(matchmaker_stats.snapshot(), commit_queue=match_commit_queue.qsize()),
+        "settings": {
+            "tick_interval": QUEUE_TICK_INTERVAL,
+            "tick_budget": QUEUE_TICK_BUDGET,
+            "grouping_strategy": queue_grouping_strategy
+        }
+    })
+
 @queue_bp.route('/', methods=['POST'])
 def add_to_queue():
     """Добавляет пользователя в очередь"""
@@ -291,16 +435,16 @@ def add_to_queue():
         return jsonify({"status": "error", "message": "User not found"}), 404
     
     # Проверяем, не находится ли игрок уже в матче
-    profile_data = json.loads(user.get('profile_data', '{}'))
-    if profile_data.get('match_current'):
+    if user.get('match_current'):
         return jsonify({"status": "error", "message": "Player is already in a match"}), 409
     
-    # Проверяем, не находится ли игрок уже в очереди
-    with queue_lock:
-        for queue_type, tickets in queues.items():
-            for ticket in tickets:
-                if ticket.queue_player == player_id:
-                    return jsonify({"status": "error", "message": "Player is already in queue"}), 409
+    # Матч игрока собран, но еще сохраняется - match_current в базе пока пуст
+    if player_id in pending_matches:
+        return jsonify({"status": "error", "message": "Player is already in a match"}), 409
+    
+    # Проверяем, не находится ли игрок уже в очереди (окончательно - в enqueue_ticket под блокировкой)
+    if player_id in player_tickets:
+        return jsonify({"status": "error", "message": "Player is already in queue"}), 409
     
     # Создаем билет в очередь
     ticket = QueueTicket(
@@ -315,13 +459,15 @@ def add_to_queue():
     
     # Добавляем в очередь
     with queue_lock:
-        queues[match_type].append(ticket)
+        if player_id in pending_matches:
+            return jsonify({"status": "error", "message": "Player is already in a match"}), 409
+        if not enqueue_ticket(ticket):
+            return jsonify({"status": "error", "message": "Player is already in queue"}), 409
     
     # Обновляем данные игрока
-    profile_data['queue_ticket_id'] = ticket.queue_ticket_id
     db.update_user({
         'user_id': player_id,
-        'profile_data': json.dumps(profile_data)
+        'queue_ticket_id': ticket.queue_ticket_id
     })
     
     return jsonify({
@@ -343,31 +489,21 @@ def remove_from_queue():
         return jsonify({"status": "error", "message": "player_id required"}), 400
     
     player_id = data['player_id']
-    removed_ticket = None
     
-    # Ищем и удаляем билет из всех очередей
+    # Ищем билет игрока по индексу и удаляем его из очереди
     with queue_lock:
-        for match_type, tickets in queues.items():
-            for ticket in tickets[:]:  # Копируем список для безопасного удаления
-                if ticket.queue_player == player_id:
-                    tickets.remove(ticket)
-                    removed_ticket = ticket
-                    break
-            if removed_ticket:
-                break
+        removed_ticket = player_tickets.get(player_id)
+        if removed_ticket:
+            dequeue_ticket(removed_ticket)
     
     if not removed_ticket:
         return jsonify({"status": "error", "message": "Player not found in queue"}), 404
     
     # Обновляем данные игрока
-    user = db.get_user(player_id)
-    if user:
-        profile_data = json.loads(user.get('profile_data', '{}'))
-        profile_data['queue_ticket_id'] = None
-        db.update_user({
-            'user_id': player_id,
-            'profile_data': json.dumps(profile_data)
-        })
+    db.update_user({
+        'user_id': player_id,
+        'queue_ticket_id': None
+    })
     
     return jsonify({
         "status": "success",
@@ -390,6 +526,10 @@ def update_queue():
     
     # Можно обновить настройки матчмейкинга
     global all_mmr_min_limit_threshold, all_mmr_time_in_seconds_to_raise_threshold, all_mmr_raise_threshold_step
+    global queue_grouping_strategy
+    
+    if 'grouping_strategy' in data and data['grouping_strategy'] not in GROUPING_STRATEGIES:
+        return jsonify({"status": "error", "message": f"grouping_strategy must be one of: {', '.join(GROUPING_STRATEGIES)}"}), 400
     
     if 'mmr_min_limit_threshold' in data:
         all_mmr_min_limit_threshold = data['mmr_min_limit_threshold']
@@ -397,6 +537,8 @@ def update_queue():
         all_mmr_time_in_seconds_to_raise_threshold = data['mmr_time_in_seconds_to_raise_threshold']
     if 'mmr_raise_threshold_step' in data:
         all_mmr_raise_threshold_step = data['mmr_raise_threshold_step']
+    if 'grouping_strategy' in data:
+        queue_grouping_strategy = data['grouping_strategy']
     
     return jsonify({
         "status": "success",
@@ -404,28 +546,41 @@ def update_queue():
         "settings": {
             "mmr_min_limit_threshold": all_mmr_min_limit_threshold,
             "mmr_time_in_seconds_to_raise_threshold": all_mmr_time_in_seconds_to_raise_threshold,
-            "mmr_raise_threshold_step": all_mmr_raise_threshold_step
+            "mmr_raise_threshold_step": all_mmr_raise_threshold_step,
+            "grouping_strategy": queue_grouping_strategy
         }
     })
 
 @queue_bp.route('/player/<player_id>', methods=['GET'])
 def get_player_queue_status(player_id):
     """Получает статус игрока в очереди"""
-    with queue_lock:
-        for match_type, tickets in queues.items():
-            for ticket in tickets:
-                if ticket.queue_player == player_id:
-                    wait_time = (datetime.now() - ticket.queue_ticket_register_time).total_seconds()
-                    
-                    return jsonify({
-                        "inQueue": True,
-                        "queueType": match_type,
-                        "queueTime": int(wait_time),
-                        "currentMmrThreshold": calculate_mmr_threshold(ticket),
-                        "userMmr": ticket.queue_ticket_player_mmr,
-                        "matchId": "",  # Empty unless match found
-                        "matchFound": False  # Will be True when match is found
-                    })
+    # Чтение одного ключа словаря атомарно - опрос статуса не ждет queue_lock
+    ticket = player_tickets.get(player_id)
+    if ticket:
+        wait_time = (datetime.now() - ticket.queue_ticket_register_time).total_seconds()
+        
+        return jsonify({
+            "inQueue": True,
+            "queueType": ticket.queue_match_type,
+            "queueTime": int(wait_time),
+            "currentMmrThreshold": calculate_mmr_threshold(ticket),
+            "userMmr": ticket.queue_ticket_player_mmr,
+            "matchId": "",  # Empty unless match found
+            "matchFound": False  # Will be True when match is found
+        })
+    
+    # Матч собран, сохранение в базу еще идет
+    proposal = pending_matches.get(player_id)
+    if proposal:
+        return jsonify({
+            "inQueue": False,
+            "queueType": proposal.match_type,
+            "queueTime": 0,
+            "currentMmrThreshold": 0,
+            "userMmr": 0,
+            "matchId": proposal.match_id,
+            "matchFound": True
+        })
     
     return jsonify({
         "inQueue": False,
@@ -444,8 +599,12 @@ def clear_queue():
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
     
     with queue_lock:
-        for match_type in queues:
-            queues[match_type] = []
+        for tickets in queues.values():
+            tickets.clear()
+        player_tickets.clear()
+        dirty_match_types.clear()
+        scan_failed.clear()
+        db.counters.set('queue_users', 0)
     
     return jsonify({
         "status": "success",
@@ -89,9 +89,9 @@ def register_user():
         return jsonify({"status": "error", "message": "Password must be at least 6 characters"}), 400
     
     # Получаем порядковый номер для player_id
-    user_count = db.get_server_stats().get('total_users_count', 0)
-    player_id = f"user_{user_count+1}"
-    nick_name = data.get('nick_name') or f"Player {user_count+1}"
+    user_number = db.next_sequence_value('user_id')
+    player_id = f"user_{user_number}"
+    nick_name = data.get('nick_name') or f"Player {user_number}"
     email = data['email']
     password = data['password']
     avatar_url = data.get('avatar_url', "")
@@ -105,17 +105,7 @@ def register_user():
         'avatar_url': avatar_url,
         'mmr': mmr,
         'status': 'active',
-        'profile_data': json.dumps({
-            'match_current': None,
-            'queue_ticket_id': None,
-            'money': 0.0,
-            'last_login_time': None,
-            'last_logout_time': None,
-            'last_login_ip': '',
-            'last_logout_ip': '',
-            'last_login_device': '',
-            'last_logout_device': ''
-        })
+        'profile_data': '{}'  # match_current, money, last_login_* и т.д. хранятся в колонках users
     }
     
     try:
@@ -171,6 +161,26 @@ def delete_user():
         "user": deleted_user
     })
 
+@user_bp.route('/bulk', methods=['DELETE'])
+def delete_users():
+    """Удаляет нескольких пользователей одной транзакцией (например, ботов после нагрузочного теста)"""
+    if not verify_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    data = request.get_json()
+    
+    if not data or not isinstance(data.get('player_ids'), list):
+        return jsonify({"status": "error", "message": "player_ids list is required"}), 400
+    
+    deleted_users = db.delete_users(data['player_ids'])
+    
+    return jsonify({
+        "status": "success",
+        "message": f"Deleted {len(deleted_users)} users",
+        "deleted": list(deleted_users),
+        "not_found": [player_id for player_id in data['player_ids'] if player_id not in deleted_users]
+    })
+
 @user_bp.route('/find_by_email', methods=['GET'])
 def find_user_by_email():
     """Найти пользователя по email"""
@@ -179,23 +189,16 @@ def find_user_by_email():
         return jsonify({"status": "error", "message": "Email parameter required"}), 400
     
     try:
-        # Ищем пользователя в базе данных
-        conn = db.get_connection()
-        cursor = conn.cursor()
+        # Ищем пользователя в базе данных (в режиме шардирования - во всех шардах)
+        user_data = db.get_user_by_email(email)
         
-        cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        user_row = cursor.fetchone()
-        
-        if user_row:
-            user_data = dict(user_row)
-            conn.close()
+        if user_data:
             
             return jsonify({
                 "status": "success",
                 "user": user_data
             })
         else:
-            conn.close()
             return jsonify({
                 "status": "error",
                 "message": "User not found"
@@ -207,6 +210,27 @@ def find_user_by_email():
             "message": f"Database error: {str(e)}"
         }), 500
 
+@user_bp.route('/by_mmr', methods=['GET'])
+def find_users_by_mmr():
+    """Найти игроков с рейтингом в диапазоне mmr ± delta для типа матча"""
+    try:
+        match_type = int(request.args['match_type'])
+        mmr = int(request.args['mmr'])
+        delta = int(request.args.get('delta', 100))
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "match_type and mmr parameters required"}), 400
+    
+    users = db.find_users_by_mmr(match_type, mmr, delta, limit)
+    return jsonify({
+        "status": "success",
+        "match_type": match_type,
+        "mmr": mmr,
+        "delta": delta,
+        "users": users,
+        "total_users": len(users)
+    })
+
 @user_bp.route('/<player_id>', methods=['GET'])
 def get_user_profile(player_id):
     """Получить профиль пользователя по player_id"""
@@ -241,45 +265,28 @@ def update_game_data(player_id):
     if not data:
         return jsonify({"status": "error", "message": "No data"}), 400
     
-    # Получаем текущий профиль
-    user = db.get_user(player_id)
-    if not user:
-        return jsonify({"status": "error", "message": "User not found"}), 404
-    
-    # Обновляем profile_data
-    profile_data = json.loads(user.get('profile_data', '{}'))
-    
-    if 'match_current' in data:
-        profile_data['match_current'] = data['match_current']
-    if 'queue_ticket_id' in data:
-        profile_data['queue_ticket_id'] = data['queue_ticket_id']
-    if 'money' in data:
-        profile_data['money'] = data['money']
-    if 'last_login_time' in data:
-        profile_data['last_login_time'] = data['last_login_time']
-    if 'last_logout_time' in data:
-        profile_data['last_logout_time'] = data['last_logout_time']
-    if 'last_login_ip' in data:
-        profile_data['last_login_ip'] = data['last_login_ip']
-    if 'last_logout_ip' in data:
-        profile_data['last_logout_ip'] = data['last_logout_ip']
-    if 'last_login_device' in data:
-        profile_data['last_login_device'] = data['last_login_device']
-    if 'last_logout_device' in data:
-        profile_data['last_logout_device'] = data['last_logout_device']
-    
-    update_data = {
-        "user_id": player_id,
-        "profile_data": json.dumps(profile_data)
-    }
+    # Обновляем только переданные поля профиля (каждое - отдельная колонка users)
+    update_data = {"user_id": player_id}
+    for field in ['match_current', 'queue_ticket_id', 'money',
+                  'last_login_time', 'last_logout_time',
+                  'last_login_ip', 'last_logout_ip',
+                  'last_login_device', 'last_logout_device']:
+        if field in data:
+            update_data[field] = data[field]
     
     # Обновляем MMR если передан
     if 'mmr' in data:
         update_data['mmr'] = json.dumps(data['mmr'])
     
+    if len(update_data) == 1:
+        user = db.get_user(player_id)
+        if not user:
+            return jsonify({"status": "error", "message": "User not found"}), 404
+        return jsonify({"status": "success", "user": user})
+    
     updated = db.update_user(update_data)
     if not updated:
-        return jsonify({"status": "error", "message": "Failed to update user"}), 500
+        return jsonify({"status": "error", "message": "User not found"}), 404
     
     return jsonify({"status": "success", "user": updated})
 
@@ -301,15 +308,11 @@ def login_user():
     
     # Обновить время последнего входа
     import datetime
-    now = datetime.datetime.now().isoformat()
-    profile_data = json.loads(user.get('profile_data', '{}'))
-    profile_data['last_login_time'] = now
-    profile_data['last_login_ip'] = request.remote_addr
-    profile_data['last_login_device'] = request.headers.get('User-Agent', '')
-    
     db.update_user({
         "user_id": user['user_id'],
-        "profile_data": json.dumps(profile_data)
+        "last_login_time": datetime.datetime.now().isoformat(),
+        "last_login_ip": request.remote_addr,
+        "last_login_device": request.headers.get('User-Agent', '')
     })
     
     return jsonify({
@@ -332,15 +335,11 @@ def logout_user():
     
     # Обновить время последнего выхода
     import datetime
-    now = datetime.datetime.now().isoformat()
-    profile_data = json.loads(user.get('profile_data', '{}'))
-    profile_data['last_logout_time'] = now
-    profile_data['last_logout_ip'] = request.remote_addr
-    profile_data['last_logout_device'] = request.headers.get('User-Agent', '')
-    
     db.update_user({
         "user_id": user['user_id'],
-        "profile_data": json.dumps(profile_data)
+        "last_logout_time": datetime.datetime.now().isoformat(),
+        "last_logout_ip": request.remote_addr,
+        "last_logout_device": request.headers.get('User-Agent', '')
     })
     
     return jsonify({"status": "success", "message": "Logged out successfully"}) 
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+Индексы очередей матчмейкинга.
+
+Каждая очередь типа матча (queue_endpoints.queues) - TicketQueue: билеты хранятся
+сразу в двух порядках - по времени постановки (приоритет у дольше ждущих) и по MMR
+(оба - отсортированные списки ключей, поддерживаются через bisect). Группа ближайших по
+MMR игроков вокруг любого билета находится за O(log n + k), без сортировки всей
+очереди на каждом такте обработчика.
+
+Как собрать группу из очереди, решает стратегия из GROUPING_STRATEGIES
+(queue_endpoints.queue_grouping_strategy): 'anchor' - ближайшие по MMR игроки
+вокруг дольше всех ждущего билета, 'window' - самое узкое окно соседей по MMR,
+которое допускают пороги всех игроков окна.
+
+MatchmakerStats - метрики обработчика: матчи за такт, время такта и время
+разбора накопившейся очереди, сохранение собранных матчей (GET /api-game-queue/stats).
+"""
+
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+class TicketQueue:
+    """Очередь билетов одного типа матча: порядок ожидания + индекс по MMR.
+    
+    Порядок ожидания - по времени постановки, в том числе для билетов, вернувшихся
+    в очередь или поставленных не по порядку: стратегии группировки берут наибольший
+    порог у oldest(). MMR и время постановки билета - часть ключей обоих порядков,
+    поэтому после add() их нельзя менять (нужно remove() и снова add()).
+    """
+    
+    def __init__(self):
+        self._tickets: Dict[str, Any] = {}  # queue_ticket_id -> билет
+        # (время постановки, queue_ticket_id, билет) и (mmr, время постановки, queue_ticket_id, билет)
+        # по возрастанию; queue_ticket_id уникален, поэтому до сравнения самих билетов дело не доходит
+        self._by_wait: List[Tuple] = []
+        self._by_mmr: List[Tuple] = []
+    
+    @staticmethod
+    def _wait_key(ticket) -> Tuple:
+        return (ticket.queue_ticket_register_time, ticket.queue_ticket_id, ticket)
+    
+    @staticmethod
+    def _mmr_key(ticket) -> Tuple:
+        return (ticket.queue_ticket_player_mmr, ticket.queue_ticket_register_time, ticket.queue_ticket_id, ticket)
+    
+    def add(self, ticket):
+        """Добавляет билет на свои места в порядке ожидания и в индексе MMR"""
+        for entries, key in ((self._by_wait, self._wait_key(ticket)), (self._by_mmr, self._mmr_key(ticket))):
+            entries.insert(bisect_left(entries, key), key)
+        self._tickets[ticket.queue_ticket_id] = ticket
+    
+    def remove(self, ticket) -> bool:
+        """Удаляет билет из обоих порядков (False, если билета нет в очереди)"""
+        if self._tickets.pop(ticket.queue_ticket_id, None) is None:
+            return False
+        del self._by_wait[bisect_left(self._by_wait, self._wait_key(ticket))]
+        del self._by_mmr[bisect_left(self._by_mmr, self._mmr_key(ticket))]
+        return True
+    
+    def clear(self):
+        self._tickets.clear()
+        self._by_wait.clear()
+        self._by_mmr.clear()
+    
+    def oldest(self):
+        """Билет, который ждет дольше всех (None для пустой очереди)"""
+        return self._by_wait[0][-1] if self._by_wait else None
+    
+    def by_mmr(self) -> List[Any]:
+        """Билеты по возрастанию MMR"""
+        return [entry[-1] for entry in self._by_mmr]
+    
+    def nearest_group(self, anchor, size: int, max_diff: float,
+                      accepts: Callable[[Any, float], bool]) -> Optional[List[Any]]:
+        """Группа из size билетов, ближайших по MMR к anchor (anchor - первый в группе).
+        
+        Кандидаты перебираются от anchor в обе стороны по возрастанию разницы MMR,
+        пока она не превысит max_diff; accepts(ticket, diff) решает, подходит ли кандидат.
+        """
+        entries = self._by_mmr
+        mmr = anchor.queue_ticket_player_mmr
+        index = bisect_left(entries, self._mmr_key(anchor))
+        left, right = index - 1, index + 1
+        group = [anchor]
+        while len(group) < size:
+            left_diff = mmr - entries[left][0] if left >= 0 else None
+            right_diff = entries[right][0] - mmr if right < len(entries) else None
+            if left_diff is not None and (right_diff is None or left_diff <= right_diff):
+                candidate, diff = entries[left][-1], left_diff
+                left -= 1
+            elif right_diff is not None:
+                candidate, diff = entries[right][-1], right_diff
+                right += 1
+            else:
+                break
+            if diff > max_diff:
+                break
+            if accepts(candidate, diff):
+                group.append(candidate)
+        return group if len(group) == size else None
+    
+    def tightest_group(self, anchor, size: int, max_spread: float,
+                       accepts: Callable[[Any, float], bool]) -> Optional[List[Any]]:
+        """Самое узкое окно из size соседних по MMR билетов с anchor, которое принимают все билеты окна.
+        
+        Окна (их не больше size) перебираются по возрастанию разброса MMR, пока он не превысит
+        max_spread; accepts(ticket, diff) получает наибольшую разницу MMR билета с остальными в окне.
+        """
+        entries = self._by_mmr
+        position = bisect_left(entries, self._mmr_key(anchor))
+        starts = range(max(0, position - size + 1), min(position, len(entries) - size) + 1)
+        windows = [(entries[start + size - 1][0] - entries[start][0], start) for start in starts]
+        for spread, start in sorted(window for window in windows if window[0] <= max_spread):
+            window = entries[start:start + size]
+            low, high = window[0][0], window[-1][0]
+            if all(accepts(entry[-1], max(entry[0] - low, high - entry[0])) for entry in window):
+                return [entry[-1] for entry in window]
+        return None
+    
+    def __len__(self) -> int:
+        return len(self._tickets)
+    
+    def __iter__(self) -> Iterator[Any]:
+        """Билеты в порядке ожидания (дольше ждущие первыми)"""
+        return (entry[-1] for entry in self._by_wait)
+    
+    def __contains__(self, ticket) -> bool:
+        return ticket.queue_ticket_id in self._tickets
+
+# Стратегия группировки: (очередь, размер группы, порог MMR билета, deadline, failed) -> группа или None.
+# deadline - time.perf_counter(), после которого поиск прекращается; failed - queue_ticket_id билетов,
+# для которых группа на этом такте уже не нашлась: удаление других билетов в том же такте
+# группу для них не создает (для 'window' - почти никогда), поэтому повторно их не проверяем
+GroupingStrategy = Callable[[TicketQueue, int, Callable[[Any], float], Optional[float], Optional[Set[str]]],
+                            Optional[List[Any]]]
+
+def anchor_grouping(tickets: TicketQueue, size: int, threshold: Callable[[Any], float],
+                    deadline: Optional[float] = None, failed: Optional[Set[str]] = None) -> Optional[List[Any]]:
+    """Основа группы - билеты в порядке ожидания, к ней - ближайшие по MMR игроки в пределах
+    max(порог основы, свой порог) от основы (разброс группы - до двух порогов)"""
+    # Порог растет со временем ожидания: у дольше всех ждущего билета он самый большой,
+    # дальше него по MMR подходящих игроков быть не может
+    max_threshold = threshold(tickets.oldest())
+    for base_ticket in tickets:
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if failed is not None and base_ticket.queue_ticket_id in failed:
+            continue
+        base_threshold = threshold(base_ticket)
+        
+        def suitable(ticket, mmr_diff: float) -> bool:
+            return mmr_diff <= max(base_threshold, threshold(ticket))
+        
+        group = tickets.nearest_group(base_ticket, size, max_threshold, suitable)
+        if group:
+            return group
+        if failed is not None:
+            failed.add(base_ticket.queue_ticket_id)
+    return None
+
+def window_grouping(tickets: TicketQueue, size: int, threshold: Callable[[Any], float],
+                    deadline: Optional[float] = None, failed: Optional[Set[str]] = None) -> Optional[List[Any]]:
+    """Для билетов в порядке ожидания - самое узкое окно соседей по MMR, в котором каждый игрок
+    в пределах своего порога от всех остальных (разброс группы - не больше порога)"""
+    max_threshold = threshold(tickets.oldest())
+    for base_ticket in tickets:
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if failed is not None and base_ticket.queue_ticket_id in failed:
+            continue
+        group = tickets.tightest_group(base_ticket, size, max_threshold,
+                                       lambda ticket, mmr_diff: mmr_diff <= threshold(ticket))
+        if group:
+            return group
+        if failed is not None:
+            failed.add(base_ticket.queue_ticket_id)
+    return None
+
+GROUPING_STRATEGIES: Dict[str, GroupingStrategy] = {
+    'anchor': anchor_grouping,
+    'window': window_grouping,
+}
+
+@dataclass
+class MatchmakerStats:
+    """Метрики обработчика очередей"""
+    ticks: int = 0
+    event_ticks: int = 0  # такты, разбуженные постановкой билета, а не таймером
+    matches: int = 0
+    last_tick_matches: int = 0
+    max_tick_matches: int = 0
+    last_tick_ms: float = 0.0
+    max_tick_ms: float = 0.0
+    budget_exhausted: int = 0  # такты, на которых группы остались, а бюджет времени кончился
+    last_drain_ms: float = 0.0  # от начала первого такта до такта, после которого групп не осталось
+    max_drain_ms: float = 0.0
+    committed: int = 0  # матчи, сохраненные конвейером (queue_endpoints.commit_match)
+    commit_retries: int = 0
+    commit_failures: int = 0  # матчи, которые не удалось сохранить: игроки вернулись в очередь
+    commit_lag_ms: float = 0.0  # от сборки последнего сохраненного матча до конца его сохранения
+    _backlog_started: Optional[float] = field(default=None, repr=False)
+    
+    def record_tick(self, started: float, finished: float, matches: int, exhausted: bool, event: bool = False):
+        """Учитывает такт обработчика (started/finished - time.perf_counter())"""
+        elapsed_ms = (finished - started) * 1000
+        self.ticks += 1
+        self.event_ticks += event
+        self.matches += matches
+        self.last_tick_matches = matches
+        self.max_tick_matches = max(self.max_tick_matches, matches)
+        self.last_tick_ms = elapsed_ms
+        self.max_tick_ms = max(self.max_tick_ms, elapsed_ms)
+        if exhausted:
+            self.budget_exhausted += 1
+            if self._backlog_started is None:
+                self._backlog_started = started
+            return
+        if self._backlog_started is not None:
+            self.last_drain_ms = (finished - self._backlog_started) * 1000
+            self._backlog_started = None
+        elif matches:
+            self.last_drain_ms = elapsed_ms
+        else:
+            return
+        self.max_drain_ms = max(self.max_drain_ms, self.last_drain_ms)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Метрики для JSON ответа"""
+        result = {item.name: round(getattr(self, item.name), 2) for item in fields(self) if not item.name.startswith('_')}
+        result['matches_per_tick'] = round(self.matches / self.ticks, 2) if self.ticks else 0.0
+        result['draining'] = self._backlog_started is not None
+        return result
\ No newline at end of file
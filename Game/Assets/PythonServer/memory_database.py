@@ -0,0 +1,433 @@
+"""
+Хранилище игрового сервера в памяти (без файлов и SQL).
+
+Реализует тот же интерфейс GameStorage, что и GameDatabase: строки - словари
+с теми же колонками, ошибки - те же ValueError. Данные теряются при остановке
+процесса, поэтому хранилище подходит для бенчмарков и нагрузочных тестов
+(GAME_DB_BACKEND=memory), а не для игры.
+"""
+
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Any
+
+from storage import GameStorage, completed_future
+from records import LobbyUserRecord, MatchRecord
+from database import (StatsCounters, UserCache, USER_PROFILE_COLUMNS, USER_UPDATABLE_FIELDS, GAME_UPDATABLE_FIELDS,
+                      DB_RETENTION_DAYS, DB_RETENTION_INTERVAL, RetentionWorker,
+                      QueryProfiler, profiled_methods,
+                      _parse_mmr_list, encode_cursor, decode_cursor)
+
+def _timestamp() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+def _column_default(definition: str) -> Any:
+    """Значение по умолчанию колонки профиля по ее определению в USER_PROFILE_COLUMNS"""
+    if 'DEFAULT' not in definition:
+        return None
+    value = definition.split('DEFAULT', 1)[1].strip()
+    if definition.startswith('REAL'):
+        return float(value)
+    return value.strip("'")
+
+@profiled_methods
+class MemoryGameDatabase(GameStorage):
+    """Хранилище в словарях под одной блокировкой.
+    
+    Наружу отдаются копии строк, поэтому изменение результата вызывающим
+    кодом не меняет хранилище (как и в SQLite). wait=False возвращает уже
+    завершенный Future.
+    """
+    
+    def __init__(self):
+        """Инициализация пустого хранилища"""
+        self.counters = StatsCounters()
+        # Кэш не нужен, пустой экземпляр - для stats() в ответе лобби
+        self.user_cache = UserCache(max_size=0)
+        # SQL нет - профилировщик считает только время методов
+        self.profiler = QueryProfiler()
+        self.retention: Optional[RetentionWorker] = None
+        # Как в GameDatabase: True - списки возвращают записи records.py вместо копий словарей
+        self.use_records = False
+        self._lock = threading.RLock()
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._user_mmr: Dict[str, List[int]] = {}
+        self._lobby_users: Dict[str, Dict[str, Any]] = {}
+        self._queue_users: Dict[str, Dict[str, Any]] = {}
+        self._matches: Dict[str, Dict[str, Any]] = {}
+        self._game_sessions: List[Dict[str, Any]] = []
+        self._sequences: Dict[str, int] = {}
+        self._last_ids: Dict[str, int] = {}
+    
+    def _next_id(self, table: str) -> int:
+        """Следующий id строки таблицы (аналог AUTOINCREMENT)"""
+        self._last_ids[table] = self._last_ids.get(table, 0) + 1
+        return self._last_ids[table]
+    
+    def _result(self, result: Any, wait: bool) -> Any:
+        """Результат записи: значение или завершенный Future при wait=False"""
+        return result if wait else completed_future(result)
+    
+    def _update_row(self, row: Dict[str, Any], data: Dict[str, Any], key: str, fields: List[str]) -> bool:
+        """Применение разрешенных полей data к строке, False если менять нечего"""
+        values = {field: value for field, value in data.items() if field != key and field in fields}
+        row.update(values)
+        return bool(values)
+    
+    def close(self):
+        """Остановка фоновой очистки"""
+        if self.retention is not None:
+            self.retention.stop()
+            self.retention = None
+    
+    # Пользователи
+    def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание нового пользователя"""
+        with self._lock:
+            if user_data['user_id'] in self._users:
+                raise ValueError("User already exists")
+            user = {
+                'id': self._next_id('users'),
+                'user_id': user_data['user_id'],
+                'nick_name': user_data['nick_name'],
+                'email': user_data['email'],
+                'password': user_data['password'],
+                'avatar_url': user_data.get('avatar_url', ''),
+                'mmr': user_data.get('mmr', '[]'),
+                'status': user_data.get('status', 'active'),
+                'created_at': _timestamp(),
+                'last_login': None,
+                'profile_data': user_data.get('profile_data', '{}'),
+            }
+            user.update({column: _column_default(definition) for column, definition in USER_PROFILE_COLUMNS.items()})
+            self._users[user['user_id']] = user
+            self._user_mmr[user['user_id']] = _parse_mmr_list(user['mmr'])
+            self.counters.add('users')
+            return dict(user)
+    
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя по ID"""
+        with self._lock:
+            return dict(self._users.get(user_id, {}))
+    
+    def get_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получение нескольких пользователей: user_id -> строка"""
+        with self._lock:
+            return {user_id: dict(self._users[user_id]) for user_id in user_ids if user_id in self._users}
+    
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя по email (первый по id, как в SQLite)"""
+        with self._lock:
+            for user in self._users.values():
+                if user['email'] == email:
+                    return dict(user)
+        return {}
+    
+    def _apply_user_patch(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Обновление одного пользователя под блокировкой: None - нет полей, {} - нет пользователя"""
+        fields = [key for key in user_data if key != 'user_id' and key in USER_UPDATABLE_FIELDS]
+        if not fields:
+            return None
+        user = self._users.get(user_data['user_id'])
+        if user is None:
+            return {}
+        self._update_row(user, user_data, 'user_id', fields)
+        if 'mmr' in user_data:
+            self._user_mmr[user['user_id']] = _parse_mmr_list(user['mmr'])
+        return dict(user)
+    
+    def update_user(self, user_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление данных пользователя"""
+        with self._lock:
+            return self._result(self._apply_user_patch(user_data), wait)
+    
+    def update_users(self, patches: List[Dict[str, Any]], wait: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Обновление нескольких пользователей атомарно относительно других вызовов"""
+        users = {}
+        with self._lock:
+            for patch in patches:
+                user = self._apply_user_patch(patch)
+                if user is not None:
+                    users[patch['user_id']] = user
+        return self._result({user_id: user for user_id, user in users.items() if user}, wait)
+    
+    def delete_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя (None, если его нет)"""
+        return self.delete_users([user_id]).get(user_id)
+    
+    def delete_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Удаление пользователей и их строк в лобби, очереди, сессиях и рейтинге"""
+        deleted = {}
+        with self._lock:
+            for user_id in user_ids:
+                user = self._users.pop(user_id, None)
+                if user is None:
+                    continue
+                deleted[user_id] = user
+                self._user_mmr.pop(user_id, None)
+                if self._lobby_users.pop(user_id, None) is not None:
+                    self.counters.add('lobby_users', -1)
+                self._queue_users.pop(user_id, None)
+                self.counters.add('users', -1)
+            if deleted:
+                self._game_sessions = [session for session in self._game_sessions if session['user_id'] not in deleted]
+        return deleted
+    
+    def get_user_mmr(self, user_id: str, match_type: int) -> Optional[int]:
+        """Рейтинг игрока для типа матча (None, если записи нет)"""
+        with self._lock:
+            ratings = self._user_mmr.get(user_id, [])
+        return ratings[match_type] if 0 <= match_type < len(ratings) else None
+    
+    def find_users_by_mmr(self, match_type: int, mmr: int, delta: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Игроки с рейтингом в диапазоне mmr ± delta для типа матча, ближайшие к mmr первыми"""
+        with self._lock:
+            users = [{"user_id": user_id, "mmr": ratings[match_type]}
+                     for user_id, ratings in self._user_mmr.items()
+                     if match_type < len(ratings) and abs(ratings[match_type] - mmr) <= delta]
+        users.sort(key=lambda user: abs(user["mmr"] - mmr))
+        return users[:limit]
+    
+    def next_sequence_value(self, name: str) -> int:
+        """Следующий номер последовательности name"""
+        with self._lock:
+            self._sequences[name] = self._sequences.get(name, 0) + 1
+            return self._sequences[name]
+    
+    def _page(self, rows: Dict[str, Dict[str, Any]], record_class: type, limit: int, cursor: Optional[str],
+              offset: int = 0) -> list:
+        """Строки по убыванию (created_at, id) после курсора - копиями или записями record_class (use_records).
+        
+        id и created_at выдаются под одной блокировкой, поэтому порядок вставки
+        словаря совпадает с порядком (created_at, id) и сортировка не нужна.
+        """
+        ordered = reversed(rows.values())
+        if cursor:
+            position = decode_cursor(cursor)
+            ordered = (row for row in ordered if (row['created_at'], row['id']) < position)
+        page = itertools.islice(ordered, offset, offset + limit)
+        return [record_class.from_row(row) for row in page] if self.use_records else [dict(row) for row in page]
+    
+    # Лобби
+    def create_lobby_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание пользователя в лобби"""
+        with self._lock:
+            if user_data['user_id'] in self._lobby_users:
+                raise ValueError("User already in lobby")
+            user = {
+                'id': self._next_id('lobby_users'),
+                'user_id': user_data['user_id'],
+                'username': user_data['username'],
+                'status': user_data.get('status', 'active'),
+                'created_at': _timestamp(),
+                'last_seen': None,
+            }
+            self._lobby_users[user['user_id']] = user
+            self.counters.add('lobby_users')
+            return dict(user)
+    
+    def get_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя из лобби"""
+        with self._lock:
+            return dict(self._lobby_users.get(user_id, {}))
+    
+    def get_lobby_users(self, page: int = 1, per_page: int = 1000, cursor: Optional[str] = None,
+                        include_total: bool = True) -> Dict[str, Any]:
+        """Получение списка пользователей в лобби с пагинацией (курсор или page)"""
+        offset = 0 if cursor else (page - 1) * per_page
+        with self._lock:
+            users = self._page(self._lobby_users, LobbyUserRecord, per_page, cursor, offset)
+        result = {
+            "users": users,
+            "page": page,
+            "per_page": per_page,
+            "next_cursor": encode_cursor(users[-1]['created_at'], users[-1]['id']) if users and len(users) == per_page else None
+        }
+        if include_total:
+            total_users = self.get_row_count('lobby_users')
+            result["total_users"] = total_users
+            result["total_pages"] = (total_users + per_page - 1) // per_page
+        return result
+    
+    def update_lobby_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Обновление пользователя в лобби"""
+        fields = [key for key in user_data if key != 'user_id' and key in ['username', 'status']]
+        if not fields:
+            return None
+        with self._lock:
+            user = self._lobby_users.get(user_data['user_id'])
+            if user is None:
+                return {}
+            self._update_row(user, user_data, 'user_id', fields)
+            return dict(user)
+    
+    def delete_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя из лобби"""
+        with self._lock:
+            user = self._lobby_users.pop(user_id, None)
+            if user is not None:
+                self.counters.add('lobby_users', -1)
+            return user
+    
+    # Очередь
+    def add_user_to_queue(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавление пользователя в очередь"""
+        with self._lock:
+            if user_data['user_id'] in self._queue_users:
+                raise ValueError("User already in queue")
+            user = {
+                'id': self._next_id('queue_users'),
+                'user_id': user_data['user_id'],
+                'username': user_data['username'],
+                'joined_at': _timestamp(),
+                'priority': user_data.get('priority', 0),
+                'status': user_data.get('status', 'waiting'),
+            }
+            self._queue_users[user['user_id']] = user
+            return dict(user)
+    
+    def get_queue_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Получение пользователя из очереди"""
+        with self._lock:
+            return dict(self._queue_users.get(user_id, {}))
+    
+    def get_queue_users(self) -> Dict[str, Any]:
+        """Получение списка пользователей в очереди"""
+        with self._lock:
+            users = sorted((dict(user) for user in self._queue_users.values()),
+                           key=lambda user: (-user['priority'], user['joined_at'], user['id']))
+        return {
+            "users": users,
+            "total_users": len(users)
+        }
+    
+    def remove_user_from_queue(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя из очереди"""
+        with self._lock:
+            return self._queue_users.pop(user_id, None)
+    
+    def clear_queue(self) -> int:
+        """Удаление всех пользователей из очереди"""
+        with self._lock:
+            removed = len(self._queue_users)
+            self._queue_users.clear()
+            return removed
+    
+    # Игры
+    def create_game(self, game_data: Dict[str, Any], wait: bool = True) -> Dict[str, Any]:
+        """Создание новой игры"""
+        with self._lock:
+            if game_data['match_id'] in self._matches:
+                raise ValueError("Match already exists")
+            game = {
+                'id': self._next_id('matches'),
+                'match_id': game_data['match_id'],
+                'name': game_data['name'],
+                'status': game_data.get('status', 'waiting'),
+                'max_players': game_data.get('max_players', 4),
+                'current_players': game_data.get('current_players', 0),
+                'created_at': _timestamp(),
+                'started_at': None,
+                'ended_at': None,
+                'players': game_data.get('players', '[]'),
+            }
+            self._matches[game['match_id']] = game
+            self.counters.add('matches')
+            self.counters.add('active_matches', game['status'] == 'active')
+            return self._result(dict(game), wait)
+    
+    def get_game(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """Получение матча по ID"""
+        with self._lock:
+            return dict(self._matches.get(match_id, {}))
+    
+    def get_matches(self, limit: int = 100, cursor: Optional[str] = None,
+                    include_total: bool = True) -> Dict[str, Any]:
+        """Получение списка игр (новые первыми) с пагинацией по курсору"""
+        with self._lock:
+            matches = self._page(self._matches, MatchRecord, limit, cursor)
+        result = {
+            "matches": matches,
+            "limit": limit,
+            "next_cursor": encode_cursor(matches[-1]['created_at'], matches[-1]['id']) if matches and len(matches) == limit else None
+        }
+        if include_total:
+            result["total_matches"] = self.get_row_count('matches')
+        return result
+    
+    def update_game(self, game_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление данных игры (ended_at завершает открытые сессии ее игроков)"""
+        fields = [key for key in game_data if key != 'match_id' and key in GAME_UPDATABLE_FIELDS]
+        if not fields:
+            return self._result(None, wait)
+        with self._lock:
+            game = self._matches.get(game_data['match_id'])
+            if game is None:
+                return self._result({}, wait)
+            was_active = game['status'] == 'active'
+            self._update_row(game, game_data, 'match_id', fields)
+            if game_data.get('ended_at'):
+                for session in self._game_sessions:
+                    if session['match_id'] == game['match_id'] and session.get('left_at') is None:
+                        session['left_at'] = game_data['ended_at']
+            self.counters.add('active_matches', (game['status'] == 'active') - was_active)
+            return self._result(dict(game), wait)
+    
+    def delete_game(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление игры и ее сессий"""
+        with self._lock:
+            game = self._matches.pop(match_id, None)
+            if game is None:
+                return None
+            self._game_sessions = [session for session in self._game_sessions if session['match_id'] != match_id]
+            self.counters.add('matches', -1)
+            self.counters.add('active_matches', -(game['status'] == 'active'))
+            return game
+    
+    # Статистика и обслуживание
+    def get_server_stats(self) -> Dict[str, Any]:
+        """Получение статистики сервера из счетчиков"""
+        return {
+            "lobby_users_count": self.counters.get('lobby_users'),
+            "queue_users_count": self.counters.get('queue_users'),
+            "active_matches_count": self.counters.get('active_matches'),
+            "total_users_count": self.counters.get('users')
+        }
+    
+    def get_row_count(self, table: str) -> int:
+        """Количество строк таблицы из счетчиков"""
+        return self.counters.get(table)
+    
+    def cleanup_old_data(self, days: int = DB_RETENTION_DAYS) -> Dict[str, Any]:
+        """Очистка старых данных (см. run_retention)"""
+        return self.run_retention(days)
+    
+    def run_retention(self, days: int = DB_RETENTION_DAYS, stop: Optional[threading.Event] = None,
+                      **options) -> Dict[str, Any]:
+        """Удаление завершенных игр и сессий старше days дней (отчет в формате GameDatabase.run_retention)"""
+        started = time.perf_counter()
+        cutoff = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            sessions_before = len(self._game_sessions)
+            self._game_sessions = [session for session in self._game_sessions
+                                   if session.get('left_at') is None or session['left_at'] >= cutoff]
+            expired = [match_id for match_id, game in self._matches.items()
+                       if game['ended_at'] is not None and game['ended_at'] < cutoff]
+            for match_id in expired:
+                game = self._matches.pop(match_id)
+                self.counters.add('matches', -1)
+                self.counters.add('active_matches', -(game['status'] == 'active'))
+            lock_ms = round((time.perf_counter() - started) * 1000, 2)
+        return {"game_sessions": sessions_before - len(self._game_sessions), "matches": len(expired),
+                "chunks": 1, "vacuum_pages": 0, "max_lock_ms": lock_ms, "total_lock_ms": lock_ms,
+                "duration_ms": lock_ms}
+    
+    def start_retention_worker(self, days: int = DB_RETENTION_DAYS,
+                               interval: float = DB_RETENTION_INTERVAL) -> RetentionWorker:
+        """Запуск фоновой очистки старых данных (повторный вызов возвращает уже запущенную)"""
+        if self.retention is None:
+            self.retention = RetentionWorker(self, days, interval)
+        return self.retention
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Компактные записи строк lobby_users и matches.
+
+При db.use_records = True списки (get_lobby_users, get_matches) возвращают записи
+вместо dict(row): запись хранит значения строки одним кортежем и занимает в несколько
+раз меньше памяти, чем словарь. Выгода - только в памяти: при сериализации ответа
+(RecordJSONProvider в _GAME_SERVER_MAIN.py) словарь все равно строится, и ответ
+выходит не быстрее, чем со словарями, поэтому по умолчанию записи выключены.
+Для остального кода запись - это Mapping только для чтения: record['user_id'],
+record.get(...), dict(record).
+"""
+
+from collections.abc import Mapping
+from typing import List, Dict, Optional, Any, Tuple
+
+class Record(Mapping):
+    """Базовый класс записей: значения строки в кортеже, доступ к полям как к ключам словаря"""
+    
+    __slots__ = ('_values',)
+    _fields: Tuple[str, ...] = ()
+    _index: Dict[str, int] = {}
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._index = {name: position for position, name in enumerate(cls._fields)}
+    
+    def __init__(self, *values):
+        self._values = values
+    
+    @classmethod
+    def from_rows(cls, rows) -> List['Record']:
+        """Записи из строк sqlite3.Row (или словарей) одного запроса"""
+        if not rows:
+            return []
+        if not isinstance(rows[0], dict) and tuple(rows[0].keys()) == cls._fields:
+            # Порядок колонок совпадает с полями - кортеж значений без разбора имен
+            return [cls(*row) for row in rows]
+        return [cls.from_row(row) for row in rows]
+    
+    @classmethod
+    def from_row(cls, row) -> Optional['Record']:
+        """Запись из одной строки (None, если строки нет)"""
+        return cls(*(row[name] for name in cls._fields)) if row is not None else None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Словарь с полями записи - для JSON ответа"""
+        return dict(zip(self._fields, self._values))
+    
+    def __getitem__(self, key: str) -> Any:
+        return self._values[self._index[key]]
+    
+    def __iter__(self):
+        return iter(self._fields)
+    
+    def __len__(self) -> int:
+        return len(self._fields)
+    
+    def __contains__(self, key) -> bool:
+        return key in self._index
+    
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class LobbyUserRecord(Record):
+    """Строка таблицы lobby_users"""
+    __slots__ = ()
+    _fields = ('id', 'user_id', 'username', 'status', 'created_at', 'last_seen')
+
+class MatchRecord(Record):
+    """Строка таблицы matches"""
+    __slots__ = ()
+    _fields = ('id', 'match_id', 'name', 'status', 'max_players', 'current_players',
+               'created_at', 'started_at', 'ended_at', 'players')
\ No newline at end of file
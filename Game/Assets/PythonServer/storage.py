@@ -0,0 +1,176 @@
+"""
+Интерфейс хранилища игрового сервера.
+
+Endpoint'ы работают с глобальным db через методы GameStorage и не зависят
+от реализации: GameDatabase (SQLite, database.py), ShardedGameDatabase
+(SQLite по шардам) или MemoryGameDatabase (словари в памяти, memory_database.py).
+Строки возвращаются словарями с колонками таблиц из DATABASE_DOCUMENTATION.md,
+отсутствующая строка - пустой словарь; get_users возвращает такие же словари.
+Списки (get_lobby_users, get_matches) - тоже словари, при use_records = True -
+записи records.py (Mapping с теми же ключами).
+"""
+
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import List, Dict, Optional, Any
+
+# Значения по умолчанию фоновых задач - общие для всех реализаций (database.py импортирует их отсюда)
+DB_RETENTION_DAYS = 30  # сколько дней хранятся завершенные игры и игровые сессии
+DB_RETENTION_INTERVAL = 3600.0  # период запуска фоновой очистки в секундах
+DB_BACKUP_INTERVAL = 3600.0  # период фонового копирования в секундах
+DB_BACKUP_KEEP = 5  # сколько последних копий хранить
+
+class GameStorage(ABC):
+    """Базовый класс хранилища: методы, от которых зависят endpoint'ы.
+    
+    Абстрактные методы обязательны: реализация без любого из них не создается
+    (TypeError при создании экземпляра, а не при первом вызове).
+    
+    Реализации также предоставляют атрибуты counters (StatsCounters -
+    счетчики статистики, queue_users ведет очередь в памяти), user_cache
+    (UserCache, его stats() отдает лобби) и profiler (QueryProfiler - время
+    методов и запросов).
+    """
+    
+    # Пользователи
+    @abstractmethod
+    def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание пользователя (ValueError, если он уже существует)"""
+    
+    @abstractmethod
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Пользователь по ID"""
+    
+    @abstractmethod
+    def get_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Несколько пользователей: user_id -> строка (отсутствующих нет в результате)"""
+    
+    @abstractmethod
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """Пользователь по email"""
+    
+    @abstractmethod
+    def update_user(self, user_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление полей пользователя (wait=False - вернуть Future)"""
+    
+    @abstractmethod
+    def update_users(self, patches: List[Dict[str, Any]], wait: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Обновление нескольких пользователей: user_id -> строка (wait=False - Future)"""
+    
+    @abstractmethod
+    def delete_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя и связанных с ним строк (None, если его нет)"""
+    
+    @abstractmethod
+    def delete_users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Удаление нескольких пользователей: user_id -> удаленная строка (отсутствующих нет в результате)"""
+    
+    @abstractmethod
+    def get_user_mmr(self, user_id: str, match_type: int) -> Optional[int]:
+        """Рейтинг игрока для типа матча (None, если записи нет)"""
+    
+    @abstractmethod
+    def find_users_by_mmr(self, match_type: int, mmr: int, delta: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Игроки с рейтингом в диапазоне mmr ± delta, ближайшие к mmr первыми"""
+    
+    @abstractmethod
+    def next_sequence_value(self, name: str) -> int:
+        """Следующий номер последовательности name"""
+    
+    # Лобби
+    @abstractmethod
+    def create_lobby_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавление пользователя в лобби (ValueError, если он уже там)"""
+    
+    @abstractmethod
+    def get_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Пользователь из лобби"""
+    
+    @abstractmethod
+    def get_lobby_users(self, page: int = 1, per_page: int = 1000, cursor: Optional[str] = None,
+                        include_total: bool = True) -> Dict[str, Any]:
+        """Страница пользователей лобби (новые первыми) с next_cursor (ValueError при неверном курсоре)"""
+    
+    @abstractmethod
+    def update_lobby_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Обновление пользователя в лобби"""
+    
+    @abstractmethod
+    def delete_lobby_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя из лобби (None, если его там нет)"""
+    
+    # Очередь
+    @abstractmethod
+    def add_user_to_queue(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавление пользователя в очередь (ValueError, если он уже в ней)"""
+    
+    @abstractmethod
+    def get_queue_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Пользователь из очереди"""
+    
+    @abstractmethod
+    def get_queue_users(self) -> Dict[str, Any]:
+        """Пользователи в очереди по приоритету и времени входа"""
+    
+    @abstractmethod
+    def remove_user_from_queue(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление пользователя из очереди (None, если его там нет)"""
+    
+    @abstractmethod
+    def clear_queue(self) -> int:
+        """Удаление всех пользователей из очереди, возвращает количество удаленных"""
+    
+    # Игры
+    @abstractmethod
+    def create_game(self, game_data: Dict[str, Any], wait: bool = True) -> Dict[str, Any]:
+        """Создание игры (ValueError, если она уже существует; wait=False - вернуть Future)"""
+    
+    @abstractmethod
+    def get_game(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """Игра по ID"""
+    
+    @abstractmethod
+    def get_matches(self, limit: int = 100, cursor: Optional[str] = None,
+                    include_total: bool = True) -> Dict[str, Any]:
+        """Страница игр (новые первыми) с next_cursor (ValueError при неверном курсоре)"""
+    
+    @abstractmethod
+    def update_game(self, game_data: Dict[str, Any], wait: bool = True) -> Optional[Dict[str, Any]]:
+        """Обновление полей игры (wait=False - вернуть Future)"""
+    
+    @abstractmethod
+    def delete_game(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """Удаление игры (None, если ее нет)"""
+    
+    # Статистика и обслуживание
+    @abstractmethod
+    def get_server_stats(self) -> Dict[str, Any]:
+        """Статистика сервера: lobby_users_count, queue_users_count, active_matches_count, total_users_count"""
+    
+    @abstractmethod
+    def get_row_count(self, table: str) -> int:
+        """Количество строк таблицы (users, lobby_users, matches)"""
+    
+    @abstractmethod
+    def cleanup_old_data(self, days: int = DB_RETENTION_DAYS) -> Dict[str, Any]:
+        """Удаление завершенных игр и сессий старше days дней, возвращает отчет"""
+    
+    @abstractmethod
+    def start_retention_worker(self, days: int = DB_RETENTION_DAYS, interval: float = DB_RETENTION_INTERVAL):
+        """Запуск фоновой очистки старых данных"""
+    
+    def start_backup_worker(self, interval: float = DB_BACKUP_INTERVAL, keep: int = DB_BACKUP_KEEP,
+                            backup_dir: Optional[str] = None):
+        """Запуск фонового резервного копирования (хранилище без файлов ничего не копирует)"""
+    
+    def flush(self, timeout: Optional[float] = None):
+        """Ожидание записи всех поставленных в очередь операций"""
+    
+    def close(self):
+        """Освобождение ресурсов хранилища"""
+
+def completed_future(result: Any) -> Future:
+    """Уже завершенный Future - для wait=False в реализациях без отложенной записи"""
+    future = Future()
+    future.set_result(result)
+    return future
\ No newline at end of file